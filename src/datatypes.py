@@ -1,6 +1,16 @@
 import sys
+import copy
+import math
 import time
+import array
+import bisect
+import heapq
 import traceback
+try:
+  import numpy  # for PointCodec's vectorized path
+  use_numpy = True
+except ImportError:
+  use_numpy = False
 
 ##############################################################################
 # ----------------------------- State classes ------------------------------ #
@@ -28,11 +38,35 @@ it.  More generally, you can think of this as a ``session''.'''
     def height(self):
       return self.win_sz[1]
 
+    def copy(self):
+      state = Lecture.State()
+      state.color = self.color
+      state.thickness = self.thickness
+      state.win_sz = self.win_sz
+      return state
+
+    def update(self, event):
+      '''Updates the state (the state of Deskcorder at the time this event was
+      made) based on the event.'''
+      f = Lecture.State.UPDATE.table[event.kind]
+      if f is not None: f(self, event)
+
+    def _update_thickness(self, event):
+      self.thickness = event.thickness
+
+    def _update_win_sz(self, event):
+      self.win_sz = (event.width(), event.height())
+
+    def _update_color(self, event):
+      self.color = event.color
+
   class Iterator(object):
-    '''Iterates over the events in a Lecture object.'''
-    def __init__(self, events):
+    '''Iterates over the events in a Lecture object.  If the Lecture itself is
+    given as 'lec', seeking also restores the state at the new position.'''
+    def __init__(self, events, lec = None):
       self.events = events
-      self.state = Lecture.State()
+      self.lec = lec
+      self.state = lec.state_at(0) if lec is not None else Lecture.State()
       self.offset = events[0].utime() if len(events) > 0 else 0
       self.i = 0  # i is always the next to be returned.
                   # When i has passed the end of lec, we're done.
@@ -45,13 +79,21 @@ it.  More generally, you can think of this as a ``session''.'''
       '''Continue as though the last call to next() brought the iterator to
       prog.'''
       abs_prog = self.offset + prog
-      self.i = 0  # reset
-      # Increment until we're at one before what should be the next one.
-      while self.events[self.i].utime() <= abs_prog: self.i += 1
+      if isinstance(self.events, EventStore):
+        self.i = self.events.index_of_time(abs_prog)
+      else:
+        self.i = 0  # reset
+        # Increment until we're at one before what should be the next one.
+        while self.has_next() and self.events[self.i].utime() <= abs_prog:
+          self.i += 1
+      if self.lec is not None:
+        self.state = self.lec.state_at(self.i)
 
     def seek(self, idx):
       '''Continue as though lecture[idx] is next.'''
       self.i = idx
+      if self.lec is not None:
+        self.state = self.lec.state_at(self.i)
 
     def has_next(self):
       return len(self.events) > self.i
@@ -59,14 +101,7 @@ it.  More generally, you can think of this as a ``session''.'''
     def _update_state(self, event):
       '''Updates the iterator state (the state of Deskcorder at the time
       this event was made) based on the event.'''
-      if isinstance(event, Clear):
-        pass
-      elif isinstance(event, Thickness):
-        self.state.thickness = event.thickness
-      elif isinstance(event, Start):
-        self.state.win_sz = (event.width(), event.height())
-      elif isinstance(event, Color):
-        self.state.color = event.color
+      self.state.update(event)
 
     def peek(self):
       '''Return the next value without iterating.'''
@@ -82,11 +117,10 @@ it.  More generally, you can think of this as a ``session''.'''
 [Note]: The only exception to (2) is when you use a seek().'''
       if prog is None:  # Default "get me the next one"
         if self.has_next():
-          try:
-            self._update_state(self.peek())
-            return self.peek()
-          finally:
-            self.i += 1
+          e = self.events[self.i]
+          self.i += 1
+          self._update_state(e)
+          return e
         else:
           raise StopIteration("End of lecture.")
       # Get me everything not yet returned, that should be displayed (may skip
@@ -95,28 +129,194 @@ it.  More generally, you can think of this as a ``session''.'''
       # them -_- )
       else:
         abs_prog = self.offset + prog
+        if isinstance(self.events, EventStore):
+          end = max(self.i, self.events.index_of_time(abs_prog))
+          elems = [self.events[i] for i in xrange(self.i, end)]
+          for e in elems: self._update_state(e)
+          self.i = end
+          return elems
         elems = []
         while self.has_next():
-          if self.peek().utime() > abs_prog: break
-          self._update_state(self.peek())
-          elems.append(self.peek())
+          e = self.events[self.i]
+          if e.utime() > abs_prog: break
+          self._update_state(e)
+          elems.append(e)
           self.i += 1
         return elems
 
-  def __init__(self):
+  class Stroke(object):
+    '''A stroke: the pen samples from a Click up to and including its Release,
+    kept as the range [start,end) of indexes into the lecture's events.
+    The aggregates (number of points, bounding box, ink length, times) are
+    added up as the lecture scans the stroke, so reading them doesn't touch
+    the events.  A stroke whose Release hasn't been seen yet isn't 'closed'
+    and ends after its last sample so far.'''
+    def __init__(self, events, start, state):
+      self.events = events
+      self.start = start
+      self.end = start
+      self.closed = False
+      self.color = state.color
+      self.thickness = state.thickness
+      self.num_points = 0
+      self.xmin = self.ymin = self.xmax = self.ymax = None
+      self.length = .0  # of the ink, in the points' coordinates
+      self.t0 = self.t1 = None
+
+    def _add(self, i, t, x, y):
+      '''Adds the sample at index i to the stroke.'''
+      if self.num_points == 0:
+        self.xmin = self.xmax = x
+        self.ymin = self.ymax = y
+        self.t0 = t
+      else:
+        if x < self.xmin: self.xmin = x
+        elif x > self.xmax: self.xmax = x
+        if y < self.ymin: self.ymin = y
+        elif y > self.ymax: self.ymax = y
+        self.length += math.hypot(x - self._x, y - self._y)
+      self._x, self._y = x, y
+      self.t1 = t
+      self.num_points += 1
+      self.end = i + 1
+
+    def bbox(self):
+      '''Returns (xmin, ymin, xmax, ymax), or None if there are no points.'''
+      if self.num_points == 0: return None
+      return (self.xmin, self.ymin, self.xmax, self.ymax)
+
+    def duration(self):
+      return self.t1 - self.t0 if self.num_points > 0 else .0
+
+    def points(self):
+      '''Returns the Click, Points and Release of the stroke.'''
+      kinds = self.events.kinds
+      return [self.events[i] for i in xrange(self.start, self.end)
+              if kinds[i] in EventStore.POINT_KINDS]
+
+    def first(self):
+      return self.events[self.start]
+
+    def r(self):
+      return self.color[0]
+
+    def g(self):
+      return self.color[1]
+
+    def b(self):
+      return self.color[2]
+
+  class Slide(object):
+    '''A slide: the range [start,end) of the lecture's events from a Start or
+    Clear up to the next one, with the strokes that begin on it and totals
+    over them (points, ink length, bounding box, ink colors).  Lecture
+    extends the slide as events come in; strokes that are done are added to
+    the totals once, and only the one still being drawn is re-added.'''
+    def __init__(self, events, start, size):
+      self.events = events
+      self.start = start
+      self.end = start
+      self.t = events.time_at(start)
+      self.t_end = self.t
+      self.size = size  # window size
+      self.strokes = []
+      self._done = 0  # strokes[:_done] are in the _done_* totals
+      self._done_totals = (0, .0, None, frozenset())
+      self.num_points = 0
+      self.length = .0
+      self.colors = frozenset()
+      self._bbox = None
+
+    def _extend(self, end, strokes, live):
+      '''Catches up with the lecture: the slide now ends at 'end', 'strokes'
+      begin on it after the ones it has, and 'live' is the stroke still being
+      drawn (or None).'''
+      self.end = end
+      self.t_end = self.events.time_at(end - 1)
+      self.strokes.extend(strokes)
+      points, length, bbox, colors = self._done_totals
+      colors = set(colors)
+      while self._done < len(self.strokes) \
+          and self.strokes[self._done] is not live:
+        st = self.strokes[self._done]
+        points += st.num_points
+        length += st.length
+        bbox = Lecture.Slide._union(bbox, st.bbox())
+        colors.add(st.color)
+        self._done += 1
+      self._done_totals = (points, length, bbox, frozenset(colors))
+      if self._done < len(self.strokes):  # the live one
+        points += live.num_points
+        length += live.length
+        bbox = Lecture.Slide._union(bbox, live.bbox())
+        colors.add(live.color)
+      self.num_points = points
+      self.length = length
+      self._bbox = bbox
+      self.colors = frozenset(colors)
+
+    @staticmethod
+    def _union(a, b):
+      if a is None: return b
+      if b is None: return a
+      return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]),
+              max(a[3], b[3]))
+
+    def aspect_ratio(self):
+      return self.size[0] / float(self.size[1])
+
+    def duration(self):
+      return self.t_end - self.t
+
+    def bbox(self):
+      '''Returns the (xmin, ymin, xmax, ymax) of all the strokes, or None if
+      there are no points.'''
+      return self._bbox
+
+    def summary(self):
+      '''Returns the slide's totals as a dict (see fileio's slide summaries).'''
+      return {'t': self.t, 't_end': self.t_end, 'size': self.size,
+              'strokes': len(self.strokes), 'points': self.num_points,
+              'length': self.length, 'bbox': self._bbox,
+              'colors': sorted(self.colors)}
+
+  def __init__(self, state=None):
     '''Initialize a blank state object.  If you have internal data (formerly
-known as a "trace"), then you can just pass that here.'''
-    self.state = Lecture.State() # keep track of line thickness, etc.
-    self.events = []
+known as a "trace"), then you can just pass that here.  'state' is the
+Lecture.State to start out in, e.g. for a lecture holding one slide of a
+longer one (default: a fresh one).'''
+    if state is None: state = Lecture.State()
+    self.state = state.copy() # keep track of line thickness, etc.
+    self.events = EventStore()
     self.adats = []
     self.vdats = []  # XXX For a future release.
+    self.journal = None  # logs what's appended, if set (see fileio.Journal)
+
+    # Indexes over self.events.  Only the first self._indexed events have been
+    # indexed; _sync() catches up (see there).
+    self._indexed = 0
+    self._ck_idx = array.array('l', [0])  # checkpoint positions, and
+    self._ck_state = [state.copy()]       # the state before each of them
+    self._run_state = state.copy()        # the state after _indexed events
+    self._slide_idx = array.array('l')    # positions of Starts and Clears,
+    self._slide_t = array.array('d')      # and their times
+    self._obj_last = {}  # class -> positions of stored objects of that class
+    self._kind_last = [-1] * len(EVENT_TYPES)  # kind -> last position
+
+    # Stroke and slide views (see strokes() and slides()).  These are built
+    # when asked for, from where the last call left off.
+    self._strokes = []
+    self._stroke_starts = array.array('l')
+    self._stroke_scan = 0      # events before this have been scanned,
+    self._stroke_state = None  # leaving this state (None: use state_at())
+    self._slides = []
 
   def __str__(self):
     return 'Lecture with %d events, %d audio blocks, and %d video blocks' \
         % (len(self.events), len(self.adats), len(self.vdats))
 
   def __iter__(self):
-    return Lecture.Iterator(self.events)
+    return Lecture.Iterator(self.events, self)
 
   def __getitem__(self, i):
     return self.events[i]
@@ -130,41 +330,208 @@ known as a "trace"), then you can just pass that here.'''
     else:
       self.state.win_sz = (val * self.state.win_sz[1], self.state.win_sz[1])
 
+  def snapshot(self):
+    '''Returns a copy of the lecture as it is now, that changes to either
+    won't affect (see EventStore.copy()): e.g. to save it on another thread
+    while this one keeps being added to.  Its indexes are built as it's
+    first read, by whichever thread that is.  The AudioData are shared.'''
+    lec = Lecture(self._ck_state[0])
+    lec.events = self.events.copy()
+    lec.state = self.state.copy()
+    lec.adats = list(self.adats)
+    lec.vdats = list(self.vdats)
+    return lec
+
   def append(self, e):
-    if isinstance(e, AudioRecord):
-      self.adats.append(e.get_media())
-    elif isinstance(e, VideoRecord):
-      self.vdats.append(e.get_media())
-    elif isinstance(e, Start):
-      self.resize(e.size)
-    elif isinstance(e, End):
-      self.resize(e.size)
-    elif isinstance(e, ScreenEvent):
-      sys.stdout.flush()
-      if isinstance(e, Resize):
-        sys.stderr.write('''Warning: I'd prefer you use Lecture.resize((w,h))
-                           to Lecture.append(Resize(t,(w,h))) at:\n''')
-      else:
-        sys.stderr.write('''Warning: Unrecognized ScreenEvent at:\n''')
-      traceback.print_stack()
-      sys.stderr.flush()
-      self.resize(e.size)
-      return  # because resize handles everything
-    elif isinstance(e, Color):
-      self.state.color = e.color
-    elif isinstance(e, Thickness):
-      self.state.thickness = e.thickness
-    elif isinstance(e, float):
+    if isinstance(e, float):
       e = Clear(e, None)
-    self.events.append(e)
-
-  def resize(self, size):
-    '''Registers with the lecture that the canvas has been resized.'''
+    if Lecture.APPEND(self, e):
+      self.events.append(e)
+      self._sync()
+      if self.journal is not None:
+        self.journal.add(e)
+
+  # Handlers for Lecture.APPEND.  They return whether to store the event.
+
+  def _append_audio(self, e):
+    self.adats.append(e.get_media())
+    return True
+
+  def _append_video(self, e):
+    self.vdats.append(e.get_media())
+    return True
+
+  def _append_start_end(self, e):
+    # Not resize(): that would add a Resize at time.time() before e.
+    self.state.win_sz = e.size
+    return True
+
+  def _append_screen(self, e):
+    sys.stdout.flush()
+    if isinstance(e, Resize):
+      sys.stderr.write('''Warning: I'd prefer you use Lecture.resize((w,h))
+                         to Lecture.append(Resize(t,(w,h))) at:\n''')
+    else:
+      sys.stderr.write('''Warning: Unrecognized ScreenEvent at:\n''')
+    traceback.print_stack()
+    sys.stderr.flush()
+    self.resize(e.size)
+    return False  # because resize handles everything
+
+  def _append_color(self, e):
+    self.state.color = e.color
+    return True
+
+  def _append_thickness(self, e):
+    self.state.thickness = e.thickness
+    return True
+
+  def _append_other(self, e):
+    return True
+
+  def append_samples(self, kinds, ts, xs, ys, ps):
+    '''Appends a run of pen samples, given column by column (see
+    EventStore.extend_samples()).  Same as appending the events one by one,
+    but much faster for long runs.'''
+    self.events.extend_samples(kinds, ts, xs, ys, ps)
+    self._sync()
+
+  def merge(self, *sources):
+    '''Merges sequences of events, each sorted by time, in among the
+    lecture's events (see EventStore.merge()).  Much faster than inserting
+    them one by one.  Unlike append(), this only stores the events: e.g. an
+    AudioRecord's data isn't added to adats.'''
+    self.events.merge(*sources)
+    self._sync()
+
+  def set_time(self, i, t):
+    '''Changes the time of the event at index i to t.  Use this instead of
+    changing the event's t directly, so that seeking stays correct.'''
+    self.events.set_time(i, t)
+
+  def resize(self, size, t=None):
+    '''Registers with the lecture that the canvas has been resized (at time
+    t, or now).'''
+    if t is None: t = time.time()
     if isinstance(self.last(), ScreenEvent):
       self.last().size = size
+      self.events.touch(len(self.events) - 1)
     else:
-      self.events.append(Resize(time.time(), size))
+      self.events.append(Resize(t, size))
     self.state.win_sz = size
+    self._sync()
+    if self.journal is not None:
+      self.journal.add(Resize(t, size))  # replays as the same resize()
+
+  # Most events between two state checkpoints (see state_at()).
+  CHECKPOINT_INTERVAL = 256
+
+  def _sync(self):
+    '''Brings the indexes up to date with self.events.  Appended events are
+    indexed one by one.  If events were changed anywhere else (see
+    EventStore.touch()), the indexes are cut back to there first.'''
+    changed = self.events.changed
+    if changed is not None:
+      self.events.changed = None
+      if changed < self._indexed:
+        self._truncate_indexes(changed)
+    n = len(self.events)
+    refs = self.events.refs
+    i = self._indexed
+    while i < n:
+      if refs[i] >= 0:
+        self._index_event(i)
+        i += 1
+      else:
+        j = i + 1
+        while j < n and refs[j] < 0: j += 1
+        self._index_samples(i, j)
+        i = j
+    self._indexed = n
+
+  def _index_event(self, i):
+    '''Adds event i to the indexes.  Events before it are already indexed.'''
+    if i - self._ck_idx[-1] >= Lecture.CHECKPOINT_INTERVAL:
+      self._checkpoint(i)
+    k = self.events.kinds[i]
+    self._kind_last[k] = i
+    if self.events.is_object(i):
+      e = self.events[i]
+      for cls in type(e).__mro__:
+        self._obj_last.setdefault(cls, array.array('l')).append(i)
+      if k == Start.kind or k == Clear.kind:
+        self._checkpoint(i)
+        self._slide_idx.append(i)
+        self._slide_t.append(e.utime())
+      self._run_state.update(e)
+
+  def _index_samples(self, a, b):
+    '''Adds events a..b-1, which are all pen samples kept in the columns, to
+    the indexes.  Pen samples don't change the state, so this only needs to
+    place checkpoints and update _kind_last, and can do so for the whole run
+    at once.'''
+    c = max(a, self._ck_idx[-1] + Lecture.CHECKPOINT_INTERVAL)
+    while c < b:
+      self._checkpoint(c)
+      c += Lecture.CHECKPOINT_INTERVAL
+    kinds = self.events.kinds[a:b].tostring()
+    for k in EventStore.COLUMNAR_KINDS:
+      j = kinds.rfind(chr(k))
+      if j >= 0: self._kind_last[k] = a + j
+
+  def _truncate_indexes(self, n):
+    '''Forgets everything indexed about events n and later.'''
+    cut = bisect.bisect_right(self._ck_idx, n)  # keeps the one at n, if any
+    del self._ck_idx[cut:]
+    del self._ck_state[cut:]
+    cut = bisect.bisect_left(self._slide_idx, n)
+    del self._slide_idx[cut:]
+    del self._slide_t[cut:]
+    for idx in self._obj_last.itervalues():
+      while len(idx) > 0 and idx[-1] >= n: idx.pop()
+    for k in xrange(len(self._kind_last)):
+      if self._kind_last[k] >= n: self._kind_last[k] = None
+    self._run_state = self._replay(len(self._ck_idx) - 1, n)
+    self._indexed = n
+    self._truncate_strokes(n)
+
+  def _truncate_strokes(self, n):
+    '''Forgets the strokes and slides that involve events n and later.'''
+    scan = min(self._stroke_scan, n)
+    while len(self._strokes) > 0 and self._strokes[-1].end > n:
+      scan = min(scan, self._strokes.pop().start)
+      self._stroke_starts.pop()
+    if scan < self._stroke_scan:
+      self._stroke_scan = scan
+      self._stroke_state = None
+    while len(self._slides) > 0 and (self._slides[-1].end > n
+        or len(self._slides[-1].strokes) > 0
+           and self._slides[-1].strokes[-1].end > n):
+      self._slides.pop()
+
+  def _checkpoint(self, i):
+    if self._ck_idx[-1] == i:
+      self._ck_state[-1] = self._run_state.copy()
+    else:
+      self._ck_idx.append(i)
+      self._ck_state.append(self._run_state.copy())
+
+  def _replay(self, ck, i):
+    '''Returns the state before event i, starting from checkpoint ck.'''
+    state = self._ck_state[ck].copy()
+    kinds = self.events.kinds
+    updates = Lecture.State.UPDATE.table
+    for j in xrange(self._ck_idx[ck], i):
+      if updates[kinds[j]] is not None:
+        state.update(self.events[j])
+    return state
+
+  def state_at(self, i):
+    '''Returns the state (color, thickness, window size) that iterating from
+    the start would have left off with right before returning event i.'''
+    self._sync()
+    i = max(0, min(i, len(self.events)))
+    return self._replay(bisect.bisect_right(self._ck_idx, i) - 1, i)
 
   def first(self):
     return self.events[0] if len(self.events) else None
@@ -173,36 +540,45 @@ known as a "trace"), then you can just pass that here.'''
     '''Gets the last event.  If typ is specified, gets the last event with
     type typ.  If there is no event with type = typ or the lecture is empty,
     returns None.'''
+    i = self.last_index(typ)
+    return self.events[i] if i is not None else None
+
+  def last_index(self, typ = None):
+    '''Like last(), but returns the index of the event instead of the event
+    itself.'''
     if len(self.events) <= 0: return None
     if typ is None:
-      return self.events[-1]
-    else:
-      i = -1
-      try:  # search backward for type
-        while not isinstance(self.events[i], typ): i -= 1
-      except IndexError:
-        return None
-      return self.events[i]
+      return len(self.events) - 1
+    if not isinstance(typ, type):  # e.g. a tuple of types
+      i = len(self.events) - 1
+      while i >= 0 and not isinstance(self.events[i], typ): i -= 1
+      return i if i >= 0 else None
+    self._sync()
+    objs = self._obj_last.get(typ)
+    i = objs[-1] if objs else -1
+    for k in EventStore.COLUMNAR_KINDS:
+      if issubclass(EVENT_TYPES[k], typ):
+        i = max(i, self._last_of_kind(k))
+    return i if i >= 0 else None
+
+  def _last_of_kind(self, k):
+    '''Index of the last pen sample with kind k, or -1.'''
+    if self._kind_last[k] is None:  # forgotten by _truncate_indexes()
+      kinds = self.events.kinds
+      i = self._indexed - 1
+      while i >= 0 and kinds[i] != k: i -= 1
+      self._kind_last[k] = i
+    return self._kind_last[k]
 
   def last_points(self, max_num):
     '''Returns an array of up to 'max_num' of the last point events.  If the
     last event wasn't a point event, this will return [].'''
-    events = []
-    it = reversed(self.events)
-    try:
-      e = it.next()
-      if isinstance(e, Point):
-        events.append(e)
-      else:
-        return []
-      while len(events) < max_num:
-        e = it.next()
-        if isinstance(e, Point): raise StopIteration
-        events.append(e)
-    except StopIteration:
-      pass
-    events.reverse()
-    return events
+    kinds = self.events.kinds
+    start = end = len(kinds)
+    while start > 0 and end - start < max_num \
+        and kinds[start-1] in EventStore.POINT_KINDS:
+      start -= 1
+    return self.events[start:end]
 
   def last_slide_iter(self):
     '''Returns an iterator pointing to the first element of the last slide.'''
@@ -219,51 +595,122 @@ known as a "trace"), then you can just pass that here.'''
     '''Convenience function that accumulates all the events between the last
     clear (which may be the start of the lecture) and the end of the
     lecture.'''
-    events = []
-    it = reversed(self.events)
-    try:
-      while True:
-        e = it.next()
-        if isinstance(e, Start) or isinstance(e, Clear): raise StopIteration
-        events.append(e)
-    except StopIteration:
-      pass
-    events.reverse()
-    return events
+    self._sync()
+    start = self._slide_idx[-1] + 1 if len(self._slide_idx) > 0 else 0
+    return self.events[start:]
+
+  def slide_start(self, i):
+    '''Returns the index of the Start or Clear that began the slide event i is
+    on, or 0 if there was none before it.'''
+    self._sync()
+    s = bisect.bisect_right(self._slide_idx, i) - 1
+    return self._slide_idx[s] if s >= 0 else 0
+
+  def slide_at_time(self, t):
+    '''Returns the index of the Start or Clear that began the slide that was
+    active at time t, or 0 if there was none by then.'''
+    self._sync()
+    return self.slide_start(self.events.index_of_time(t) - 1)
+
+  def slide_times(self):
+    '''Returns the times at which each slide started.'''
+    self._sync()
+    return list(self._slide_t)
 
   def events_to_time(self, t):
     '''Get all the events from the start of the slide that was active during
-    time t up to and including the event with utime() == t.'''
-    if len(self.events) <= 0: return []
-
-    # Iterator and amount to change it on fail.
-    i = len(self.events) / 2
-    di = len(self.events) / 4
-
-    # binary search to find element with utime() at point
-    while self.events[i].utime() != t and di > 0:
-      if self.events[i].utime() > t:
-        i += di
-      else:
-        i -= di
-      di /= 2    # Next time, only jump half.
-
-    if i == 0: return [self.events[i]]
-
-    events = [self.events[i]]  # what to return
-    i -= 1
-
-    # reverse linear "search" for first appearance of a clear screen-type of
-    # event
-    while isinstance(self.events[i], Clear) or isinstance(self.events[i], Start):
-      events.append(self.events[i])
-      i -= 1
-
-    # TODO Include state.
-    events.reverse()
-    it = Lecture.Iterator(events)
+    time t up to and including the last event at or before t.  The returned
+    iterator starts out with the state from right before the slide.'''
+    self._sync()
+    end = self.events.index_of_time(t)
+    start = self.slide_start(end - 1)
+    it = Lecture.Iterator(self.events[start:end])
+    it.state = self.state_at(start)
     return it
 
+  def events_between(self, t0, t1, typ=None):
+    '''Returns a view (see EventRange) of the events after t0, up to and
+    including t1, optionally only those of type typ.  Finding the range is
+    O(log n); nothing is copied.  Consecutive calls with t1 of one as t0 of
+    the next see each event once, like Iterator.next(prog).'''
+    start = self.events.index_of_time(t0)
+    end = max(start, self.events.index_of_time(t1))
+    return EventRange(self.events, start, end, typ)
+
+  def strokes(self):
+    '''Returns the strokes of the lecture, in order (see Lecture.Stroke).
+    The last one may still be open.'''
+    self._scan_strokes()
+    return list(self._strokes)
+
+  def _scan_strokes(self):
+    '''Adds the events not scanned yet to the strokes.'''
+    self._sync()
+    n = len(self.events)
+    if self._stroke_scan >= n: return
+    if self._stroke_state is None:
+      self._stroke_state = self.state_at(self._stroke_scan)
+    state = self._stroke_state
+    events = self.events
+    kinds, ts, xs, ys = events.kinds, events.ts, events.xs, events.ys
+    updates = Lecture.State.UPDATE.table
+    pen = EventStore.POINT_KINDS
+    stroke = None
+    if len(self._strokes) > 0 and not self._strokes[-1].closed:
+      stroke = self._strokes[-1]
+    for i in xrange(self._stroke_scan, n):
+      k = kinds[i]
+      if k == Click.kind:
+        stroke = Lecture.Stroke(events, i, state)
+        self._strokes.append(stroke)
+        self._stroke_starts.append(i)
+      elif stroke is None or k not in pen:
+        if updates[k] is not None: state.update(events[i])
+        continue
+      stroke._add(i, ts[i], xs[i], ys[i])
+      if k == Release.kind:
+        stroke.closed = True
+        stroke = None
+    self._stroke_scan = n
+
+  def slides(self):
+    '''Returns the slides of the lecture, in order (see Lecture.Slide).  If
+    there are strokes before the first Start or Clear, they're on a slide of
+    their own starting at 0.'''
+    self._scan_strokes()
+    n = len(self.events)
+    if n == 0: return []
+    bounds = list(self._slide_idx)
+    if len(bounds) == 0 or (len(self._stroke_starts) > 0
+                            and self._stroke_starts[0] < bounds[0]):
+      bounds.insert(0, 0)
+    if len(self._slides) > 0 and self._slides[0].start != bounds[0]:
+      self._slides = []  # the first Start or Clear came after all
+
+    live = None
+    if len(self._strokes) > 0 and not self._strokes[-1].closed:
+      live = self._strokes[-1]
+    for s in xrange(max(0, len(self._slides) - 1), len(bounds)):
+      if s == len(self._slides):
+        self._slides.append(Lecture.Slide(self.events, bounds[s],
+            self.state_at(bounds[s] + 1).win_sz))
+      self._extend_slide(self._slides[s],
+                         bounds[s+1] if s + 1 < len(bounds) else n, live)
+    if live is not None:  # may have started before the last Start or Clear
+      s = bisect.bisect_right(bounds, live.start) - 1
+      if s < len(self._slides) - 1:
+        self._extend_slide(self._slides[s], self._slides[s].end, live)
+    return list(self._slides)
+
+  def _extend_slide(self, slide, end, live):
+    lo = bisect.bisect_left(self._stroke_starts, slide.start)
+    hi = bisect.bisect_left(self._stroke_starts, end)
+    slide._extend(end, self._strokes[lo + len(slide.strokes):hi], live)
+
+  def slide_summaries(self):
+    '''Returns the summary() of each slide.'''
+    return [slide.summary() for slide in self.slides()]
+
   def num_events(self):
     return len(self.events)
 
@@ -283,7 +730,37 @@ known as a "trace"), then you can just pass that here.'''
 # -------------------------------- Events -------------------------------- #
 ############################################################################
 
+class Palette(object):
+  '''Interns pen settings, so that the many Color and Thickness events that
+use the same color or thickness share one object instead of each holding
+their own copy.  Values are told apart by type as well as value, so (1,0,0)
+and (1.,0.,0.) stay different.'''
+  def __init__(self):
+    self.colors = {}
+    self.thicknesses = {}
+
+  def color(self, color):
+    '''Returns the shared tuple for color (any 3-sequence).'''
+    color = tuple(color)
+    return self.colors.setdefault((color, tuple(map(type, color))), color)
+
+  def thickness(self, thickness):
+    '''Returns the shared object for thickness.'''
+    return self.thicknesses.setdefault((thickness, type(thickness)),
+                                       thickness)
+
+# The palette all events share.
+PALETTE = Palette()
+
+
 class Event(object):
+  # Small integer that identifies the class (see EVENT_TYPES and Dispatcher).
+  # Every subclass has its own; they're also used in files, so never reuse one.
+  kind = 0
+
+  # Events have no __dict__; every subclass lists the attributes it adds.
+  __slots__ = ('t',)
+
   class Error(Exception):
     '''Represents a missing function in a class that extends Event.'''
     pass
@@ -292,12 +769,28 @@ class Event(object):
     '''Stores the time the event was instantiated.'''
     self.t = t
 
+  def __getstate__(self):
+    '''Returns the event's attributes as a dict, for pickle.'''
+    state = {}
+    for cls in type(self).__mro__:
+      for name in cls.__dict__.get('__slots__', ()):
+        if hasattr(self, name):
+          state[name] = getattr(self, name)
+    return state
+
+  def __setstate__(self, state):
+    for name, value in state.iteritems():
+      setattr(self, name, value)
+
   def utime(self):
     '''Returns the time this data was created.''' 
     return self.t
 
 class MouseEvent(Event):
   '''An event that has an (x,y) and time.'''
+  kind = 1
+  __slots__ = ('pos',)
+
   def __init__(self, t, pos):
     Event.__init__(self, t)
     self.pos = pos
@@ -310,11 +803,17 @@ class MouseEvent(Event):
 
 class Move(MouseEvent):
   '''Undrawn point (the pen is up).'''
+  kind = 2
+  __slots__ = ()
+
   def __init__(self, t, pos):
     MouseEvent.__init__(self, t, pos)
 
 class Point(MouseEvent):
   '''Drawn point (the pen is down).'''
+  kind = 3
+  __slots__ = ('p',)
+
   def __init__(self, t, pos, p):
     MouseEvent.__init__(self, t, pos)
     self.p = p  # \in [0,1] meaning no--full pressure
@@ -324,6 +823,9 @@ class Point(MouseEvent):
 
 class Drag(MouseEvent):
   '''Dragging something across the screen.'''
+  kind = 4
+  __slots__ = ('i',)
+
   def __init__(self, t, pos, i):
     MouseEvent.__init__(self, t, pos)
     self.i = i  # "object ID" of what's being dragged
@@ -342,15 +844,24 @@ class Drag(MouseEvent):
 
 class Click(Point):
   '''The mouse was clicked.  a.k.a. "mouse-down"'''
+  kind = 5
+  __slots__ = ()
+
   def __init__(self, t, pos):
     Point.__init__(self, t, pos, 0.01)
 
 class Release(Point):
   '''The mouse was released.  a.k.a. "mouse-up"'''
+  kind = 6
+  __slots__ = ()
+
   def __init__(self, t, pos):
     Point.__init__(self, t, pos, 0.01)
 
 class MediaEvent(Event):
+  kind = 7
+  __slots__ = ('i',)
+
   def __init__(self, t, i):
     '''Creates a new MediaEvent with a pointer to the media it effected.'''
     Event.__init__(self, t)
@@ -362,6 +873,9 @@ class MediaEvent(Event):
 
 class MediaRecordEvent(MediaEvent):
   '''Recording some non-pen media event.'''
+  kind = 8
+  __slots__ = ('media',)
+
   def __init__(self, t, i, media):
     MediaEvent.__init__(self, t, i)
     self.media = media
@@ -371,6 +885,9 @@ class MediaRecordEvent(MediaEvent):
 
 class AudioRecord(MediaRecordEvent):
   '''Microphone started recording.'''
+  kind = 9
+  __slots__ = ()
+
   def __init__(self, t, i, media):
     MediaRecordEvent.__init__(self, t, i, media)
     if not isinstance(media, AudioData):
@@ -378,6 +895,9 @@ class AudioRecord(MediaRecordEvent):
 
 class VideoRecord(MediaRecordEvent):
   '''Something (A/V) stopped recording.'''
+  kind = 10
+  __slots__ = ()
+
   def __init__(self, t, i, media):
     MediaEvent.__init__(self, t, i, media)
     if not isinstance(media, VideoData):
@@ -385,15 +905,21 @@ class VideoRecord(MediaRecordEvent):
 
 class Clear(Event):
   '''Clear the screen and set a new background.'''
+  kind = 11
+  __slots__ = ('bg',)
+
   def __init__(self, t, bg):
     Event.__init__(self, t)
     self.bg = bg  # TODO something intelligent...
 
 class Color(Event):
   '''The color changed.'''
+  kind = 12
+  __slots__ = ('color',)
+
   def __init__(self, t, color):
     Event.__init__(self, t)
-    self.color = color
+    self.color = PALETTE.color(color)
 
   def r(self):
     return self.color[0]
@@ -404,14 +930,28 @@ class Color(Event):
   def b(self):
     return self.color[2]
 
+  def __setstate__(self, state):
+    Event.__setstate__(self, state)
+    self.color = PALETTE.color(self.color)
+
 class Thickness(Event):
   '''The thickness changed.'''
+  kind = 13
+  __slots__ = ('thickness',)
+
   def __init__(self, t, thickness):
     Event.__init__(self, t)
-    self.thickness = thickness
+    self.thickness = PALETTE.thickness(thickness)
+
+  def __setstate__(self, state):
+    Event.__setstate__(self, state)
+    self.thickness = PALETTE.thickness(self.thickness)
 
 class ScreenEvent(Event):
   '''Size-based event (event that affects the screen, only).'''
+  kind = 14
+  __slots__ = ('size',)
+
   def __init__(self, t, size):
     Event.__init__(self, t)
     self.size = size
@@ -427,15 +967,519 @@ class ScreenEvent(Event):
 
 class Start(ScreenEvent):
   '''The program was started.'''
-  pass
+  kind = 15
+  __slots__ = ()
 
 class End(ScreenEvent):
   '''The program was ended.'''
-  pass
+  kind = 16
+  __slots__ = ()
 
 class Resize(ScreenEvent):
   '''The screen was resized.'''
-  pass
+  kind = 17
+  __slots__ = ()
+
+# All event classes, indexed by their kind.
+EVENT_TYPES = [None] * 18
+for cls in (Event, MouseEvent, Move, Point, Drag, Click, Release, MediaEvent,
+            MediaRecordEvent, AudioRecord, VideoRecord, Clear, Color,
+            Thickness, ScreenEvent, Start, End, Resize):
+  assert EVENT_TYPES[cls.kind] is None, "kind %d used twice" % cls.kind
+  EVENT_TYPES[cls.kind] = cls
+del cls
+
+class Dispatcher(object):
+  '''Picks what to do with an event based on its kind, in one table lookup.
+
+Handlers are given per class, as a dict.  Every kind gets the handler of the
+closest class in its MRO, so Click and Release get Point's handler unless
+they have their own, no matter what order things are listed in.  Kinds
+without one get 'default'.
+
+Calling the dispatcher calls the handler with the same arguments; the event
+must be the last one.  E.g. "d(self, e)" calls "d.table[e.kind](self, e)".
+Loops that care about speed can look handlers up in 'table' directly.'''
+  def __init__(self, handlers, default=None):
+    self.table = []
+    for cls in EVENT_TYPES:
+      for base in cls.__mro__:
+        if base in handlers:
+          self.table.append(handlers[base])
+          break
+      else:
+        self.table.append(default)
+
+  def __getitem__(self, e):
+    '''Returns the handler for event e.'''
+    return self.table[e.kind]
+
+  def __call__(self, *args):
+    return self.table[args[-1].kind](*args)
+
+
+
+############################################################################
+# ---------------------------- Event storage ----------------------------- #
+############################################################################
+
+class EventStore(object):
+  '''Struct-of-arrays storage for the events of a Lecture.
+
+Pen samples (Point, Click, Release and Move) are by far the most common
+events, so instead of keeping one Python object per sample, their time,
+position and pressure are kept in typed arrays, one entry per event.  The
+event objects are only built when they're asked for.  Everything else (colors,
+clears, audio, ...) is rare and is kept as the object itself.  The 'kinds'
+column holds every event's Event.kind, so code can tell events apart without
+building them.
+
+This behaves like the list that used to be in Lecture.events: it can be
+indexed, sliced, iterated over, appended to, inserted into, and popped from.
+Note that pen samples come back as new objects on every access, so changing
+one will not change what's stored.  Use set_time() to change an event's time.
+
+Alongside the columns, 'tmax' holds the running maximum of the event times:
+tmax[i] is the latest time among events 0..i.  It never decreases, so it can
+be bisected to find where a time falls, even though the events themselves
+aren't always in order (e.g. the -1 placeholder times DCB uses while
+loading).'''
+
+  # Classes whose instances are kept in the columns.  Subclasses of these
+  # aren't: they may have more to them than the columns can hold.
+  COLUMNAR = (Point, Click, Release, Move)
+  COLUMNAR_KINDS = tuple(cls.kind for cls in COLUMNAR)
+  POINT_KINDS = (Point.kind, Click.kind, Release.kind)
+
+  def __init__(self, events=()):
+    self.kinds = array.array('B')
+    self.ts = array.array('d')
+    self.xs = array.array('d')
+    self.ys = array.array('d')
+    self.ps = array.array('d')
+    self.refs = array.array('i')  # index into self.objs, or -1 if columnar
+    self.objs = []
+    self.tmax = array.array('d')  # running maximum of times (see above)
+    self.changed = None  # lowest index changed other than by append()
+    for e in events:
+      self.append(e)
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in xrange(*i.indices(len(self.kinds)))]
+    return self._materialize(self._index(i))
+
+  def __iter__(self):
+    for i in xrange(len(self.kinds)):
+      yield self._materialize(i)
+
+  def __reversed__(self):
+    for i in reversed(xrange(len(self.kinds))):
+      yield self._materialize(i)
+
+  def _index(self, i):
+    '''Turns a possibly-negative index into a positive one.'''
+    if i < 0:
+      i += len(self.kinds)
+    if i < 0 or i >= len(self.kinds):
+      raise IndexError("event index out of range")
+    return i
+
+  def _materialize(self, i):
+    '''Builds the event object stored at (positive) index i.'''
+    if self.refs[i] >= 0:
+      return self.objs[self.refs[i]]
+    cls = EVENT_TYPES[self.kinds[i]]
+    e = cls.__new__(cls)
+    e.t = self.ts[i]
+    e.pos = (self.xs[i], self.ys[i])
+    if cls is not Move:
+      e.p = self.ps[i]
+    return e
+
+  def is_object(self, i):
+    '''True if the event at (positive) index i is stored as an object.'''
+    return self.refs[i] >= 0
+
+  def kind_at(self, i):
+    return self.kinds[self._index(i)]
+
+  def time_at(self, i):
+    '''Returns self[i].utime() without building the event.'''
+    i = self._index(i)
+    if self.refs[i] >= 0:
+      return self.objs[self.refs[i]].utime()
+    return self.ts[i]
+
+  def index_of_time(self, t):
+    '''Returns the index of the first event with a time after t, where all
+    events before it have times at or before t.  Events with equal times stay
+    together: all of them come before the returned index.'''
+    return bisect.bisect_right(self.tmax, t)
+
+  def set_time(self, i, t):
+    '''Sets the time of the event at index i.'''
+    i = self._index(i)
+    if self.refs[i] >= 0:
+      self.objs[self.refs[i]].t = t
+    self.ts[i] = t
+    self._reindex_times(i)
+    self.touch(i)
+
+  def touch(self, i):
+    '''Records that the event at index i was changed in place, or that events
+    were inserted or removed there.  Whatever indexes these events (see
+    Lecture._sync()) has to redo everything from there on.'''
+    i = max(0, i + len(self.kinds) if i < 0 else i)
+    self.changed = i if self.changed is None else min(self.changed, i)
+
+  def _reindex_times(self, i):
+    '''Recomputes self.tmax from i on, after the time at i changed.  Stops as
+    soon as an entry comes out the same as before, because everything after
+    it will too.'''
+    tmax = self.tmax[i-1] if i > 0 else float('-inf')
+    for j in xrange(i, len(self.kinds)):
+      tmax = max(tmax, self.time_at(j))
+      if self.tmax[j] == tmax: break
+      self.tmax[j] = tmax
+
+  def _row(self, e):
+    '''Returns the values e should have in each column.'''
+    cls = type(e)
+    if cls not in EventStore.COLUMNAR:
+      self.objs.append(e)
+      return e.kind, e.t, .0, .0, .0, len(self.objs) - 1
+    return (e.kind, e.t, e.pos[0], e.pos[1],
+            e.p if cls is not Move else .0, -1)
+
+  def append(self, e):
+    k, t, x, y, p, ref = self._row(e)
+    self.kinds.append(k)
+    self.ts.append(t)
+    self.xs.append(x)
+    self.ys.append(y)
+    self.ps.append(p)
+    self.refs.append(ref)
+    self.tmax.append(max(self.tmax[-1], t) if len(self.tmax) > 0 else t)
+
+  def copy(self):
+    '''Returns a copy of the store that changes to either won't affect.  The
+    columns are copied whole, which is fast even for millions of events; the
+    stored objects are shared, except ScreenEvents, which Lecture.resize()
+    changes in place.'''
+    store = EventStore()
+    for name in ('kinds', 'ts', 'xs', 'ys', 'ps', 'refs', 'tmax'):
+      setattr(store, name, getattr(self, name)[:])
+    store.objs = [copy.copy(e) if isinstance(e, ScreenEvent) else e
+                  for e in self.objs]
+    return store
+
+  def extend_samples(self, kinds, ts, xs, ys, ps):
+    '''Appends pen samples given column by column: sequences of the same
+    length holding each sample's kind (one of COLUMNAR_KINDS), time,
+    position and pressure (ignored for Moves).  Arrays of the same types as
+    the columns are copied in fastest.'''
+    n = len(kinds)
+    if len(ts) != n or len(xs) != n or len(ys) != n or len(ps) != n:
+      raise ValueError("columns differ in length")
+    ts = _as_array(self.ts.typecode, ts)
+    self.kinds.extend(_as_array(self.kinds.typecode, kinds))
+    self.ts.extend(ts)
+    self.xs.extend(_as_array(self.xs.typecode, xs))
+    self.ys.extend(_as_array(self.ys.typecode, ys))
+    self.ps.extend(_as_array(self.ps.typecode, ps))
+    self.refs.extend(array.array('i', [-1]) * n)
+    tmax = self.tmax[-1] if len(self.tmax) > 0 else float('-inf')
+    if n > 0 and ts[0] >= tmax and ts.tolist() == sorted(ts):
+      self.tmax.extend(ts)  # in order: the times are their own maximum
+    else:
+      for t in ts:
+        tmax = max(tmax, t)
+        self.tmax.append(tmax)
+
+  def insert(self, i, e):
+    # Same clamping as list.insert(), so we know where e ends up.
+    n = len(self.kinds)
+    i = max(0, i + n) if i < 0 else min(i, n)
+    k, t, x, y, p, ref = self._row(e)
+    self.kinds.insert(i, k)
+    self.ts.insert(i, t)
+    self.xs.insert(i, x)
+    self.ys.insert(i, y)
+    self.ps.insert(i, p)
+    self.refs.insert(i, ref)
+    self.tmax.insert(i, float('nan'))
+    self._reindex_times(i)
+    self.touch(i)
+
+  def merge(self, *sources):
+    '''Merges the events of each source (a sequence of events sorted by time)
+    in among the ones here, in a single pass.  An event goes after every event
+    already here with a time at or before its own (see index_of_time()), and
+    after events of earlier sources with the same time, so the order of equal
+    times is kept.'''
+    merged = heapq.merge(*[_sort_keys(k, src) for k, src in enumerate(sources)])
+    cols = (self.kinds, self.ts, self.xs, self.ys, self.ps, self.refs,
+            self.tmax)
+    new = [array.array(col.typecode) for col in cols]
+    tmax = new[-1]
+    done = 0  # rows of ours copied into new so far
+    first = None  # where the first merged event went
+    for t, _, _, e in merged:
+      i = bisect.bisect_right(self.tmax, t, done)
+      if i > done:
+        for to, col in zip(new, cols):
+          to.extend(col[done:i])
+        done = i
+      if first is None:
+        first = i
+      # Everything of ours after e has a later tmax than t, so the tmax we
+      # copy over stays right.
+      row = self._row(e) + (max(tmax[-1], t) if len(tmax) > 0 else t,)
+      for to, v in zip(new, row):
+        to.append(v)
+    if first is None:
+      return
+    for to, col in zip(new, cols):
+      to.extend(col[done:])
+    (self.kinds, self.ts, self.xs, self.ys, self.ps, self.refs,
+        self.tmax) = new
+    self.touch(first)
+
+  def pop(self, i=-1):
+    i = self._index(i)
+    e = self._materialize(i)
+    for col in (self.kinds, self.ts, self.xs, self.ys, self.ps):
+      col.pop(i)
+    ref = self.refs.pop(i)
+    if ref >= 0:
+      del self.objs[ref]
+      if ref < len(self.objs):  # shift the later objects' refs down
+        refs = self.refs
+        for j in xrange(len(refs)):
+          if refs[j] > ref:
+            refs[j] -= 1
+    self.tmax.pop(i)
+    if i < len(self.kinds):
+      self._reindex_times(i)
+    self.touch(i)
+    return e
+
+  def nbytes(self):
+    '''Approximate number of bytes used by the columns and stored objects
+    (not counting what those objects refer to).'''
+    cols = (self.kinds, self.ts, self.xs, self.ys, self.ps, self.refs,
+            self.tmax)
+    return sum(map(sys.getsizeof, cols)) + sys.getsizeof(self.objs)
+
+def _as_array(typecode, seq):
+  '''Returns seq as an array of the given type: seq itself if it is one.'''
+  if isinstance(seq, array.array) and seq.typecode == typecode:
+    return seq
+  return array.array(typecode, seq)
+
+def _sort_keys(k, events):
+  '''Yields (time, k, position, event) for each event, for EventStore.merge().
+  The first three alone always tell two of these apart.'''
+  for j, e in enumerate(events):
+    yield e.utime(), k, j, e
+
+class EventRange(object):
+  '''A view of the events store[start:end], optionally only those that are
+instances of 'typ' (a class or tuple of classes).  Nothing is copied: events
+are built as the view is iterated over, and ones of other types are skipped
+by their kind, without building them.'''
+  def __init__(self, store, start, end, typ=None):
+    self.store = store
+    self.start = start
+    self.end = end
+    self.wanted = None  # kind -> bool
+    if typ is not None:
+      self.wanted = [issubclass(cls, typ) for cls in EVENT_TYPES]
+
+  def indexes(self):
+    '''Yields the index in the store of each event in the view.'''
+    if self.wanted is None:
+      for i in xrange(self.start, self.end):
+        yield i
+    else:
+      kinds, wanted = self.store.kinds, self.wanted
+      for i in xrange(self.start, self.end):
+        if wanted[kinds[i]]: yield i
+
+  def __iter__(self):
+    materialize = self.store._materialize
+    for i in self.indexes():
+      yield materialize(i)
+
+  def __len__(self):
+    if self.wanted is None:
+      return self.end - self.start
+    return sum(1 for i in self.indexes())
+
+  def __nonzero__(self):
+    for i in self.indexes():
+      return True
+    return False
+
+  def times(self):
+    '''Yields the time of each event in the view, without building it.'''
+    ts = self.store.ts
+    for i in self.indexes():
+      yield ts[i]
+
+# Dispatch tables for Lecture, which comes before the Event classes.
+Lecture.State.UPDATE = Dispatcher({
+    Thickness: Lecture.State._update_thickness,
+    Start: Lecture.State._update_win_sz,
+    Color: Lecture.State._update_color})
+Lecture.APPEND = Dispatcher({
+    AudioRecord: Lecture._append_audio,
+    VideoRecord: Lecture._append_video,
+    Start: Lecture._append_start_end,
+    End: Lecture._append_start_end,
+    ScreenEvent: Lecture._append_screen,
+    Color: Lecture._append_color,
+    Thickness: Lecture._append_thickness}, Lecture._append_other)
+
+
+
+############################################################################
+# ----------------------------- Point codec ------------------------------ #
+############################################################################
+
+class PointCodec(object):
+  '''Packs runs of pen samples (time, x, y, pressure) into few bytes.  Each
+  column is rounded onto a grid of 'res' steps per second (time) or per unit
+  (x, y, pressure), and stored as the run's first value, its base, followed
+  by the differences between neighbours, all as zig-zag varints (7 bits a
+  byte, the sign in the lowest bit).  Consecutive samples are a few ms and a
+  few pixels apart, so most values take one or two bytes, where a sample
+  takes 21 in the columns of a DCB v0.4 file.  Values come back rounded to
+  the grid.
+
+  A run can be anything from a stroke (to keep it packed in memory) to a
+  slide (DCB v0.5+).  Whole columns are done at a time with numpy if it's
+  there ('vectorized'), else value by value.'''
+  class Error(Exception):
+    '''Raised when packed samples end early.'''
+    pass
+
+  def __init__(self, t_res=1000., xy_res=65536., p_res=1024.,
+               vectorized=None):
+    self.t_res = float(t_res)
+    self.xy_res = float(xy_res)
+    self.p_res = float(p_res)
+    self.vectorized = use_numpy if vectorized is None else vectorized
+
+  def _resolutions(self):
+    return (self.t_res, self.xy_res, self.xy_res, self.p_res)
+
+  def encode(self, ts, xs, ys, ps):
+    '''Returns the samples, given column by column, as bytes.'''
+    cols = (ts, xs, ys, ps)
+    if self.vectorized:
+      return ''.join(_encode_varints_np(col, res)
+                     for col, res in zip(cols, self._resolutions()))
+    return ''.join(_encode_varints_py(col, res)
+                   for col, res in zip(cols, self._resolutions()))
+
+  def decode(self, buf, off, n):
+    '''Reads n samples packed by encode() from buf[off:] (a string or
+    mmap).  Returns the columns (ts, xs, ys, ps), as arrays of doubles, and
+    the offset after them.'''
+    if self.vectorized:
+      return _decode_varints_np(buf, off, n, self._resolutions())
+    cols = []
+    for res in self._resolutions():
+      col, off = _decode_varints_py(buf, off, n, res)
+      cols.append(col)
+    return cols, off
+
+def _encode_varints_py(col, res):
+  out = bytearray()
+  prev = 0
+  for v in col:
+    q = int(math.floor(v * res + .5))
+    d = q - prev
+    prev = q
+    z = d << 1 if d >= 0 else (~d << 1) | 1
+    while z >= 0x80:
+      out.append((z & 0x7f) | 0x80)
+      z >>= 7
+    out.append(z)
+  return str(out)
+
+def _decode_varints_py(buf, off, n, res):
+  data = bytearray(buf[off:off + 10 * n])  # 10 bytes hold any 64-bit value
+  col = array.array('d', [0.]) * n
+  i = q = 0
+  try:
+    for j in xrange(n):
+      b = data[i]
+      i += 1
+      z = b & 0x7f
+      shift = 7
+      while b & 0x80:
+        b = data[i]
+        i += 1
+        z |= (b & 0x7f) << shift
+        shift += 7
+      q += (z >> 1) ^ -(z & 1)
+      col[j] = q / res
+  except IndexError:
+    raise PointCodec.Error("Packed samples end early.")
+  return col, off + i
+
+def _encode_varints_np(col, res):
+  if len(col) == 0:
+    return ''
+  if isinstance(col, array.array) and col.typecode == 'd':
+    col = numpy.frombuffer(col, numpy.float64)  # without copying
+  q = numpy.floor(numpy.asarray(col, numpy.float64) * res + .5)
+  q = q.astype(numpy.int64)
+  q[1:] -= q[:-1].copy()
+  z = ((q << 1) ^ (q >> 63)).view(numpy.uint64)
+  sizes = numpy.ones(len(z), numpy.int64)  # bytes each value takes
+  rest = z >> numpy.uint64(7)
+  while rest.any():
+    sizes += rest != 0
+    rest >>= numpy.uint64(7)
+  at = numpy.arange(sizes.max())
+  groups = (z[:, None] >> (7 * at).astype(numpy.uint64)) & numpy.uint64(0x7f)
+  groups = groups.astype(numpy.uint8)
+  groups[at < sizes[:, None] - 1] |= 0x80
+  return groups[at < sizes[:, None]].tostring()
+
+def _decode_varints_np(buf, off, n, resolutions):
+  k = n * len(resolutions)
+  if k == 0:
+    return [array.array('d') for res in resolutions], off
+  size = min(len(buf) - off, 10 * k)
+  b = numpy.frombuffer(buf, numpy.uint8, size, off)
+  ends = numpy.flatnonzero(b < 0x80)[:k]
+  if len(ends) < k:
+    raise PointCodec.Error("Packed samples end early.")
+  b = b[:ends[-1] + 1]
+  starts = numpy.empty(k, numpy.int64)
+  starts[0] = 0
+  starts[1:] = ends[:-1] + 1
+  # Each byte holds 7 bits of its value, from bit 7 * (its place in it) on.
+  first = numpy.zeros(len(b), numpy.int64)
+  first[starts] = starts
+  at = numpy.arange(len(b)) - numpy.maximum.accumulate(first)
+  bits = (b & 0x7f).astype(numpy.uint64) << (7 * at).astype(numpy.uint64)
+  z = numpy.add.reduceat(bits, starts)
+  d = (z >> numpy.uint64(1)).view(numpy.int64) ^ \
+      -(z & numpy.uint64(1)).view(numpy.int64)
+  q = numpy.cumsum(d.reshape(len(resolutions), n), axis=1)
+  cols = [array.array('d', (q[c] / res).tostring())
+          for c, res in enumerate(resolutions)]
+  return cols, off + int(ends[-1]) + 1
+
 
 
 
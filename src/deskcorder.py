@@ -33,6 +33,11 @@ class Main:
     self.last_pause = None
 
     self.lec = Lecture()
+    self.fname = None    # the file self.lec was last saved to or loaded from
+    self.saver = None    # the save under way (see save()),
+    self.saving = None   # the lecture it's saving a snapshot of,
+    self.next_save = None  # and the file to save to next, if asked to
+    self.journal = None  # the session journal (see load_config())
 
     self.audio = Audio(self)
     self.gui = GUI(self)
@@ -79,7 +84,7 @@ class Main:
     self.progress = val
     self.audio.set_progress(val + self.lec.first().utime())
     self.gui.canvas.ttpt = val + self.lec.first().utime()
-    self.it.seek(self.progress)
+    self.it.seek_to_time(self.progress)
 
   def reset(self):
     '''Clears the state of the canvas and audio, as if the system had just
@@ -88,6 +93,8 @@ class Main:
       self.all_buttons_off()
       self.gui.progress_slider_value(.0)
       self.gui.canvas.reset()
+      self.fname = None
+      self.start_journal()
       self.audio.reset()
       self.stop()
 
@@ -100,8 +107,20 @@ class Main:
     print 'Loading configuration from "%s"' % config.config_dir
 
     # If we're recovering from a crash, check to see if we should reload.
-    if os.path.isdir(config.lecture_dir):
-      self.gui.ask_recover()
+    # If that fails, the journal is left alone (and this session isn't
+    # journaled), so it can be offered again next time.
+    keep_journal = False
+    if fileio.Journal.exists(config.lecture_dir) and self.gui.ask_recover():
+      try:
+        lec = fileio.recover(config.lecture_dir)
+        if lec is not None:
+          self.lec = lec
+      except (fileio.FormatError, IOError) as e:
+        self.gui.recover_failed(str(e))
+        keep_journal = True
+    if not keep_journal:
+      self.journal = fileio.Journal(config.lecture_dir)
+      self.start_journal()
 
     if config.file_to_load is not None and config.file_to_load is not False:
       print 'Loading', config.file_to_load
@@ -122,6 +141,15 @@ class Main:
     except KeyboardInterrupt:
       pass
     self.gui.deinit()
+    self.wait_for_saves()
+    if self.journal is not None:
+      self.journal.close(remove=True)  # a clean exit: nothing to recover
+
+  def start_journal(self, base=None, n=None, num_adats=None):
+    '''(Re)starts the session journal on self.lec, from the file 'base' it
+    was saved to or loaded from, if any (see fileio.Journal.start()).'''
+    if self.journal is not None and isinstance(self.lec, Lecture):
+      self.journal.start(self.lec, base, n, num_adats)
 
   def is_recording(self):
     '''Determines if the mic is on and recording.'''
@@ -228,22 +256,32 @@ class Main:
     #  2. When out iterator goes past the end of the lec object and we're
     #     out of audio, return false (stop calling this function).
     for e in self.it.next(self.progress):
-      if isinstance(e, Clear):
-        self.gui.canvas.clear()
-      elif isinstance(e, Click):
-        self.last_point = e
-      elif isinstance(e, Point):
-        self.gui.canvas.draw(self.it.state.color,
-            self.it.state.thickness * e.p, self.last_point.pos, e.pos)
-        self.last_point = e
-      else:
-        print 'Not handling event of type', type(e)
+      self.PLAY(self, e)
 
     if not self.it.has_next() and a_time < 0:
       self.stop()
       return False
     return self.check_done()
 
+  # Handlers for Main.PLAY, which plays back one event.
+
+  def _play_clear(self, e):
+    self.gui.canvas.clear()
+
+  def _play_click(self, e):
+    self.last_point = e
+
+  def _play_point(self, e):
+    self.gui.canvas.draw(self.it.state.color,
+        self.it.state.thickness * e.p, self.last_point.pos, e.pos)
+    self.last_point = e
+
+  def _play_other(self, e):
+    print 'Not handling event of type', type(e)
+
+  PLAY = Dispatcher({Clear: _play_clear, Click: _play_click,
+                     Point: _play_point}, _play_other)
+
   def pause(self, checked):
     '''Pauses playback and audio recording.'''
     if self.is_empty():
@@ -348,16 +386,46 @@ class Main:
     exporter.to_swf(self.lec, self.audio.make_data(), fname)
 
   def save(self, fname = 'save.dcb'):
-    '''Cleans everything up (play back, recording, etc), and saves the current
-    lecture and audio.  If there is no set filename, uses the GUI to ask the
-    user where they would like the file saved.  (Their answer will effect the
-    format of the save.'''
-
-    # TODO check if this is dirty.
-    if self.is_recording():
-      self.record(False)
-    fileio.save(fname, self.lec)
-    self.gui.canvas.dirty = False
+    '''Saves the lecture as it is now to fname, in the background (see
+    fileio.Saver), so that recording and drawing carry on while it's
+    written.  The canvas is marked clean once it's done, unless more has
+    been added by then.  If a save is under way already, this one starts
+    when that's done.'''
+    if self.saver is not None:
+      self.next_save = fname
+      return
+    self.saving = self.lec
+    self.saver = fileio.save_in_background(fname, self.lec,
+                                           append=(fname == self.fname))
+    self.gui.timeout_add(100, self.check_save)
+
+  def check_save(self):
+    '''Checks on the save under way (see save()).  Returns whether it still
+    is, to be called again.'''
+    saver = self.saver
+    if not saver.done():
+      return True
+    self.saver = None
+    if saver.error is not None:
+      print 'Could not save %s: %s' % (saver.fname, saver.error)
+    elif self.lec is self.saving:  # not started over since
+      self.fname = saver.fname
+      if saver.round_trips():  # else recovery couldn't start from it
+        self.start_journal(saver.fname, saver.num_events, saver.num_adats)
+      if len(self.lec) == saver.num_events and \
+          len(self.lec.adats) == saver.num_adats:
+        self.gui.canvas.dirty = False
+    self.saving = None
+    if self.next_save is not None:
+      fname, self.next_save = self.next_save, None
+      self.save(fname)
+    return False
+
+  def wait_for_saves(self):
+    '''Blocks until the saves under way are done.'''
+    while self.saver is not None:
+      self.saver.join()
+      self.check_save()
 
   def load(self, fname = 'save.dcb'):
     ''''''
@@ -365,6 +433,8 @@ class Main:
     # TODO check if this is dirty.
     try:
       self.lec = fileio.load(fname)
+      self.fname = fname
+      self.start_journal(fname)
       return True
     except fileio.FormatError:
       return False
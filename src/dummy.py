@@ -91,6 +91,11 @@ class GUI:
   def dirty_ok(self):
     print 'GUI::dirty_ok() not implemented'
     return False
+  def ask_recover(self):
+    print 'GUI::ask_recover() not implemented'
+    return False
+  def recover_failed(self, msg):
+    print 'GUI::recover_failed(%s) not implemented' % msg
   def connect_new(self, fun):
     print 'GUI::connect_new(function) not implemented'
   def connect_record(self, fun):
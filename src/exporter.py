@@ -10,11 +10,11 @@ import subprocess
 def _draw_slide_on_surface(ctx, slide, scale = (400,300), ts = None):
   #ctx.set_line_cap(cairo.LINE_CAP_ROUND)
   for stroke in slide.strokes:
-    if len(stroke.points) <= 0: continue
+    if stroke.num_points <= 0: continue
     ctx.set_source_rgb(stroke.r(), stroke.g(), stroke.b())
     ctx.move_to(stroke.first().x() * scale[0], stroke.first().y() * scale[1])
     diag_scale = math.sqrt(scale[0]**2 + scale[1]**2)
-    for point in stroke.points[1:]:
+    for point in stroke.points()[1:]:
       if ts is not None and ts < point.t:
         ctx.stroke()
         return
@@ -39,10 +39,11 @@ def _draw_to_png(fname, slide, size = (400,300), ts = None):
 def to_pdf(trace, ofname, size = (400,300), times = None):
   #surface = cairo.PDFSurface("%s.pdf" % ofname, size[0], size[1])
   #ctx = cairo.Context(surface)
+  slides = trace.slides()
   if times is None:
     print 'Writing %d PDF %s' % \
-        (len(trace.slides), 'pages' if len(trace.slides) > 1 else 'page')
-    for slide in trace.slides:
+        (len(slides), 'pages' if len(slides) > 1 else 'page')
+    for slide in slides:
       _draw_slide_on_surface(ctx, slide, size)
       ctx.show_page()
   else:
@@ -51,14 +52,14 @@ def to_pdf(trace, ofname, size = (400,300), times = None):
     for ts in times:
       assigned = False
       print 'finding slide for t:%.0f' % ts
-      for i in xrange(1,len(trace.slides)):
-        if trace[i].t > ts:
-          _draw_slide_on_surface(ctx, trace[i-1], size, ts)
+      for i in xrange(1,len(slides)):
+        if slides[i].t > ts:
+          _draw_slide_on_surface(ctx, slides[i-1], size, ts)
           ctx.show_page()
           assigned = True
           break
       if not assigned:
-        _draw_slide_on_surface(ctx, trace[i], size, ts)
+        _draw_slide_on_surface(ctx, slides[i], size, ts)
         ctx.show_page()
 
 
@@ -69,22 +70,23 @@ def to_pdf(trace, ofname, size = (400,300), times = None):
 
 def to_png(trace, ofname, size = (400,300), times = None):
   print 'to_png()'
+  slides = trace.slides()
   slideidx = 0
   if times is None:
-    for slide in trace.slides:
+    for slide in slides:
       _draw_to_png("%s-%03d.png" % (ofname,slideidx), slide, size)
       slideidx += 1
   else:
     for ts in times:
       assigned = False
       print 'finding slide for t:%.0f' % ts
-      for i in xrange(1,len(trace.slides)):
-        if trace[i].t > ts:
-          _draw_to_png("%s-%03d.png" % (ofname,slideidx), trace[i-1], size, ts)
+      for i in xrange(1,len(slides)):
+        if slides[i].t > ts:
+          _draw_to_png("%s-%03d.png" % (ofname,slideidx), slides[i-1], size, ts)
           assigned = True
           break
       if not assigned:
-        _draw_to_png("%s-%03d.png" % (ofname,slideidx), trace[i], size, ts)
+        _draw_to_png("%s-%03d.png" % (ofname,slideidx), slides[i], size, ts)
       slideidx += 1
 
 
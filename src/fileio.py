@@ -1,8 +1,15 @@
 import os
 import sys
 import math
+import time
+import mmap
+import array
+import bisect
+import heapq
+import collections
 import base64
-import xml.dom.minidom
+import xml.parsers.expat
+import xml.etree.cElementTree as ElementTree
 import struct  # for binary conversions
 import zlib    # to compress audio data in v0.1.x
 try:
@@ -12,13 +19,21 @@ except ImportError:
   use_speex = False
 import wave
 import tarfile
+import zipfile
+import io
 import tempfile
-from shutil import rmtree
+import threading
+import multiprocessing
+from shutil import rmtree, copymode
 
 from datatypes import *
 
 # Valid version numbers (ones we can load)
-VALID_VERSIONS = [(0,1,0), (0,1,1), (0,1,2), (0,2,0), (0,3,0)]
+VALID_VERSIONS = [(0,1,0), (0,1,1), (0,1,2), (0,2,0), (0,3,0), (0,4,0),
+                  (0,5,0)]
+
+# DCB versions we can save.
+WRITABLE_VERSIONS = [(0,3,0), (0,4,0), (0,5,0)]
 
 # Currently-supported formats.
 FORMATS = {'dcx': "Deskcorder XML file",
@@ -28,11 +43,14 @@ FORMATS = {'dcx': "Deskcorder XML file",
            'dcb': "Deskcorder binary file"}
 
 # Current default version.
-DEFAULT_VERSION = (0,3,0)
+DEFAULT_VERSION = (0,4,0)
 
 # Magic number to appear at the beginning of every DCB file.
 MAGIC_NUMBER = '\x42\xfa\x32\xba\x22\xaa\xaa\xbb'
 
+# Magic number to end the trailer of every v0.4+ DCB file.
+INDEX_MAGIC = '\xbb\xaa\xaa\x22\xba\x32\xfa\x42'
+
 
 class FormatError(Exception):
   '''Raised when an unrecoverable formatting error takes place.'''
@@ -43,6 +61,14 @@ class VersionError(FormatError):
   def __init__(self, v):
     FormatError.__init__(self, "Unrecognized version: %d.%d.%d" % v)
 
+class MissingBaseError(FormatError):
+  '''Raised when a session journal continues from a file that can't be
+  loaded (see Journal.load()).'''
+  def __init__(self, base):
+    FormatError.__init__(self, "Can't load %s, which the journal continues "
+                         "from." % base)
+    self.base = base
+
 
 class InternalError(RuntimeError):
   '''Raised when an internal error occurs.'''
@@ -50,6 +76,102 @@ class InternalError(RuntimeError):
 
 
 
+############################################################################
+# ----------------------------- Diagnostics ------------------------------ #
+############################################################################
+
+class Diagnostics(object):
+  '''What a reader or writer did: records per type, bytes and time per
+  section and, when asked for, a trace of the records themselves.
+
+  Levels:
+    OFF      nothing at all (the default)
+    COUNTS   the counters only
+    SAMPLED  counters, and a trace line for every 'sample'th record of a type
+    FULL     counters, and a trace line for every record
+
+  Readers and writers check 'counting' and 'tracing' before doing anything
+  with this object, so while it's off nothing is counted, formatted or
+  written.  The trace goes to 'out' (a file name or a file object), or
+  else to the log file the reader or writer names in begin().  A file is
+  only created once there's a line to write.
+
+  Without an explicit Diagnostics, from_env() decides: DESKCORDER_DIAG is
+  "off", "counts", "sampled", "sampled:N" or "full", and
+  DESKCORDER_DIAG_FILE is where the trace goes.
+
+  Counters add up over every load() or save() this is passed to:
+    records  {record type: count}, e.g. 'slide', 'stroke', 'point', 'move'
+    bytes    {section: bytes read or written}, e.g. 'header', 'slides'
+    times    {section: seconds}'''
+  OFF, COUNTS, SAMPLED, FULL = range(4)
+  LEVELS = {'off': OFF, 'counts': COUNTS, 'sampled': SAMPLED, 'full': FULL}
+
+  def __init__(self, level=OFF, out=None, sample=100):
+    self.level = level
+    self.counting = level >= Diagnostics.COUNTS
+    self.tracing = level >= Diagnostics.SAMPLED
+    self.sample = sample if level == Diagnostics.SAMPLED else 1
+    self.out = out
+    self.fp = None
+    self._log_fname = None
+    self.records = {}
+    self.bytes = {}
+    self.times = {}
+    self._seen = {}
+
+  @staticmethod
+  def from_env():
+    '''Returns a Diagnostics set up from $DESKCORDER_DIAG and
+    $DESKCORDER_DIAG_FILE.'''
+    spec = os.environ.get('DESKCORDER_DIAG', 'off').strip().lower()
+    name, _, sample = spec.partition(':')
+    if name not in Diagnostics.LEVELS or not (sample or '1').isdigit():
+      sys.stderr.write("Warning: bad DESKCORDER_DIAG: %s\n" % spec)
+      return Diagnostics()
+    return Diagnostics(Diagnostics.LEVELS[name],
+                       os.environ.get('DESKCORDER_DIAG_FILE'),
+                       int(sample) if sample else 100)
+
+  def begin(self, log_fname):
+    '''Called when a load() or save() starts.  log_fname is where the trace
+    goes if no 'out' was given.  Trace files are started over every time.'''
+    self._log_fname = log_fname
+
+  def end(self):
+    '''Called when a load() or save() is done.  Closes the trace file, if
+    this opened one.'''
+    if self.fp is not None:
+      if self.fp is self.out:
+        self.fp.flush()
+      else:
+        self.fp.close()
+      self.fp = None
+
+  def count(self, record, n=1):
+    '''Counts n records of type 'record'.'''
+    self.records[record] = self.records.get(record, 0) + n
+
+  def section(self, name, start, nbytes):
+    '''Counts section 'name' as nbytes long and as having taken from 'start'
+    (a time.time()) until now.'''
+    self.times[name] = self.times.get(name, 0.) + time.time() - start
+    self.bytes[name] = self.bytes.get(name, 0) + nbytes
+
+  def trace(self, record, fmt, *args):
+    '''Writes "fmt % args" to the trace, if this record of type 'record' is
+    one of the ones traced.'''
+    seen = self._seen.get(record, 0)
+    self._seen[record] = seen + 1
+    if seen % self.sample != 0:
+      return
+    if self.fp is None:
+      out = self.out if self.out is not None else self._log_fname
+      self.fp = open(out, 'w') if isinstance(out, str) else out
+    self.fp.write(fmt % args + '\n')
+
+
+
 ############################################################################
 # -------------------- Reading and writing functions --------------------- #
 ############################################################################
@@ -86,70 +208,296 @@ def load_wav(fname):
 
 
 
+############################################################################
+# ------------------------- Audio (de)compression ------------------------ #
+############################################################################
+
+# How many worker processes compress and decompress audio blocks (None: one
+# for each core, 1: do it all here).  Less than PARALLEL_AUDIO_BYTES of audio
+# is done here anyway: starting workers would cost more than it saves.
+AUDIO_WORKERS = None
+PARALLEL_AUDIO_BYTES = 1 << 20
+
+_pool = None  # (number of workers, multiprocessing.Pool) once started
+
+def _audio_map(fun, items, nbytes):
+  '''Returns map(fun, items), worked out by a pool of AUDIO_WORKERS worker
+  processes if the items add up to 'nbytes' bytes, and that's enough.  fun
+  has to be a module-level function, for the workers to find.'''
+  global _pool
+  workers = AUDIO_WORKERS
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  if workers <= 1 or len(items) <= 1 or nbytes < PARALLEL_AUDIO_BYTES:
+    return map(fun, items)
+  if _pool is None or _pool[0] != workers:
+    if _pool is not None:
+      _pool[1].terminate()
+      _pool = None
+    try:
+      _pool = (workers, multiprocessing.Pool(workers))
+    except OSError as e:
+      sys.stderr.write("Warning: no audio workers (%s).\n" % e)
+      return map(fun, items)
+  return _pool[1].map(fun, items, 1)  # blocks are few, and big
+
+def _deflate(raw):
+  '''Returns raw audio compressed with zlib.'''
+  return zlib.compress(raw, zlib.Z_BEST_COMPRESSION)
+
+def _inflate(item):
+  '''Returns the raw audio for (key, data), where data is compressed as the
+  AudioData type key says, or None if it can't be decompressed here.'''
+  key, data = item
+  if key == AudioData.ZLB:
+    return zlib.decompress(data)
+  elif key == AudioData.SPX and use_speex:
+    return speex.new(raw = True).decode(data)
+  return None
+
+def _raw_audio(adat, size=1 << 16):
+  '''Yields the raw audio of adat in pieces (of about 'size' bytes if it
+  has to be inflated from zlib).'''
+  dats = adat.dats
+  if AudioData.RAW in dats:
+    raw = dats[AudioData.RAW]
+    for piece in (raw if isinstance(raw, list) else [raw]):
+      yield piece
+  elif AudioData.ZLB in dats:
+    z = zlib.decompressobj()
+    data = dats[AudioData.ZLB]
+    for i in xrange(0, len(data), size):
+      chunk = data[i:i + size]
+      while chunk:
+        yield z.decompress(chunk, size)
+        chunk = z.unconsumed_tail
+    yield z.flush()
+  elif AudioData.SPX in dats:
+    raw = _inflate((AudioData.SPX, dats[AudioData.SPX]))
+    if raw is not None:
+      yield raw
+
+
 ############################################################################
 # ----------------------------- Public API ------------------------------- #
 ############################################################################
 
-def load(fname, win_sz=(1,1)):
-  '''Reads in a file and returns a 2-tuple of lecture an audio.'''
+def load(fname, win_sz=(1,1), diag=None, lazy=False):
+  '''Reads in a file and returns a 2-tuple of lecture an audio.  'diag' is a
+  Diagnostics to count into (default: Diagnostics.from_env()).  With 'lazy',
+  files that can be read a slide at a time (DCB v0.4+) are opened as a
+  LazyLecture instead; others are read in whole as usual.'''
   try:
     if fname.lower().endswith(".dcx"):
       return _load_dcx(fname, win_sz)
     elif fname.lower().endswith(".dct"):
-      return DCT(fname, DEFAULT_VERSION).load()
+      return DCT(fname, DEFAULT_VERSION, diag=diag).load()
     elif fname.lower().endswith(".dcb"):
-      return DCB(fname, DEFAULT_VERSION).load()
+      dcb = DCB(fname, DEFAULT_VERSION, diag=diag)
+      if lazy and dcb.read_version()[1] >= 4:
+        return LazyLecture(fname, diag=diag)
+      return dcb.load()
     elif fname.lower().endswith(".dcd"):
-      return DCD(fname, DEFAULT_VERSION).load()
+      return DCD(fname, DEFAULT_VERSION, diag=diag).load()
     elif fname.lower().endswith(".dar"):
-      return DAR(fname, DEFAULT_VERSION).load()
+      return DAR(fname, DEFAULT_VERSION, diag=diag).load()
     else:
-      return DCB(fname, DEFAULT_VERSION).load()
+      return DCB(fname, DEFAULT_VERSION, diag=diag).load()
   except FormatError as e:
     print 'FormatError:', str(e)
     return ()
 
-def save(fname, lec=None, req_v=DEFAULT_VERSION):
-  '''Writes out a lecture and set of audio snippets to a file.'''
+def save(fname, lec=None, req_v=DEFAULT_VERSION, summaries=False, diag=None,
+         codec=None, append=False):
+  '''Writes out a lecture and set of audio snippets to a file.  With
+  'summaries', formats that can (DCB v0.4+, DCD) also store each slide's
+  summary in the header, for load_summaries().  'diag' is a Diagnostics to
+  count into (default: Diagnostics.from_env()).  'codec' is the PointCodec
+  that DCB v0.5+ files pack pen samples with, e.g. to change the grid they
+  are rounded to.  With 'append', saving lec again to the DCB v0.4+ file it
+  was last saved to (or loaded from) only adds what's new to the end of it,
+  so that it takes about as long however big lec gets; other files are
+  written whole.'''
   if lec is None: return
   if fname.lower().endswith(".dcx"):
     _save_dcx(fname, lec, req_v)
   elif fname.lower().endswith(".dct"):
-    DCT(fname, req_v).save(lec)
+    DCT(fname, req_v, summaries, diag).save(lec)
   elif fname.lower().endswith(".dcb"):
-    DCB(fname, req_v).save(lec)
+    DCB(fname, req_v, summaries, diag, codec).save(lec, append)
   elif fname.lower().endswith(".dcd"):
-    DCD(fname, req_v).save(lec)
+    DCD(fname, req_v, summaries, diag).save(lec)
   elif fname.lower().endswith(".dar"):
-    DAR(fname, req_v).save(lec)
+    DAR(fname, req_v, summaries, diag).save(lec)
   elif fname.lower().endswith(".txt"):
     save_strokes_as_csv(fname, lec)
   else:
-    DCB(fname, req_v).save(lec)
+    DCB(fname, req_v, summaries, diag, codec).save(lec, append)
+
+def round_trips(fname, req_v=DEFAULT_VERSION):
+  '''Returns whether save(fname, lec, req_v) keeps all of lec, as it is, for
+  load() to give back.  Only DCB v0.4 files do: v0.5 rounds pen samples to
+  its grid, and the other formats keep less (no moves or settings but the
+  strokes' colors in DCD, DCT and DAR, no audio in DCD, only the strokes in
+  DCX and CSV, ...).'''
+  ext = os.path.splitext(fname)[1].lower()
+  if ext in ('.dcx', '.dct', '.dcd', '.dar', '.txt'):
+    return False
+  return tuple(req_v) == (0,4,0)
+
+def load_summaries(fname):
+  '''Reads just the slide summaries (see Lecture.Slide.summary()) from the
+  header of a file, without loading any events.  Returns None if the file
+  doesn't have them.'''
+  if fname.lower().endswith(".dcd"):
+    return DCD(fname).load_summaries()
+  elif fname.lower().endswith(".dcb"):
+    return DCB(fname).load_summaries()
+  return None
+
+def save_in_background(fname, lec, **kwargs):
+  '''Starts saving lec to fname as save() would, but from a snapshot, on a
+  thread of its own.  Returns the Saver, to check on it.'''
+  saver = Saver(fname, lec, **kwargs)
+  saver.start()
+  return saver
+
+def recover(dirname, diag=None):
+  '''Returns the lecture logged in the session journal in dirname (see
+  Journal), e.g. after a crash, or None if there isn't one.  Raises
+  FormatError if it can't be read, and MissingBaseError if the file it
+  continues from can't be loaded; the journal is left as it is.'''
+  if not Journal.exists(dirname):
+    return None
+  return Journal(dirname, diag=diag).load()
+
+def iter_events(fname, t0=None, t1=None, diag=None):
+  '''Returns an iterator over the events in a file, in time order, that
+  reads the file as it goes instead of building a Lecture: however big the
+  file, only about a slide (or a block of audio) is in memory at a time.
+  AudioRecords come with their AudioData.  With t0 and/or t1, only the events
+  after t0, up to and including t1, come out (see Lecture.events_between()),
+  and the parts of the file outside that are skipped where the format
+  allows: DCB v0.4+ goes straight to the slides in range through its index.'''
+  if fname.lower().endswith(".dcx"):
+    return _iter_dcx(fname, t0, t1)
+  elif fname.lower().endswith(".dcd"):
+    return DCD(fname, diag=diag).iter_events(t0, t1)
+  elif fname.lower().endswith(".dct"):
+    return DCT(fname, diag=diag).iter_events(t0, t1)
+  elif fname.lower().endswith(".dar"):
+    return DAR(fname, diag=diag).iter_events(t0, t1)
+  else:
+    return DCB(fname, diag=diag).iter_events(t0, t1)
+
+def _time_range(t0, t1):
+  '''Returns (t0, t1), with None as no limit.'''
+  return (float('-inf') if t0 is None else t0,
+          float('inf') if t1 is None else t1)
+
+def _in_time_order(*sources):
+  '''Merges iterators of (t, i, event), each in order of (t, i), into one of
+  the events.  Ties go to the earlier source.'''
+  def tagged(s, source):
+    for t, i, e in source:
+      yield t, s, i, e
+  for t, s, i, e in heapq.merge(*[tagged(s, source)
+                                  for s, source in enumerate(sources)]):
+    yield e
 
 def save_strokes_as_csv(fname, lec):
   f = open(fname, 'w')
-  it = iter(lec)
-  stroke = []
-  state = Lecture.State()
-  while it.has_next():
-    n = it.next()
-    if isinstance(n, Click) or isinstance(n, Point):
-      stroke.append((n.x(), n.y(), n.t))
-    elif isinstance(n, Release):
-      stroke.append((n.x(), n.y(), n.t))
-      stroke.append(())
-    elif isinstance(n, ScreenEvent):
-      state = n
-
-  for p in stroke:
-    if len(p) == 3:
-      f.write("%d, %d, %d" %
-          (p[0] * state.width(), p[1] * state.height(), p[2]))
-    f.write("\n")
+  state = lec.last(ScreenEvent) or Lecture.State()
+  for stroke in lec.strokes():
+    for p in stroke.points():
+      f.write("%d, %d, %d\n" %
+          (p.x() * state.width(), p.y() * state.height(), p.t))
+    if stroke.closed:
+      f.write("\n")
   f.close()
 
 
+############################################################################
+# --------------------------- Background saving -------------------------- #
+############################################################################
+
+class Saver(threading.Thread):
+  '''Saves a snapshot of a lecture (see Lecture.snapshot()) on a thread of
+  its own, so that the lecture can keep being added to in the meantime.
+  Check done() to see if it's finished, then 'error' for the exception that
+  stopped it, if any.  The keyword arguments are save()'s.
+
+  A file is written whole to a temporary file next to it, which is then
+  renamed over it: a crash leaves either the old file or the new one.  A
+  DCB file that can be appended to (see DCB._append_chunks()) is instead
+  appended to in place, which is as safe.  DCD directories are written in
+  place.'''
+  def __init__(self, fname, lec, **kwargs):
+    threading.Thread.__init__(self, name='Saver')
+    self.daemon = True
+    self.fname = fname
+    self.lec = lec.snapshot()
+    self.num_events = len(self.lec)     # how much of lec the snapshot has
+    self.num_adats = len(self.lec.adats)
+    self.kwargs = kwargs
+    self.error = None
+
+  def done(self):
+    return not self.is_alive()
+
+  def round_trips(self):
+    '''Returns whether the file keeps the snapshot as it is (see
+    fileio.round_trips()).'''
+    return round_trips(self.fname, self.kwargs.get('req_v', DEFAULT_VERSION))
+
+  def run(self):
+    try:
+      self._save()
+    except Exception as e:
+      self.error = e
+
+  def _save(self):
+    fname = self.fname
+    ext = os.path.splitext(fname)[1]
+    if ext.lower() == '.dcd' or os.path.isdir(fname):
+      save(fname, self.lec, **self.kwargs)
+      return
+    if self.kwargs.get('append') and os.path.isfile(fname):
+      dcb = DCB(fname, self.kwargs.get('req_v', DEFAULT_VERSION))
+      if dcb.v[1] >= 4 and dcb._saved_part(self.lec) is not None:
+        save(fname, self.lec, **self.kwargs)
+        return
+    fd, tmp = tempfile.mkstemp(suffix=ext or '.dcb', prefix='.save-',
+                               dir=os.path.dirname(os.path.abspath(fname)))
+    os.close(fd)
+    try:
+      save(tmp, self.lec, **self.kwargs)
+      f = open(tmp, 'rb')
+      try:
+        os.fsync(f.fileno())
+      finally:
+        f.close()
+      Saver._set_mode(tmp, fname)
+      if os.name == 'nt' and os.path.exists(fname):
+        os.remove(fname)  # rename doesn't replace files there
+      os.rename(tmp, fname)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  @staticmethod
+  def _set_mode(tmp, fname):
+    '''Gives tmp, which is about to replace fname, the mode of fname, or
+    if there's no fname yet, the mode a new file gets (mkstemp() makes it
+    readable by its owner only).'''
+    if os.path.exists(fname):
+      copymode(fname, tmp)
+    else:
+      umask = os.umask(0)  # the only way to read it
+      os.umask(umask)
+      os.chmod(tmp, 0666 & ~umask)
+
+
 ################################################################################
 # ------------------------------------ DCB ----------------------------------- #
 ################################################################################
@@ -157,12 +505,18 @@ def save_strokes_as_csv(fname, lec):
 class DCB(object):
   '''Does Deskcorder Binary loading and saving.  Even after this format
   becomes deprecated, its functions are still used in its subclasses.'''
-  def __init__(self, fname, version=DEFAULT_VERSION):
-    '''Creates an empty DCB reader/writer.'''
+  def __init__(self, fname, version=DEFAULT_VERSION, summaries=False,
+               diag=None, codec=None):
+    '''Creates an empty DCB reader/writer.  With 'summaries', v0.4+ files get
+    the slide summaries too.  It counts and traces into 'diag' (see
+    Diagnostics), or into one set up from the environment.  v0.5+ files are
+    saved with pen samples packed by 'codec' (default: a PointCodec()).'''
     self.fname = fname
     self.v = version
     self.fp = None
-    self.log = None
+    self.summaries = summaries
+    self.diag = diag if diag is not None else Diagnostics.from_env()
+    self.codec = codec if codec is not None else PointCodec()
     self.lec = None
     self.state = Lecture.State()
 
@@ -171,20 +525,6 @@ class DCB(object):
     '''Writes to file f using struct.pack(fmt, *args).'''
     f.write(struct.pack(fmt, *args))
 
-  @staticmethod
-  def bin_read(f, fmt):
-    '''Reads file f using struct to get datatypes shown in fmt.'''
-    try:
-      l = struct.calcsize(fmt)
-      s = f.read(l)
-      return struct.unpack(fmt, s)
-    except struct.error as e:
-      print 'got', s
-      print 'which is', len(s), 'when', l, 'was requested'
-      print 'reading again yields "%s"' % hex(ord(f.read(1)))
-      sys.stdout.flush()
-      raise e
-
   def _make_lec(self, lec):
     # Build old lecture object.
     self.lec = {}
@@ -192,223 +532,415 @@ class DCB(object):
     self.lec['moves'] = []
     self.lec['adats'] = []
 
-    it = iter(lec)
-    while it.has_next():
-      e = next(it)
-      if isinstance(e, Start) or isinstance(e, Clear):
-        slide = {}
-        slide['t'] = e.t
-        slide['aspect_ratio'] = e.width() / e.height()
-        slide['strokes'] = []
-        self.lec['slides'].append(slide)
-      elif isinstance(e, Click):
+    for s in lec.slides():
+      slide = {}
+      slide['t'] = s.t
+      slide['aspect_ratio'] = s.aspect_ratio()
+      slide['strokes'] = []
+      for st in s.strokes:
         stroke = {}
-        stroke['thickness'] = 0.5
-        stroke['aspect_ratio'] = self.lec['slides'][-1]['aspect_ratio']
-        stroke['color'] = self.state.color
-        stroke['points'] = [e]
-        self.lec['slides'][-1]['strokes'].append(stroke)
-      elif isinstance(e, Point):
-        self.lec['slides'][-1]['strokes'][-1]['points'].append(e)
-      elif isinstance(e, Move):
-        pass # TODO handle move
-      elif isinstance(e, Color):
-        self.state.color = e.color
-      elif isinstance(e, AudioRecord):
-        pass # TODO handle audio
-      elif isinstance(e, VideoRecord):
-        pass # TODO handle video
-
-  def save(self, lec = None):
-    '''(Deprecated) Writes a lecture and audio data to a file.'''
+        stroke['thickness'] = st.thickness
+        stroke['aspect_ratio'] = slide['aspect_ratio']
+        stroke['color'] = st.color
+        stroke['points'] = st.points()
+        slide['strokes'].append(stroke)
+      self.lec['slides'].append(slide)
+    # TODO handle moves, audio and video
+
+  def save(self, lec = None, append=False):
+    '''Writes a lecture and audio data to a file.  With 'append', if the
+    file is a v0.4+ one that lec was saved to before, only what lec got
+    since is written (see _append_chunks()).'''
     if lec is None:
       return
-    if self.v != DEFAULT_VERSION:
+    if self.v not in WRITABLE_VERSIONS:
       raise VersionError(self.v)
 
-    self.fp = open(self.fname, 'wb')
-    self.log = open(self.fname + ".save_log", 'w')
-    
-    # Convert passed lecture to old lecture format.
-    self._make_lec(lec)
-
-    # --- header ---
-    self.fp.write(MAGIC_NUMBER)
-    DCB.bin_write(self.fp, "<III", *self.v)
-    self.log.write("File version: (%d,%d,%d)\n" % self.v)
-    if self.v[1] >= 2:
-      DCB.bin_write(self.fp, "<f", self.lec['slides'][0]['aspect_ratio'])
-      self.log.write('File has %d slides, ar = %.2f\n' \
-          % (len(self.lec['slides']), self.lec['slides'][0]['aspect_ratio']))
-    else:
-      self.log.write('File will have %d slides\n' % len(self.lec['slides']))
-
-    # --- slides ---
-    DCB.bin_write(self.fp, "<I", len(self.lec['slides']))
-    for slide in self.lec['slides']:  # Slide block
-      self._save_slide(slide)
-
-    # --- moves ---
-    DCB.bin_write(self.fp, "<I", len(self.lec['moves']))  # number of moves sans mouse click
-    self.log.write('%d positions\n' % len(self.lec['moves']))
-    self.log.flush()
-    for m in self.lec['moves']:
-      self._save_move(m)
-
-    # --- audio ---
-    DCB.bin_write(self.fp, "<I", len(self.lec['adats'])) # number of audio files
-    for af in self.lec['adats']:
-      self._save_audio(af)
-
-    self.fp.close()
-    self.fp = None
-    self.log.close()
-    self.log = None
+    saved = self._saved_part(lec) if append and self.v[1] >= 4 else None
+    self.fp = open(self.fname, 'r+b' if saved is not None else 'wb')
+    diag = self.diag
+    diag.begin(self.fname + ".save_log")
+    try:
+      if saved is not None:
+        self._append_chunks(lec, *saved)
+        return
+      if self.v[1] >= 4:
+        self._save_chunks(lec)
+        return
+
+      # Convert passed lecture to old lecture format.
+      self._make_lec(lec)
+
+      # --- header ---
+      mark = self._mark()
+      self.fp.write(MAGIC_NUMBER)
+      DCB.bin_write(self.fp, "<III", *self.v)
+      if diag.tracing:
+        diag.trace('header', "File version: (%d,%d,%d)", *self.v)
+      if self.v[1] >= 2:
+        DCB.bin_write(self.fp, "<f", self.lec['slides'][0]['aspect_ratio'])
+        if diag.tracing:
+          diag.trace('header', 'File has %d slides, ar = %.2f',
+              len(self.lec['slides']), self.lec['slides'][0]['aspect_ratio'])
+      elif diag.tracing:
+        diag.trace('header', 'File will have %d slides', len(self.lec['slides']))
+      mark = self._section('header', mark)
+
+      # --- slides ---
+      DCB.bin_write(self.fp, "<I", len(self.lec['slides']))
+      for slide in self.lec['slides']:  # Slide block
+        self._save_slide(slide)
+      mark = self._section('slides', mark)
+
+      # --- moves ---
+      DCB.bin_write(self.fp, "<I", len(self.lec['moves']))  # number of moves sans mouse click
+      if diag.tracing:
+        diag.trace('header', '%d positions', len(self.lec['moves']))
+      for m in self.lec['moves']:
+        self._save_move(m)
+      mark = self._section('moves', mark)
+
+      # --- audio ---
+      DCB.bin_write(self.fp, "<I", len(self.lec['adats'])) # number of audio files
+      for af in self.lec['adats']:
+        self._save_audio(af)
+      self._section('audio', mark)
+    finally:
+      self.fp.close()
+      self.fp = None
+      diag.end()
+
+  def _mark(self, off=None):
+    '''Returns where a section starts (the time, and off or else the write
+    position) for _section(), or None if nothing is being counted.'''
+    if self.diag.counting:
+      return time.time(), self.fp.tell() if off is None else off
+    return None
+
+  def _section(self, name, mark, off=None):
+    '''Counts the section from mark (see _mark()) up to off, or else the
+    write position.  Returns the mark for the next section.'''
+    if mark is None:
+      return None
+    end = self._mark(off)
+    self.diag.section(name, mark[0], end[1] - mark[1])
+    return end
+
+  # Record layouts, compiled once.  Pen samples are "point" records (time in
+  # ms, x, y, pressure), except for v0.3+ clicks and releases, which have no
+  # pressure and use the "move" layout.
+  U32 = struct.Struct("<I")
+  F32 = struct.Struct("<f")
+  VERSION = struct.Struct("<III")
+  SLIDE = struct.Struct("<QI")
+  STROKE_V2 = struct.Struct("<ff")
+  COLOR = struct.Struct("<fff")
+  POINT = struct.Struct("<Qfff")
+  MOVE = struct.Struct("<Qff")
+  AUDIO = struct.Struct("<QQ")
 
   def load(self):
     '''Loads DCB-v0.x.x'''
     self.fp = open(self.fname, 'rb')
-    self.log = open(self.fname + '.load_log', 'w')
-    if self.fp.read(8) != MAGIC_NUMBER:
+    try:
+      buf = self.fp.read()
+    finally:
+      self.fp.close()
+      self.fp = None
+    self.diag.begin(self.fname + '.load_log')
+    try:
+      self._decode(buf)
+    except struct.error as e:
+      raise FormatError("File ends early: %s" % e)
+    finally:
+      self.diag.end()
+    try:
+      return self.lec
+    finally:
+      self.lec = None
+
+  def _decode(self, buf):
+    '''Builds self.lec from the contents of a whole DCB file.  Records are
+    unpacked straight out of buf, with pen samples a stroke at a time.'''
+    diag = self.diag
+    mark = self._mark(0)
+    if buf[:8] != MAGIC_NUMBER:
       raise FormatError("Magic number does not match.")
-    self.log.write('Magic number!\n')
+    if diag.tracing: diag.trace('header', 'Magic number!')
 
-    self.v = DCB.bin_read(self.fp, "<III")  # file version
-    self.log.write('version %d.%d.%d\n' % self.v)
+    self.v = DCB.VERSION.unpack_from(buf, 8)  # file version
+    off = 8 + DCB.VERSION.size
+    if diag.tracing: diag.trace('header', 'version %d.%d.%d', *self.v)
     if self.v not in VALID_VERSIONS:
       raise VersionError(self.v)
 
     print 'File is DCB v%d.%d.%d' % self.v
+    if self.v[1] >= 4:
+      self._section('header', mark, off)
+      return self._decode_chunks(buf)
 
-    if self.v[0] == 0:
-      self.lec = Lecture()
-      self.log.write("We're at self.fp.tell():%d\n" % self.fp.tell())
-      if self.v[1] == 2:
-        aspect_ratio = DCB.bin_read(self.fp, "<f")[0]
-        self.log.write('aspect ratio: %.2f\n' % aspect_ratio)
-        self.log.flush()
-        self.lec.aspect_ratio = aspect_ratio
-      num_slides = DCB.bin_read(self.fp, "<I")[0]  # number of slides
-      self.log.write('%d slides\n' % num_slides)
-      self.log.flush()
-      for slide_i in xrange(num_slides):
-        self.log.write("  Slide %d\n" % slide_i)
-        self._load_slide()
-
-      # number of points
-      self.log.write("We're at self.fp.tell():%d\n" % self.fp.tell())
-      num_moves = DCB.bin_read(self.fp, "<I")[0]
-      self.log.write('%d positions\n' % num_moves)
-      self.log.flush()
-      for pos_i in xrange(num_moves):
-        self.log.write('  move %d\n' % pos_i)
-        self.log.flush()
-        self._load_move()  # out of order!
-        for i in reversed(xrange(len(self.lec))):  # TODO optimize
-          if self.lec[-1].utime() < self.lec[i].utime():
-            break
-        self.lec.events.insert(i, self.lec.events.pop())
-
-      self.lec.adats = []
-      if self.v != (0,1,0):
-        # number of audio files
-        self.log.write("We're at self.fp.tell():%d\n" % self.fp.tell())
-        num_afs = DCB.bin_read(self.fp, "<I")[0]
-        self.log.write('%d audio files\n' % num_afs)
-        self.log.flush()
-        for af_i in xrange(num_afs):
-          self.log.write("  Audio %d\n" % af_i)
-          self._load_audio()
+    self.lec = Lecture()
+    if self.v[1] >= 2:
+      aspect_ratio = DCB.F32.unpack_from(buf, off)[0]
+      off += DCB.F32.size
+      if diag.tracing: diag.trace('header', 'aspect ratio: %.2f', aspect_ratio)
+      self.lec.aspect_ratio(aspect_ratio)
+    mark = self._section('header', mark, off)
+    num_slides = DCB.U32.unpack_from(buf, off)[0]  # number of slides
+    off += DCB.U32.size
+    if diag.tracing: diag.trace('header', '%d slides', num_slides)
+    for slide_i in xrange(num_slides):
+      # tstamp of "clear" (ms), number of strokes in the slide
+      t, num_strokes = DCB.SLIDE.unpack_from(buf, off)
+      off += DCB.SLIDE.size
+      if diag.counting: diag.count('slide')
+      if diag.tracing:
+        diag.trace('slide', '  slide: %d strokes at %dms', num_strokes, t)
+      self.lec.append(Clear(t / 1000., (800,600)))
+      for stroke_i in xrange(num_strokes):
+        off = self._decode_stroke(buf, off)
+    mark = self._section('slides', mark, off)
+
+    # moves: tstamp (ms), x, y.  They're stored after all the strokes, so
+    # they're merged in with them at the end.
+    num_moves = DCB.U32.unpack_from(buf, off)[0]
+    off += DCB.U32.size
+    if diag.counting: diag.count('move', num_moves)
+    if diag.tracing: diag.trace('header', '%d positions', num_moves)
+    moves = []
+    for pos_i in xrange(num_moves):
+      ts, x, y = DCB.MOVE.unpack_from(buf, off)
+      off += DCB.MOVE.size
+      if diag.tracing:
+        diag.trace('move', '  pos: (%.3f,%.3f) @ %dms', x, y, ts)
+      moves.append(Move(ts / 1000.0, (x, y)))
+    mark = self._section('moves', mark, off)
+
+    # audio: same as the moves.
+    self.lec.adats = []
+    audio = []
+    if self.v != (0,1,0):
+      num_afs = DCB.U32.unpack_from(buf, off)[0]  # number of audio files
+      off += DCB.U32.size
+      if diag.tracing: diag.trace('header', '%d audio files', num_afs)
+      for af_i in xrange(num_afs):
+        off = self._decode_audio(buf, off, audio)
+      DCB._inflate_audio(self.lec.adats)
+    self._section('audio', mark, off)
+
+    moves.sort(key=lambda e: e.utime())  # fast when they're in order already
+    audio.sort(key=lambda e: e.utime())
+    self.lec.merge(moves, audio)
+    return off
+
+  def iter_events(self, t0=None, t1=None):
+    '''Yields the events in the file in time order, reading it as it goes
+    (see fileio.iter_events()).'''
+    t0, t1 = _time_range(t0, t1)
+    if self.read_version()[1] >= 4:
+      lazy = LazyLecture(self.fname, 1, self.diag)
+      try:
+        for e in lazy.iter_between(t0, t1):
+          yield e
+      finally:
+        lazy.close()
+      return
 
-    self.fp.close()
-    self.fp = None
-    self.log.close()
-    self.log = None
+    # The moves and audio are stored after all the slides, so each section
+    # is read on its own, and the three are merged.
+    self.fp = open(self.fname, 'rb')
+    buf = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
     try:
-      return self.lec
+      off = DCB.HEADER_SIZE + (DCB.F32.size if self.v[1] >= 2 else 0)
+      num_slides = DCB.U32.unpack_from(buf, off)[0]
+      slides = off = off + DCB.U32.size
+      for slide_i in xrange(num_slides):
+        num_strokes = DCB.SLIDE.unpack_from(buf, off)[1]
+        off += DCB.SLIDE.size
+        for stroke_i in xrange(num_strokes):
+          off += self._stroke_size(buf, off)[0]
+      num_moves = DCB.U32.unpack_from(buf, off)[0]
+      moves = off + DCB.U32.size
+      off = moves + DCB.MOVE.size * num_moves
+      num_afs = 0
+      if self.v != (0,1,0):
+        num_afs = DCB.U32.unpack_from(buf, off)[0]
+        off += DCB.U32.size
+      for e in _in_time_order(
+          self._iter_slides(buf, slides, num_slides, t0, t1),
+          self._iter_moves(buf, moves, num_moves, t0, t1),
+          self._iter_audio(buf, off, num_afs, t0, t1)):
+        yield e
+    except struct.error as e:
+      raise FormatError("File ends early: %s" % e)
     finally:
       self.lec = None
+      buf.close()
+      self.fp.close()
+      self.fp = None
+
+  def _stroke_size(self, buf, off):
+    '''Returns the size of the stroke at buf[off:], and the times of its
+    click and release (s, or None if it's empty), without decoding it.'''
+    num_points = DCB.U32.unpack_from(buf, off)[0]
+    if num_points <= 0:
+      return DCB.U32.size, None, None
+    start = off
+    off += DCB.U32.size + DCB.COLOR.size
+    if self.v == (0,2,0):
+      off += DCB.STROKE_V2.size
+    end = DCB.POINT if self.v[1] < 3 else DCB.MOVE
+    click = end.unpack_from(buf, off)[0] / 1000.
+    off += end.size + DCB.POINT.size * max(0, num_points - 2)
+    release = end.unpack_from(buf, off)[0] / 1000.
+    return off + end.size - start, click, release
+
+  def _iter_slides(self, buf, off, num_slides, t0, t1):
+    '''Yields (t, i, event) for the events in the num_slides slides at
+    buf[off:] that are after t0, up to and including t1, in order.  Each
+    slide is decoded on its own, and strokes outside the range are skipped
+    over.'''
+    i = 0
+    for slide_i in xrange(num_slides):
+      t, num_strokes = DCB.SLIDE.unpack_from(buf, off)
+      off += DCB.SLIDE.size
+      if t / 1000. > t1:
+        return
+      self.lec = Lecture()
+      self.lec.append(Clear(t / 1000., (800,600)))
+      for stroke_i in xrange(num_strokes):
+        size, click, release = self._stroke_size(buf, off)
+        if click is not None and release > t0 and click <= t1:
+          self._decode_stroke(buf, off)
+        off += size
+      for e in self.lec.events_between(t0, t1):
+        yield e.utime(), i, e
+        i += 1
+      self.lec = None
+
+  def _iter_moves(self, buf, off, num_moves, t0, t1):
+    '''Like _iter_slides(), for the num_moves moves at buf[off:].'''
+    ts = array.array('d', (DCB.MOVE.unpack_from(buf, off + i * DCB.MOVE.size)[0]
+                           / 1000. for i in xrange(num_moves)))
+    order = xrange(num_moves)
+    if any(ts[i] > ts[i+1] for i in xrange(num_moves - 1)):
+      order = sorted(order, key=ts.__getitem__)
+    for i in order:
+      if t0 < ts[i] <= t1:
+        x, y = DCB.MOVE.unpack_from(buf, off + i * DCB.MOVE.size)[1:]
+        yield ts[i], i, Move(ts[i], (x, y))
+
+  def _iter_audio(self, buf, off, num_afs, t0, t1):
+    '''Like _iter_slides(), for the num_afs audio entries at buf[off:].  Each
+    one is read when its turn comes.'''
+    entries = []
+    for i in xrange(num_afs):
+      t, sz = DCB.AUDIO.unpack_from(buf, off)
+      entries.append((t / 1000., i, off))
+      off += DCB.AUDIO.size + sz
+    entries.sort()
+    for t, i, off in entries:
+      if t0 < t <= t1:
+        adat = self._read_audio(buf, off)[0]
+        DCB._inflate_audio([adat])
+        yield t, i, AudioRecord(t, i, adat)
 
   def _save_slide(self, slide):
     '''Writes a slide to file in DCB format.'''
     DCB.bin_write(self.fp, "<QI", int(slide['t'] * 1000), len(slide['strokes'])) # tstamp & number of strokes
-    self.log.write('  slide: %d strokes at %.0fms\n' % (len(slide['strokes']), slide['t']))
-    self.log.flush()
+    if self.diag.counting: self.diag.count('slide')
+    if self.diag.tracing:
+      self.diag.trace('slide', '  slide: %d strokes at %.0fms',
+          len(slide['strokes']), slide['t'] * 1000)
     for stroke in slide['strokes']:  # Stroke block
       self._save_stroke(stroke)
 
-  def _load_slide(self):
-    # tstamp of "clear" (ms), number of strokes in first slide
-    self.log.write("  We're at self.fp.tell():%d\n" % self.fp.tell())
-    t, num_strokes = DCB.bin_read(self.fp, "<QI")
-    self.log.write('    %d strokes at %.1fs\n' \
-        % (num_strokes, t / 1000.))
-    self.log.flush()
-    self.lec.append(Clear(t / 1000., (800,600)))
-    for stroke_i in xrange(num_strokes):
-      self.log.write("  stroke %d\n" % stroke_i)
-      self.log.flush()
-      self._load_stroke()
-
   def _save_stroke(self, stroke):
     '''Writes a stroke to file in DCB format.'''
+    diag = self.diag
     DCB.bin_write(self.fp, "<I", len(stroke['points'])) # number of points in stroke
-    self.log.write('  stroke has %d points\n' % len(stroke['points']))
-    self.log.flush()
+    if diag.counting:
+      diag.count('stroke')
+      diag.count('point', len(stroke['points']))
+    if diag.tracing:
+      diag.trace('stroke', '  stroke has %d points', len(stroke['points']))
     if len(stroke['points']) > 0:  # remainder of Stroke block
       # Stroke color
       if self.v == (0,2,0):
         DCB.bin_write(self.fp, "<ff", stroke['aspect_ratio'], stroke['thickness'])
-        self.log.write("  stroke has ar = %.2f, th = %.2f\n" \
-            % (stroke['aspect_ratio'], stroke['thickness']))
+        if diag.tracing:
+          diag.trace('stroke', "  stroke has ar = %.2f, th = %.2f",
+              stroke['aspect_ratio'], stroke['thickness'])
       DCB.bin_write(self.fp, "<fff", *stroke['color'])
-      self.log.write('  stroke color: (%.3f,%.3f,%.3f)\n' % stroke['color'])
-      self.log.flush()
-      for point in stroke['points']:
+      if diag.tracing:
+        diag.trace('stroke', '  stroke color: (%.3f,%.3f,%.3f)', *stroke['color'])
+      self._save_click(stroke['points'][0])
+      for point in stroke['points'][1:-1]:
         self._save_point(point)
+      self._save_release(stroke['points'][-1])
 
-  def _load_stroke(self):
+  def _decode_stroke(self, buf, off):
+    '''Appends the stroke at buf[off:] to self.lec.  Returns the offset after
+    it.'''
     # number of points in this stroke, color (r,g,b)
-    self.log.write("    We're at self.fp.tell():%d\n" % self.fp.tell())
-    num_points = DCB.bin_read(self.fp, "<I")[0]
-    if num_points > 0:
-      if self.v == (0,2,0):
-        aspect_ratio, thickness = DCB.bin_read(self.fp, "<ff")
-        self.log.write('        as_ra: %.2f\n' % aspect_ratio)
-        self.log.write('    thickness: %.2f\n' % thickness)
-        self.log.flush()
-      else:
-        aspect_ratio = 4./3
-        self.s_thickness = 0
-      color = DCB.bin_read(self.fp, "<fff")
-      self.log.write('    %d points with (%.1f,%.1f,%.1f)\n' \
-          % ((num_points,) + color))
-      self.log.flush()
-      if self.v[1] == 2:
-        self.lec.append(Color(-1, color))
-        self.lec.resize((aspect_ratio * 600, 800 / aspect_ratio))  # guess it's 800x600
-        self.lec.append(Thickness(-1, thickness))
+    num_points = DCB.U32.unpack_from(buf, off)[0]
+    off += DCB.U32.size
+    if num_points <= 0:
+      return off
+    v = self.v
+    if v == (0,2,0):
+      aspect_ratio, thickness = DCB.STROKE_V2.unpack_from(buf, off)
+      off += DCB.STROKE_V2.size
+    color = DCB.COLOR.unpack_from(buf, off)
+    off += DCB.COLOR.size
+
+    # The click, then the points between it and the release.
+    end = DCB.POINT if v[1] < 3 else DCB.MOVE
+    click = end.unpack_from(buf, off)
+    off += end.size
+    num_mid = max(0, num_points - 2)
+    mid = struct.unpack_from("<" + "Qfff" * num_mid, buf, off)
+    off += DCB.POINT.size * num_mid
+    release = end.unpack_from(buf, off)
+    off += end.size
+
+    diag = self.diag
+    if diag.counting:
+      diag.count('stroke')
+      diag.count('point', num_points)
+    if diag.tracing:
+      diag.trace('stroke', '  stroke: %d points, color (%.3f,%.3f,%.3f)',
+          num_points, *color)
+      for i in xrange(0, 4 * num_mid, 4):
+        diag.trace('point', '    point (%.3f,%.3f) @ %dms with %.2f%%',
+            mid[i+1], mid[i+2], mid[i], mid[i+3] * 100)
+
+    # The stroke's settings, at the time of its click.
+    t = click[0] / 1000.0
+    self.lec.append(Color(t, color))
+    if v[1] == 2:
+      self.lec.resize((aspect_ratio * 600, 800 / aspect_ratio), t)  # guess it's 800x600
+      self.lec.append(Thickness(t, thickness))
+
+    ps = mid[3::4]
+    if v[1] < 2:
+      # Previous versions have thickness where pressure should be.  "Fake" the
+      # correct way of doing thickness/pressure for the stroke/points.
+      if num_mid > 0:
+        self.lec.state.thickness = sum(ps) / float(num_mid)
+      if v == (0,1,0):
+        num_mid = 0  # FIXME these have always been dropped
+        ps = ()
       else:
-        self.lec.append(Color(-1, color))
-      if num_points >= 0:
-        self.log.write("      click\n")
-        self._load_click()
-        t = self.lec.last(Click).utime()
-        if self.v[1] <= 2:   # "correcting"
-          self.lec.last(Color).t = t
-          if self.v[1] == 2:
-            self.lec.last(Resize).t = t
-            self.lec.last(Thickness).t = t
-        self.lec.last(Color)
-        self.num_points = 0
-        for point_i in xrange(1, num_points-1):
-          self.log.write("      point %d\n" % point_i)
-          self._load_point()
-        self._load_release()
-      if self.v[1] < 2:  # finish pre-v0.2 conversion.
-        self.lec.state.thickness = self.s_thickness / float(self.num_points)
-    else:
-      self.log.write('    Empty stroke!\n')
+        ps = (math.sqrt(2) if v == (0,1,2) else 1.,) * num_mid
+    self.lec.append_samples(
+        (Click.kind,) + (Point.kind,) * num_mid + (Release.kind,),
+        [click[0] / 1000.0] + [ts / 1000.0 for ts in mid[0:4*num_mid:4]]
+            + [release[0] / 1000.0],
+        (click[1],) + mid[1:4*num_mid:4] + (release[1],),
+        (click[2],) + mid[2:4*num_mid:4] + (release[2],),
+        (.01,) + ps + (.01,))
+    return off
 
   def _save_point(self, point):
     '''Writes a point to file in DCB format.'''
@@ -417,26 +949,10 @@ class DCB(object):
     else:
       p = point.p
     DCB.bin_write(self.fp, "<Qfff", point.t * 1000, point.x(), point.y(), p)
-    self.log.write('    point (%.3f,%.3f) @ %.1f with %.2f%%\n' \
-        % (point.x(), point.y(), point.t, p * 100))
-    self.log.flush()
-
-  def _load_point(self):
-    # timestamp (ms), x, y, "thickness"
-    ts, x, y, th_pr = DCB.bin_read(self.fp, "<Qfff")
-    self.log.write('        (%.3f,%.3f) @ %.1fs with %.1f%%\n' \
-        % (x, y, ts / 1000., th_pr * 100))
-    self.log.flush()
-    if self.v[1] < 2:
-      # if this is a previous version, "fake" the correct way of doing
-      # thickness/pressure for the stroke/points.
-      self.s_thickness += th_pr
-      self.num_points += 1
-      th_pr = 1.
-    if self.v == (0,1,1) or self.v[1] == 2:
-      self.lec.append(Point(ts / 1000.0, (x, y), th_pr))
-    elif self.v == (0,1,2):
-      self.lec.append(Point(ts / 1000.0, (x, y), th_pr * math.sqrt(2)))
+    if self.diag.tracing:
+      self.diag.trace('point', '    point (%.3f,%.3f) @ %.1f with %.2f%%',
+          point.x(), point.y(), point.t, p * 100)
+
 
 
 
@@ -444,50 +960,32 @@ class DCB(object):
   # ------------------------ Lecture object handling ------------------------- #
   ##############################################################################
 
-  def _save_click(self, click, num_points):
-    DCB.bin_write(self.fp, "<IfffffQfff", num_points,
-      self.state.aspect_ratio(), self.state.thickness,
-      self.state.color.r(), self.state.color.g(), self.state.color.b(),
-      click.t * 1000, click.x(), click.y(), 0.01)
-    self.log.write("click (%.3f,%.3f) @ %.1f\n" % (click.pos + (click.t,)))
-    self.log.flush()
-
-  def _load_click(self):
+  def _save_click(self, click):
     if self.v[1] < 3:
-      ts, x, y, th_pr = DCB.bin_read(self.fp, "<Qfff")
+      self._save_point(click)
     else:
-      ts, x, y = DCB.bin_read(self.fp, "<Qff")
-    self.lec.append(Click(ts / 1000.0, (x, y)))
+      DCB.bin_write(self.fp, "<Qff", click.t * 1000, click.x(), click.y())
+      if self.diag.tracing:
+        self.diag.trace('point', "    click (%.3f,%.3f) @ %.1f",
+            *(click.pos + (click.t,)))
 
   def _save_release(self, rel):
-    DCB.bin_write(self.fp, "<Qfff", rel.utime() * 1000, rel.x(), rel.y())
-    self.log.write("    release (%.3f,%.3f) @ %.1f\n" \
-        % (rel.pos + rel.utime()))
-    self.log.flush()
-
-  def _load_release(self):
     if self.v[1] < 3:
-      ts, x, y, th_pr = DCB.bin_read(self.fp, "<Qfff")
+      self._save_point(rel)
     else:
-      ts, x, y = DCB.bin_read(self.fp, "<Qff")
-    self.lec.append(Release(ts / 1000.0, (x, y)))
-    self.log.write("      release (%.3f,%.3f) @ %.1f\n" % (x, y, ts / 1000.0))
-    self.log.flush()
+      DCB.bin_write(self.fp, "<Qff", rel.utime() * 1000, rel.x(), rel.y())
+      if self.diag.tracing:
+        self.diag.trace('point', "    release (%.3f,%.3f) @ %.1f",
+            *(rel.pos + (rel.utime(),)))
 
   def _save_move(self, move):
     '''Writes a move to file in DCB format.'''
     # point tstamp (ms), x, y
     DCB.bin_write(self.fp, "<Qff", move.t * 1000, move.x(), move.y())
-    self.log.write('  pos: (%.3f,%.3f) @ %fms\n' % (move.x(), move.y(), move.t))
-    self.log.flush()
-
-  def _load_move(self):
-    # tstamp (ms), x, y
-    self.log.write(  "We're at self.fp.tell():%d\n" % self.fp.tell())
-    ts, x, y = DCB.bin_read(self.fp, "<Qff")
-    self.log.write('    (%.3f,%.3f) @ %.1fs\n' % (x, y, ts / 1000.))
-    self.log.flush()
-    self.lec.append(Move(ts / 1000.0, (x, y)))
+    if self.diag.counting: self.diag.count('move')
+    if self.diag.tracing:
+      self.diag.trace('move', '  pos: (%.3f,%.3f) @ %.0fms',
+          move.x(), move.y(), move.t * 1000)
 
   def _save_audio(self, audio):
     '''Writes audio data to file in DCB format.'''
@@ -510,58 +1008,1341 @@ class DCB(object):
 
     # tstamp (ms), bytes of data in audio file
     DCB.bin_write(self.fp, "<QQ", int(audio[0] * 1000), len(c_data))
-    self.log.write('  audio @ %.2fs with %d bytes\n' % (audio[0], len(c_data)))
-    self.log.flush()
+    if self.diag.counting: self.diag.count('audio')
+    if self.diag.tracing:
+      self.diag.trace('audio', '  audio @ %.2fs with %d bytes',
+          audio[0], len(c_data))
     self.fp.write(c_data) # (compressed) audio data
 
-  def _load_audio(self):
-    '''Appends the audio entry at 'self.fp' to 'self.adats'.'''
+  def _decode_audio(self, buf, off, audio):
+    '''Adds the data of the audio entry at buf[off:] to self.lec.adats, and
+    its AudioRecord to the list 'audio'.  Returns the offset after it.  The
+    data is left compressed, for _inflate_audio().'''
+    adat, off = self._read_audio(buf, off)
+    audio.append(AudioRecord(adat.utime(), len(self.lec.adats), adat))
+    self.lec.adats.append(adat)
+    return off
+
+  def _read_audio(self, buf, off):
+    '''Returns the AudioData of the audio entry at buf[off:], with the data
+    as stored (see _inflate_audio()), and the offset after it.'''
     # tstamp (ms), bytes of (compressed) audio data
-    self.log.write(  "We're at self.fp.tell():%d\n" % self.fp.tell())
-    t, sz = DCB.bin_read(self.fp, "<QQ")
-    self.log.write('    %d bytes at %.1fs\n' % (sz, t / 1000.))
-    self.log.flush()
+    t, sz = DCB.AUDIO.unpack_from(buf, off)
+    off += DCB.AUDIO.size
+    if self.diag.counting: self.diag.count('audio')
+    if self.diag.tracing:
+      self.diag.trace('audio', '    %d bytes at %.1fs', sz, t / 1000.)
     # data
     adat = AudioData(t / 1000.0)
-    cdat = self.fp.read(sz)
+    cdat = buf[off:off+sz]
+    if len(cdat) < sz:
+      raise FormatError("Audio data ends early.")
     if self.v[1] == 1:
-      adat.add_type(AudioData.ZLB, cdat)
-      raw_dat = zlib.decompress(cdat)
+      adat.add_type(AudioData.ZLB, cdat)  # see _inflate_audio()
     elif self.v[1] == 2:
-      if use_speex:
-        adat.add_type(AudioData.SPX, cdat)
-        s = speex.new(raw = True)
-        raw_dat = s.decode(cdat)
-      else:
-        sys.stdout.flush()
-        sys.stderr.write("Warning: Speex not imported!")
-        traceback.print_stack()
-        sys.stderr.flush()
+      adat.add_type(AudioData.SPX, cdat)
     else:
-      raw_dat = cdat
-    adat.add_type(AudioData.RAW, raw_dat)
-    ar = AudioRecord(t / 1000.0, len(self.lec.adats), adat)
-    self.lec.adats.append(adat)
-    for i in reversed(xrange(len(self.lec))):  # TODO optimize
-      if self.lec[-1].utime() < self.lec[i].utime():
+      adat.add_type(AudioData.RAW, cdat)
+    return adat, off + sz
+
+  ############################################################################
+  # ------------------------ Chunked files (v0.4+) ------------------------- #
+  ############################################################################
+
+  # From v0.4 on, the magic number and version are followed by chunks, each
+  # a tag and the length of the rest of it:
+  #   HEAD  the aspect ratio (F64), and from v0.5 on the grid pen samples
+  #         are rounded to (GRID: see PointCodec)
+  #   STAT  the state (color, thickness, window size) that the SLID chunk
+  #         after it starts out in (STATE), so that it can be read on its own
+  #   SLID  the events from one slide's Start or Clear up to the next one's
+  #         (see _encode_events()).  A slide saved a part at a time (see
+  #         _append_chunks()) has a SLID for each part; the ones after the
+  #         first don't start with a Start or Clear.
+  #   AUDI  a block of audio: its time and AudioData type (AUDIO_V4), then
+  #         the data
+  #   SUMM  slide summaries, one line each (see _format_summary()), if saved
+  #         with them
+  #   INDX  the number of chunks, then an INDEX_ENTRY for each other chunk
+  # and then a trailer holding the INDX chunk's offset.  Readers go through
+  # the index to reach any chunk without reading what comes before it, and
+  # skip tags they don't know.  v0.5 differs from v0.4 only in HEAD and in
+  # how SLID chunks store pen samples.
+  CHUNK = struct.Struct("<4sQ")           # tag, length of the rest
+  INDEX_ENTRY = struct.Struct("<4sQQdd")  # tag, offset, length, t0, t1
+  TRAILER = struct.Struct("<Q8s")         # offset of INDX, INDEX_MAGIC
+  F64 = struct.Struct("<d")
+  AUDIO_V4 = struct.Struct("<dB")
+  STATE = struct.Struct("<dddddd")        # r, g, b, thickness, width, height
+  GRID = struct.Struct("<ddd")            # steps per s, per unit of x and y,
+                                          # per unit of pressure
+  HEADER_SIZE = len(MAGIC_NUMBER) + VERSION.size
+
+  def _save_chunks(self, lec):
+    '''Writes lec to self.fp as a v0.4+ file.'''
+    index = []
+    mark = self._mark()
+    self.fp.write(MAGIC_NUMBER)
+    self.fp.write(DCB.VERSION.pack(*self.v))
+    head = DCB.F64.pack(lec.aspect_ratio())
+    if self.v[1] >= 5:
+      codec = self.codec
+      head += DCB.GRID.pack(codec.t_res, codec.xy_res, codec.p_res)
+    self._write_chunk(index, 'HEAD', head)
+    self._section('header', mark)
+    self._save_rest(lec, index, 0, 0)
+
+  def _save_rest(self, lec, index, n, num_adats):
+    '''Writes lec's events from n on, and its audio from block num_adats on,
+    to self.fp as chunks of a v0.4+ file, then the summaries and the index:
+    the chunks in the list 'index' and the new ones.'''
+    diag = self.diag
+    events = lec.events
+    mark = self._mark()
+    for a, b in DCB._slide_runs(lec):
+      if b <= n:
+        continue
+      a = max(a, n)  # the rest of a slide that was saved in part
+      t0, t1 = events.time_at(a), events.tmax[b-1]
+      self._write_chunk(index, 'STAT', DCB._encode_state(lec.state_at(a)),
+                        t0, t1)
+      self._write_chunk(index, 'SLID', self._encode_events(events, a, b),
+                        t0, t1)
+      if diag.counting:
+        diag.count('slide')
+        diag.count('event', b - a)
+    mark = self._section('slides', mark)
+
+    adats = lec.adats[num_adats:]
+    for adat, payload in zip(adats, DCB._encode_audio(adats)):
+      self._write_chunk(index, 'AUDI', payload, adat.utime(), adat.utime())
+      if diag.counting: diag.count('audio')
+    mark = self._section('audio', mark)
+
+    if self.summaries:
+      self._write_chunk(index, 'SUMM', ''.join(
+          DCB._format_summary(s) for s in lec.slide_summaries()))
+    index_off = self.fp.tell()
+    self._write_chunk(None, 'INDX', DCB.U32.pack(len(index)) +
+        ''.join(DCB.INDEX_ENTRY.pack(*entry) for entry in index))
+    self.fp.write(DCB.TRAILER.pack(index_off, INDEX_MAGIC))
+    self._section('index', mark)
+
+  def _saved_part(self, lec):
+    '''Returns (index, number of events, number of audio blocks) for the
+    part of lec in this v0.4+ file, if that's all the file holds: the file
+    is of self.v, and has the start of lec's events and audio as they are
+    now.  Returns None if it doesn't, or there's no such file.  Only the
+    header, the index and the first bytes of each chunk are read, and events
+    are assumed not to have been changed since they were saved.'''
+    if not os.path.isfile(self.fname):
+      return None
+    v = self.v
+    try:
+      buf = self._open_indexed()
+    except FormatError:
+      self.v = v
+      return None
+    try:
+      if self.v != v:
+        return None
+      index = [entry for entry in self._read_index(buf)
+               if entry[0] not in ('SUMM', 'INDX')]
+      n = num_adats = 0
+      last = None  # time of the last event saved
+      for tag, off, length, t0, t1 in index:
+        start = self._chunk_payload(buf, tag, off, length)
+        if tag == 'HEAD':
+          if self._decode_head(buf, start) != lec.aspect_ratio():
+            return None
+        elif tag == 'SLID':
+          n += DCB.U32.unpack_from(buf, start)[0]
+          last = t1
+        elif tag == 'AUDI':
+          num_adats += 1
+      # The index has the exact times, but from v0.5 on, those loaded from
+      # the file are rounded to the codec's grid.
+      tol = .5 / self.codec.t_res if self.v[1] >= 5 else 0.
+      if n > len(lec.events) or num_adats > len(lec.adats) or \
+          n > 0 and last == last and abs(last - lec.events.tmax[n-1]) > tol:
+        return None
+      return index, n, num_adats
+    except (FormatError, struct.error):
+      return None
+    finally:
+      buf.close()
+      self.fp.close()
+      self.fp = None
+      self.v = v
+
+  def _append_chunks(self, lec, index, n, num_adats):
+    '''Adds what lec got since it was saved to self.fp (see _saved_part()):
+    the old summaries, index and trailer are cut off, and the new chunks
+    written in their place, then new summaries, index and trailer.  Until
+    that's done, the file has no trailer, and readers still find all the
+    chunks written whole (see _read_index()).'''
+    self.fp.seek(self._payload_end(index))
+    self.fp.truncate()
+    self._save_rest(lec, index, n, num_adats)
+    self.fp.flush()
+    os.fsync(self.fp.fileno())
+
+  def _write_chunk(self, index, tag, payload, t0=0., t1=0.):
+    '''Writes a chunk to self.fp, and adds its entry to the list 'index'
+    (unless that's None).'''
+    off = self.fp.tell()
+    if index is not None:
+      index.append((tag, off, len(payload), t0, t1))
+    if self.diag.tracing:
+      self.diag.trace('chunk', '%s: %d bytes at %d', tag, len(payload), off)
+    self.fp.write(DCB.CHUNK.pack(tag, len(payload)))
+    self.fp.write(payload)
+
+  @staticmethod
+  def _slide_runs(lec):
+    '''Yields (start, end) for the runs of lec's events that make up its
+    slides, in order.  Events before the first slide are a run of their
+    own.'''
+    bounds = [slide.start for slide in lec.slides()] + [len(lec.events)]
+    if bounds[0] > 0:
+      bounds.insert(0, 0)
+    for a, b in zip(bounds, bounds[1:]):
+      if a < b:
+        yield a, b
+
+  @staticmethod
+  def _encode_state(state):
+    return DCB.STATE.pack(*(tuple(state.color) + (state.thickness,) +
+                            tuple(state.win_sz)))
+
+  @staticmethod
+  def _decode_state(buf, off):
+    '''Returns the Lecture.State in the STAT chunk payload at buf[off:].'''
+    v = DCB.STATE.unpack_from(buf, off)
+    state = Lecture.State()
+    state.color = v[0:3]
+    state.thickness = v[3]
+    state.win_sz = tuple(int(x) if x == int(x) else x for x in v[4:6])
+    return state
+
+  def _decode_head(self, buf, off):
+    '''Reads the HEAD chunk payload at buf[off:]: returns the aspect ratio,
+    and sets self.codec to the file's grid (v0.5+).'''
+    if self.v[1] >= 5:
+      self.codec = PointCodec(*DCB.GRID.unpack_from(buf, off + DCB.F64.size))
+    return DCB.F64.unpack_from(buf, off)[0]
+
+  # The columns of a SLID chunk, after the number of events: kinds, times,
+  # then x, y and pressure of pen samples (0 for other events), as arrays of
+  # these types.  From v0.5 on, only the kinds are stored like that; the
+  # times, x, y and pressures are packed by self.codec (see PointCodec).  The
+  # other events follow, encoded one after another (see ENCODE_EVENT).
+  COLUMNS = 'Bdfff'
+
+  def _encode_events(self, events, a, b):
+    '''Returns the events store[a:b] as the payload of a SLID chunk.'''
+    cols = (events.kinds, events.ts, events.xs, events.ys, events.ps)
+    data = [DCB.U32.pack(b - a)]
+    if self.v[1] >= 5:
+      data.append(events.kinds[a:b].tostring())
+      data.append(self.codec.encode(*[col[a:b] for col in cols[1:]]))
+      cols = ()
+    for typecode, col in zip(DCB.COLUMNS, cols):
+      data.append(_to_le(array.array(typecode, col[a:b])))
+    for i in _object_rows(events.kinds, a, b):
+      data.append(DCB.ENCODE_EVENT(self, events[i]))
+    return ''.join(data)
+
+  def _decode_events(self, buf, off, end):
+    '''Appends the events in the SLID chunk payload buf[off:end] to
+    self.lec.'''
+    n = DCB.U32.unpack_from(buf, off)[0]
+    off += DCB.U32.size
+    cols = []
+    for typecode in DCB.COLUMNS[:1] if self.v[1] >= 5 else DCB.COLUMNS:
+      col = array.array(typecode)
+      size = col.itemsize * n
+      if off + size > end:
+        raise FormatError("Slide ends early.")
+      col.fromstring(buf[off:off+size])
+      cols.append(_from_le(col))
+      off += size
+    if self.v[1] >= 5:
+      try:
+        samples, off = self.codec.decode(buf, off, n)
+      except PointCodec.Error:
+        raise FormatError("Slide ends early.")
+      if off > end:
+        raise FormatError("Slide ends early.")
+      cols.extend(samples)
+    kinds, ts = cols[:2]
+    xs, ys, ps = [array.array('d', col) for col in cols[2:]]  # as the store has
+
+    # Runs of pen samples go in column by column, other events one by one.
+    done = 0
+    for i in _object_rows(kinds, 0, n) + [n]:
+      if done < i:
+        self.lec.append_samples(kinds[done:i], ts[done:i], xs[done:i],
+                                ys[done:i], ps[done:i])
+      if i < n:
+        if kinds[i] >= len(EVENT_TYPES):
+          raise FormatError("Unknown event kind: %d" % kinds[i])
+        cls = EVENT_TYPES[kinds[i]]
+        e, off = DCB.DECODE_EVENT.table[cls.kind](self, cls, ts[i], buf, off)
+        if e is None:
+          pass
+        elif isinstance(e, Resize):
+          self.lec.resize(e.size, e.t)
+        else:
+          self.lec.append(e)
+      done = i + 1
+    if off != end:
+      raise FormatError("Slide has %d bytes too many." % (end - off))
+
+  # Handlers for DCB.ENCODE_EVENT and DCB.DECODE_EVENT.  Encoders return the
+  # bytes for event e (its time is in the columns).  Decoders build an event
+  # of class cls and time t from buf[off:], and return it (or None to drop
+  # it) with the offset after it.
+
+  XY = struct.Struct("<dd")
+  DRAG = struct.Struct("<ddi")
+  I32 = struct.Struct("<i")
+  RGB = struct.Struct("<ddd")
+
+  def _encode_plain(self, e):
+    return ''
+
+  def _decode_plain(self, cls, t, buf, off):
+    return cls(t), off
+
+  def _encode_mouse(self, e):
+    return DCB.XY.pack(*e.pos)
+
+  def _decode_mouse(self, cls, t, buf, off):
+    return cls(t, DCB.XY.unpack_from(buf, off)), off + DCB.XY.size
+
+  def _encode_drag(self, e):
+    return DCB.DRAG.pack(e.pos[0], e.pos[1], e.i)
+
+  def _decode_drag(self, cls, t, buf, off):
+    x, y, i = DCB.DRAG.unpack_from(buf, off)
+    return cls(t, (x, y), i), off + DCB.DRAG.size
+
+  def _encode_media(self, e):
+    return DCB.I32.pack(e.i)
+
+  def _decode_media(self, cls, t, buf, off):
+    return cls(t, DCB.I32.unpack_from(buf, off)[0]), off + DCB.I32.size
+
+  def _decode_audio_record(self, cls, t, buf, off):
+    i = DCB.I32.unpack_from(buf, off)[0]
+    if not 0 <= i < len(self._audio):
+      sys.stderr.write("Warning: audio block %d is missing.\n" % i)
+      return None, off + DCB.I32.size
+    self._audio_used.add(i)
+    return cls(t, i, self._audio[i]), off + DCB.I32.size
+
+  def _encode_video(self, e):
+    raise FormatError("Video can't be saved yet.")
+
+  def _encode_clear(self, e):
+    bg = tuple(e.bg) if e.bg is not None else ()
+    return DCB.U32.pack(len(bg)) + struct.pack("<%dd" % len(bg), *bg)
+
+  def _decode_clear(self, cls, t, buf, off):
+    n = DCB.U32.unpack_from(buf, off)[0]
+    off += DCB.U32.size
+    bg = struct.unpack_from("<%dd" % n, buf, off)
+    return cls(t, bg if n > 0 else None), off + DCB.F64.size * n
+
+  def _encode_color(self, e):
+    return DCB.RGB.pack(*e.color)
+
+  def _decode_color(self, cls, t, buf, off):
+    return cls(t, DCB.RGB.unpack_from(buf, off)), off + DCB.RGB.size
+
+  def _encode_thickness(self, e):
+    return DCB.F64.pack(e.thickness)
+
+  def _decode_thickness(self, cls, t, buf, off):
+    return cls(t, DCB.F64.unpack_from(buf, off)[0]), off + DCB.F64.size
+
+  def _encode_screen(self, e):
+    return DCB.XY.pack(*e.size)
+
+  def _decode_screen(self, cls, t, buf, off):
+    size = tuple(int(v) if v == int(v) else v
+                 for v in DCB.XY.unpack_from(buf, off))
+    return cls(t, size), off + DCB.XY.size
+
+  @staticmethod
+  def _encode_audio(adats):
+    '''Returns the payloads of the AUDI chunks for adats: compressed as they
+    have been already, else compressed with zlib (in parallel: see
+    _audio_map()).'''
+    payloads = [None] * len(adats)
+    todo = []  # (i, raw data) of those to compress
+    for i, adat in enumerate(adats):
+      for key in (AudioData.SPX, AudioData.ZLB):
+        if key in adat.dats:
+          payloads[i] = DCB.AUDIO_V4.pack(adat.utime(), key) + adat.dats[key]
+          break
+      else:
+        raw = adat.dats.get(AudioData.RAW, '')
+        if isinstance(raw, list):
+          raw = ''.join(raw)
+        todo.append((i, raw))
+    compressed = _audio_map(_deflate, [raw for i, raw in todo],
+                            sum(len(raw) for i, raw in todo))
+    for (i, raw), data in zip(todo, compressed):
+      payloads[i] = DCB.AUDIO_V4.pack(adats[i].utime(), AudioData.ZLB) + data
+    return payloads
+
+  @staticmethod
+  def _read_audio_chunk(buf, off, end):
+    '''Returns the AudioData in the AUDI chunk payload buf[off:end], with
+    only the data as stored (see _inflate_audio()).'''
+    t, key = DCB.AUDIO_V4.unpack_from(buf, off)
+    adat = AudioData(t)
+    adat.add_type(key, buf[off+DCB.AUDIO_V4.size:end])
+    return adat
+
+  @staticmethod
+  def _decode_audio_chunk(buf, off, end):
+    '''Returns the AudioData in the AUDI chunk payload buf[off:end].'''
+    adat = DCB._read_audio_chunk(buf, off, end)
+    DCB._inflate_audio([adat])
+    return adat
+
+  @staticmethod
+  def _inflate_audio(adats):
+    '''Adds the raw data to each of adats that only has it compressed with
+    zlib or Speex (in parallel: see _audio_map()).'''
+    todo = []  # (AudioData, key of its compressed data)
+    for adat in adats:
+      if AudioData.RAW not in adat.dats:
+        for key in (AudioData.ZLB, AudioData.SPX):
+          if key in adat.dats:
+            todo.append((adat, key))
+            break
+    if not use_speex and any(key == AudioData.SPX for adat, key in todo):
+      sys.stdout.flush()
+      sys.stderr.write("Warning: Speex not imported!\n")
+      sys.stderr.flush()
+    raws = _audio_map(_inflate, [(key, adat.dats[key]) for adat, key in todo],
+                      sum(len(adat.dats[key]) for adat, key in todo))
+    for (adat, key), raw in zip(todo, raws):
+      if raw is not None:
+        adat.add_type(AudioData.RAW, raw)
+
+  def _decode_chunks(self, buf):
+    '''Builds self.lec from the contents of a whole v0.4+ file.'''
+    diag = self.diag
+    mark = self._mark(0)
+    index = self._read_index(buf)
+    self._section('index', mark, len(buf) - self._payload_end(index))
+
+    self.lec = Lecture()
+    self._audio = []
+    self._audio_used = set()
+    mark = self._mark(0)
+    nbytes = 0
+    for tag, off, length, t0, t1 in index:  # Audio first: events refer to it.
+      if tag == 'AUDI':
+        start = self._chunk_payload(buf, tag, off, length)
+        self._audio.append(DCB._read_audio_chunk(buf, start, start + length))
+        nbytes += DCB.CHUNK.size + length
+        if diag.counting: diag.count('audio')
+    DCB._inflate_audio(self._audio)
+    self._section('audio', mark, nbytes)
+
+    mark = self._mark(0)
+    nbytes = 0
+    for tag, off, length, t0, t1 in index:
+      if tag not in ('HEAD', 'SLID'):
+        continue
+      start = self._chunk_payload(buf, tag, off, length)
+      if diag.tracing:
+        diag.trace('chunk', '%s: %d bytes at %d', tag, length, off)
+      if tag == 'HEAD':
+        self.lec.aspect_ratio(self._decode_head(buf, start))
+        if diag.counting:
+          diag.section('header', time.time(), DCB.CHUNK.size + length)
+        continue
+      n = len(self.lec)
+      self._decode_events(buf, start, start + length)
+      nbytes += DCB.CHUNK.size + length
+      if diag.counting:
+        diag.count('slide')
+        diag.count('event', len(self.lec) - n)
+    self._section('slides', mark, nbytes)
+
+    # Keep audio that no event refers to, too.
+    self.lec.adats.extend(adat for i, adat in enumerate(self._audio)
+                          if i not in self._audio_used)
+    self._audio = self._audio_used = None
+    return len(buf)
+
+  def _payload_end(self, index):
+    '''Returns where the last chunk in index ends.'''
+    if len(index) == 0:
+      return DCB.HEADER_SIZE
+    tag, off, length, t0, t1 = max(index, key=lambda entry: entry[1])
+    return off + DCB.CHUNK.size + length
+
+  def _chunk_payload(self, buf, tag, off, length):
+    '''Checks that the index entry (tag, off, length) matches the chunk in
+    buf, and returns where the chunk's payload starts.'''
+    if DCB.CHUNK.unpack_from(buf, off) != (tag, length) or \
+        off + DCB.CHUNK.size + length > len(buf):
+      raise FormatError("Index doesn't match the %s chunk at %d." % (tag, off))
+    return off + DCB.CHUNK.size
+
+  def _read_index(self, buf):
+    '''Returns the chunk index of the v0.4+ file in buf, as a list of (tag,
+    offset, length, t0, t1), by going from the trailer at the end of buf
+    straight to the index.  Only those parts of buf are read, so buf can be
+    an mmap.  If the trailer is missing (e.g. the file was cut short), the
+    index is rebuilt by walking the chunks that are complete.'''
+    end = len(buf) - DCB.TRAILER.size
+    if end >= DCB.HEADER_SIZE + DCB.CHUNK.size:
+      index_off, magic = DCB.TRAILER.unpack_from(buf, end)
+      if magic == INDEX_MAGIC and DCB.HEADER_SIZE <= index_off < end:
+        tag, length = DCB.CHUNK.unpack_from(buf, index_off)
+        off = index_off + DCB.CHUNK.size
+        if tag == 'INDX' and off + length == end:
+          n = DCB.U32.unpack_from(buf, off)[0]
+          off += DCB.U32.size
+          if DCB.U32.size + n * DCB.INDEX_ENTRY.size == length:
+            size = DCB.INDEX_ENTRY.size
+            return [DCB.INDEX_ENTRY.unpack_from(buf, off + i * size)
+                    for i in xrange(n)]
+    sys.stderr.write("Warning: %s has no index, reading what's there.\n"
+                     % self.fname)
+    index = []
+    off = DCB.HEADER_SIZE
+    while off + DCB.CHUNK.size <= len(buf):
+      tag, length = DCB.CHUNK.unpack_from(buf, off)
+      if off + DCB.CHUNK.size + length > len(buf):
         break
-    self.lec.events.insert(i, ar)
+      if tag != 'INDX':
+        index.append((tag, off, length, float('nan'), float('nan')))
+      off += DCB.CHUNK.size + length
+    return index
+
+  def _read_header(self):
+    '''Reads and checks the magic number and version at the start of
+    self.fp, and returns the version.'''
+    header = self.fp.read(DCB.HEADER_SIZE)
+    if header[:len(MAGIC_NUMBER)] != MAGIC_NUMBER:
+      raise FormatError("Magic number does not match.")
+    self.v = DCB.VERSION.unpack_from(header, len(MAGIC_NUMBER))
+    if self.v not in VALID_VERSIONS:
+      raise VersionError(self.v)
+    return self.v
+
+  def read_version(self):
+    '''Returns the version of the file, reading only its header.'''
+    self.fp = open(self.fname, 'rb')
+    try:
+      return self._read_header()
+    finally:
+      self.fp.close()
+      self.fp = None
+
+  def _open_indexed(self):
+    '''Opens self.fp on this (v0.4+) file, and returns an mmap of it.'''
+    self.fp = open(self.fname, 'rb')
+    try:
+      if self._read_header()[1] < 4:
+        raise FormatError("DCB v%d.%d.%d files have no index." % self.v)
+      return mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except:
+      self.fp.close()
+      self.fp = None
+      raise
+
+  def index(self):
+    '''Returns the chunk index of this (v0.4+) file: (tag, offset, length,
+    t0, t1) for each chunk, where t0 and t1 are the times of its first and
+    last event.  Only the header, trailer and index are read.'''
+    buf = self._open_indexed()
+    try:
+      return self._read_index(buf)
+    finally:
+      buf.close()
+      self.fp.close()
+      self.fp = None
+
+  def load_summaries(self):
+    '''Reads the slide summaries of a v0.4+ file, going straight to them
+    through the index.  Returns None if there are none.'''
+    try:
+      index = self.index()
+    except FormatError:
+      return None
+    for tag, off, length, t0, t1 in index:
+      if tag == 'SUMM':
+        self.fp = open(self.fname, 'rb')
+        try:
+          self.fp.seek(off + DCB.CHUNK.size)
+          lines = self.fp.read(length).splitlines()
+        finally:
+          self.fp.close()
+          self.fp = None
+        return [DCB._read_summary(line) for line in lines if line.strip()]
+    return None
+
+  # Slide summaries (DCD metadata and SUMM chunks) are one line per slide:
+  #   slide <t> <t_end> <w>,<h> <strokes> <points> <length> <bbox> <colors>
+  # where bbox is "xmin,ymin,xmax,ymax" and colors is "r,g,b;r,g,b;...", or
+  # "-" for none.  Older DCD readers stop at the aspect ratio.
+
+  @staticmethod
+  def _format_summary(s):
+    fmt_list = lambda l: ','.join(repr(float(x)) for x in l)
+    return "slide %r %r %s %d %d %r %s %s\n" % \
+        (float(s['t']), float(s['t_end']), fmt_list(s['size']),
+         s['strokes'], s['points'], s['length'],
+         fmt_list(s['bbox']) if s['bbox'] is not None else '-',
+         ';'.join(fmt_list(c) for c in s['colors']) or '-')
+
+  @staticmethod
+  def _read_summary(line):
+    parse_list = lambda f: tuple(float(x) for x in f.split(','))
+    fields = line.split()
+    if len(fields) != 9 or fields[0] != 'slide':
+      raise FormatError("Bad slide summary: %s" % line.strip())
+    return {'t': float(fields[1]), 't_end': float(fields[2]),
+            'size': parse_list(fields[3]),
+            'strokes': int(fields[4]), 'points': int(fields[5]),
+            'length': float(fields[6]),
+            'bbox': parse_list(fields[7]) if fields[7] != '-' else None,
+            'colors': [parse_list(c) for c in fields[8].split(';')]
+                      if fields[8] != '-' else []}
+
+DCB.ENCODE_EVENT = Dispatcher({
+    Event: DCB._encode_plain,
+    MouseEvent: DCB._encode_mouse,
+    Drag: DCB._encode_drag,
+    MediaEvent: DCB._encode_media,
+    VideoRecord: DCB._encode_video,
+    Clear: DCB._encode_clear,
+    Color: DCB._encode_color,
+    Thickness: DCB._encode_thickness,
+    ScreenEvent: DCB._encode_screen})
+
+DCB.DECODE_EVENT = Dispatcher({
+    Event: DCB._decode_plain,
+    MouseEvent: DCB._decode_mouse,
+    Drag: DCB._decode_drag,
+    MediaEvent: DCB._decode_media,
+    AudioRecord: DCB._decode_audio_record,
+    Clear: DCB._decode_clear,
+    Color: DCB._decode_color,
+    Thickness: DCB._decode_thickness,
+    ScreenEvent: DCB._decode_screen})
+
+# Maps each event kind (as a character) to '\x01' if EventStore keeps events
+# of that kind as objects, or '\x00' if it keeps them in its columns.
+_OBJECT_KINDS = ''.join('\x00' if k in EventStore.COLUMNAR_KINDS else '\x01'
+                        for k in xrange(256))
+
+def _object_rows(kinds, a, b):
+  '''Returns the positions i in [a,b) where the array 'kinds' holds the kind
+  of an event that isn't kept in EventStore's columns.'''
+  flags = kinds[a:b].tostring().translate(_OBJECT_KINDS)
+  rows = []
+  i = flags.find('\x01')
+  while i >= 0:
+    rows.append(a + i)
+    i = flags.find('\x01', i + 1)
+  return rows
+
+def _to_le(col):
+  '''Returns the bytes of array col, little-endian.'''
+  if sys.byteorder == 'big':
+    col = array.array(col.typecode, col)
+    col.byteswap()
+  return col.tostring()
+
+def _from_le(col):
+  '''Turns array col, read from little-endian bytes, around in place if need
+  be.  Returns col.'''
+  if sys.byteorder == 'big':
+    col.byteswap()
+  return col
 
 
+############################################################################
+# ---------------------------- Lazy loading ------------------------------ #
+############################################################################
+
+class _LRU(object):
+  '''A dict that keeps only the 'size' entries used last.'''
+  def __init__(self, size):
+    self.size = max(1, size)
+    self.items = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self.items)
+
+  def get(self, key, make):
+    '''Returns the entry for key, making it with make() if it isn't there
+    (and dropping the one used longest ago if that's one too many).'''
+    try:
+      value = self.items.pop(key)
+    except KeyError:
+      value = make()
+      while len(self.items) >= self.size:
+        self.items.popitem(last=False)
+    self.items[key] = value
+    return value
+
+class LazyLecture(object):
+  '''A lecture read from a v0.4+ DCB file a slide at a time.  Opening it
+  reads only the header and the chunk index; the events of each SLID chunk,
+  and each block of audio, are decoded the first time something asks for
+  them, and only the 'cache_size' slides (and audio blocks) used last are
+  kept.
+
+  It reads like a Lecture (iterating, indexing, slides(), strokes(),
+  events_to_time(), adats, ...), but can't be changed: load() gives a
+  Lecture that can.  Indexes are over the whole lecture, but each event,
+  stroke and slide handed out belongs to the Lecture of its own slide (see
+  slide()).'''
+  CACHE_SIZE = 8
+
+  class Slide(object):
+    '''Stands in for the Lecture.Slide in one SLID chunk.  Its times come
+    from the index; anything else decodes the chunk.'''
+    def __init__(self, lazy, chunk, t, t_end):
+      self.lazy = lazy
+      self.chunk = chunk
+      self.t = t
+      self.t_end = t_end
+
+    def __getattr__(self, name):
+      return getattr(self.lazy.slide(self.chunk).slides()[-1], name)
+
+  class Audio(object):
+    '''The lecture's blocks of audio, as a sequence of AudioData that are
+    decoded when asked for.'''
+    def __init__(self, lazy):
+      self.lazy = lazy
+
+    def __len__(self):
+      return len(self.lazy._audio_chunks)
+
+    def __getitem__(self, i):
+      if i < 0: i += len(self)
+      if not 0 <= i < len(self):
+        raise IndexError("audio block index out of range")
+      return self.lazy._audio_cache.get(i, lambda: self.lazy._decode_audio(i))
+
+    def __iter__(self):
+      for i in xrange(len(self)):
+        yield self[i]
+
+  def __init__(self, fname, cache_size=CACHE_SIZE, diag=None):
+    self.fname = fname
+    self._dcb = DCB(fname, diag=diag)
+    self.diag = self._dcb.diag
+    self.buf = self._dcb._open_indexed()
+    self.fp = self._dcb.fp
+    try:
+      self._read_index()
+    except:
+      self.close()
+      raise
+    self._cache = _LRU(cache_size)
+    self._audio_cache = _LRU(cache_size)
+    self.adats = LazyLecture.Audio(self)
+    self.vdats = []
+
+  def _read_index(self):
+    buf = self.buf
+    self._ar = 1.
+    self._chunks = []        # ([(payload offset, length) of each SLID part],
+                             #  t0, t1) of each slide
+    self._states = []        # and the state it starts in, None if unknown
+    self._starts = array.array('l', [0])  # and the index of its 1st event
+    self._t0 = array.array('d')  # and the time of it
+    self._audio_chunks = []  # (payload offset, length) of each AUDI
+    state = None
+    for tag, off, length, t0, t1 in self._dcb._read_index(buf):
+      if tag not in ('HEAD', 'STAT', 'SLID', 'AUDI'):
+        continue
+      start = self._dcb._chunk_payload(buf, tag, off, length)
+      if tag == 'HEAD':
+        self._ar = self._dcb._decode_head(buf, start)
+      elif tag == 'STAT':
+        state = DCB._decode_state(buf, start)
+      elif tag == 'SLID':
+        if state is None and len(self._chunks) == 0:
+          state = Lecture.State()  # as DCB.load() starts out
+          state.win_sz = (self._ar, 1.)
+        n = DCB.U32.unpack_from(buf, start)[0]
+        if (t0 != t0 or t1 != t1) and n > 0:
+          t0, t1 = self._chunk_times(buf, start, n)
+        kind = buf[start + DCB.U32.size] if n > 0 else None
+        if len(self._chunks) > 0 and \
+            kind not in (chr(Start.kind), chr(Clear.kind)):
+          # The rest of the slide before (see DCB._append_chunks()).
+          parts, t0, t1_before = self._chunks[-1]
+          parts.append((start, length))
+          self._chunks[-1] = (parts, t0, max(t1, t1_before))
+          self._starts[-1] += n
+        else:
+          self._chunks.append(([(start, length)], t0, t1))
+          self._states.append(state)
+          self._starts.append(self._starts[-1] + n)
+          self._t0.append(t0)
+        state = None
+      else:
+        self._audio_chunks.append((start, length))
+
+    # Every chunk begins a slide, except that the first one may be the
+    # events before the first Start or Clear, which are only a slide if
+    # there are strokes in them.
+    self._slides = [LazyLecture.Slide(self, k, t0, t1)
+                    for k, (parts, t0, t1) in enumerate(self._chunks)]
+    if len(self._chunks) > 0:
+      kinds = ''
+      for start, length in self._chunks[0][0]:
+        n = DCB.U32.unpack_from(buf, start)[0]
+        kinds += buf[start + DCB.U32.size:start + DCB.U32.size + n]
+      if kinds[:1] not in (chr(Start.kind), chr(Clear.kind)) and \
+          chr(Click.kind) not in kinds:
+        del self._slides[0]
+
+  def _chunk_times(self, buf, start, n):
+    '''Returns the times of the first and last of the n events in the SLID
+    chunk payload at buf[start:], read from its time column, for when the
+    index has no times (see DCB._read_index()).'''
+    off = start + DCB.U32.size + n  # after the kinds
+    if self._dcb.v[1] >= 5:
+      try:
+        ts = self._dcb.codec.decode(buf, off, n)[0][0]
+      except PointCodec.Error:
+        raise FormatError("Slide ends early.")
+      return ts[0], ts[-1]
+    return (DCB.F64.unpack_from(buf, off)[0],
+            DCB.F64.unpack_from(buf, off + DCB.F64.size * (n - 1))[0])
+
+  def close(self):
+    '''Closes the file.  Slides and audio decoded already can still be
+    used.'''
+    if self.buf is not None:
+      self.buf.close()
+      self.buf = None
+    if self.fp is not None:
+      self.fp.close()
+      self.fp = self._dcb.fp = None
+
+  def load(self):
+    '''Reads the whole file into a Lecture.'''
+    return DCB(self.fname, diag=self.diag).load()
+
+  def slide(self, k):
+    '''Returns a Lecture holding just the events of slide k (the SLID chunk,
+    or chunks, it was saved in), starting out in the state the whole lecture
+    was in there.'''
+    return self._cache.get(k, lambda: self._decode(k))
+
+  def _decode(self, k):
+    parts, t0, t1 = self._chunks[k]
+    dcb = self._dcb
+    dcb.lec = Lecture(self._state(k))
+    dcb._audio = self.adats
+    dcb._audio_used = set()
+    try:
+      for start, length in parts:
+        dcb._decode_events(self.buf, start, start + length)
+      if self.diag.counting:
+        self.diag.count('slide')
+        self.diag.count('event', len(dcb.lec))
+      return dcb.lec
+    except struct.error as e:
+      raise FormatError("Slide ends early: %s" % e)
+    finally:
+      dcb.lec = dcb._audio = dcb._audio_used = None
+
+  def _state(self, k):
+    '''Returns the state SLID chunk k starts out in.  Files saved without
+    STAT chunks have that worked out from the chunks before it.'''
+    if self._states[k] is None:
+      j = k
+      while self._states[j] is None: j -= 1
+      for j in xrange(j, k):
+        lec = self.slide(j)
+        self._states[j+1] = lec.state_at(len(lec))
+    return self._states[k]
+
+  def _decode_audio(self, i):
+    start, length = self._audio_chunks[i]
+    if self.diag.counting: self.diag.count('audio')
+    return DCB._decode_audio_chunk(self.buf, start, start + length)
+
+  def _locate(self, i):
+    '''Returns the chunk that event i is in, and its index there.'''
+    n = len(self)
+    if i < 0: i += n
+    if not 0 <= i < n:
+      raise IndexError("event index out of range")
+    k = bisect.bisect_right(self._starts, i) - 1
+    return k, i - self._starts[k]
+
+  def _chunk_at_time(self, t):
+    '''Returns the chunk holding the slide that was active at time t.'''
+    return max(0, bisect.bisect_right(self._t0, t) - 1)
+
+  def __str__(self):
+    return 'Lazy lecture with %d events in %d slides, and %d audio blocks' \
+        % (len(self), len(self._chunks), len(self.adats))
+
+  def __iter__(self):
+    return Lecture.Iterator(self, self)
+
+  def __getitem__(self, i):
+    k, j = self._locate(i)
+    return self.slide(k)[j]
+
+  def __len__(self):
+    return self._starts[-1]
+
+  def num_events(self):
+    return len(self)
+
+  def is_empty(self):
+    return len(self) <= 0
+
+  def aspect_ratio(self):
+    return self._ar
+
+  @property
+  def state(self):
+    '''The state at the end of the lecture (see Lecture.state).'''
+    if len(self._chunks) == 0:
+      state = Lecture.State()
+      state.win_sz = (self._ar, 1.)
+      return state
+    return self.slide(len(self._chunks) - 1).state
+
+  def state_at(self, i):
+    '''Returns the state right before event i (see Lecture.state_at()).'''
+    if len(self._chunks) == 0:
+      return Lecture.State()
+    i = max(0, min(i, len(self)))
+    if i == len(self):
+      k = len(self._chunks) - 1
+      return self.slide(k).state_at(i - self._starts[k])
+    k, j = self._locate(i)
+    return self.slide(k).state_at(j)
+
+  def first(self):
+    return self[0] if len(self) else None
+
+  def last(self):
+    return self[-1] if len(self) else None
+
+  def duration(self):
+    '''Computes the duration in s of the lecture, from the index.'''
+    if len(self) <= 0:
+      return .0
+    return self._chunks[-1][2] - self._chunks[0][1]
+
+  def slides(self):
+    '''Returns the slides of the lecture, in order (see LazyLecture.Slide).
+    Nothing is decoded until something other than a slide's times is
+    used.'''
+    return list(self._slides)
+
+  def strokes(self):
+    '''Returns the strokes of the lecture, in order, like
+    Lecture.strokes().  This decodes every slide: see iter_strokes().'''
+    return list(self.iter_strokes())
+
+  def iter_strokes(self):
+    '''Yields the strokes of the lecture, in order, a slide at a time.'''
+    for k in xrange(len(self._chunks)):
+      for stroke in self.slide(k).strokes():
+        yield stroke
+
+  def last_slide_iter(self):
+    if len(self._chunks) == 0:
+      return Lecture().last_slide_iter()
+    return self.slide(len(self._chunks) - 1).last_slide_iter()
+
+  def events_to_time(self, t):
+    '''See Lecture.events_to_time().  Only the slide active at time t is
+    decoded.'''
+    if len(self._chunks) == 0:
+      return Lecture().events_to_time(t)
+    return self.slide(self._chunk_at_time(t)).events_to_time(t)
+
+  def events_between(self, t0, t1, typ=None):
+    '''Returns a list of the events after t0, up to and including t1,
+    optionally only those of type typ.  Only the slides in between are
+    decoded.'''
+    return list(self.iter_between(t0, t1, typ))
+
+  def iter_between(self, t0, t1, typ=None):
+    '''Like events_between(), but yields the events a slide at a time.'''
+    if len(self._chunks) == 0:
+      return
+    for k in xrange(self._chunk_at_time(t0), self._chunk_at_time(t1) + 1):
+      for e in self.slide(k).events_between(t0, t1, typ):
+        yield e
+
+
+############################################################################
+# ---------------------------- Session journal --------------------------- #
+############################################################################
+
+# A journal writes out what's been added to it in groups: once the oldest
+# thing waiting is JOURNAL_FLUSH_MS old, or JOURNAL_FLUSH_EVENTS events are
+# waiting, whichever comes first.  Each group is fsync'd, so a crash loses at
+# most about that much.
+JOURNAL_FLUSH_MS = 250
+JOURNAL_FLUSH_EVENTS = 256
+
+class Journal(DCB):
+  '''An append-only log of a lecture as it's made, to recover it from after
+  a crash.  Lecture.append() hands each event to the lecture's journal (see
+  Lecture.journal), and the audio module each piece of audio it records (see
+  add_audio()); a thread of the journal's own writes them out, so that
+  adding costs the caller next to nothing.
+
+  The file is a DCB header, then records: a CHUNK header, the payload, and
+  the CRC-32 of both (U32).  They are
+    BASE  the name of a saved file the lecture continues from
+    EVTS  events, as a v0.4 SLID chunk has them
+    AUDI  a piece of audio, as an AUDI chunk has it; pieces with the same
+          time are parts of one block
+  Loading stops at the first record that isn't whole, which is where a crash
+  cut it off.  Saving the lecture should compact() the journal down to a
+  BASE record.'''
+  FNAME = 'journal'
+  EVENTS_VERSION = (0,4,0)  # how the events are encoded
+  CRC = struct.Struct("<I")
+
+  def __init__(self, dirname, flush_ms=None, flush_events=None, diag=None):
+    DCB.__init__(self, os.path.join(dirname, Journal.FNAME),
+                 Journal.EVENTS_VERSION, False, diag)
+    self.dirname = dirname
+    self.flush_ms = JOURNAL_FLUSH_MS if flush_ms is None else flush_ms
+    self.flush_events = (JOURNAL_FLUSH_EVENTS if flush_events is None
+                         else flush_events)
+    self._lock = threading.Condition()  # guards the fields below it
+    self._pending = []     # (tag, item) not yet written, in order
+    self._num_events = 0   # of them, events
+    self._since = None     # when the oldest of them was added
+    self._audio_ts = {}    # time of each audio block in the file -> its index
+    self._gen = 0          # how many times the journal has been started
+    self._closed = False
+    self._io_lock = threading.Lock()  # held while self.fp is written
+    self._thread = None
+
+  @staticmethod
+  def exists(dirname):
+    '''Returns whether there's a journal in dirname with something in it.'''
+    fname = os.path.join(dirname, Journal.FNAME)
+    return os.path.isfile(fname) and os.path.getsize(fname) > DCB.HEADER_SIZE
+
+  def start(self, lec, base=None, n=None, num_adats=None):
+    '''Starts a new journal of lec (replacing the old one), and makes it
+    lec's journal.  'base' is the name of a file lec was saved to or loaded
+    from, holding its first n events and num_adats audio blocks (default:
+    all of them).  The journal starts out referring to it, then has what lec
+    got since.  Without it, whatever lec holds already is written out
+    first.'''
+    if not os.path.isdir(self.dirname):
+      os.makedirs(self.dirname)
+    self._io_lock.acquire()
+    self._lock.acquire()
+    try:
+      self._take()
+      self._gen += 1  # what the writer has taken already is out of date
+      self._audio_ts = {}
+      if self.lec is not None and self.lec.journal is self:
+        self.lec.journal = None  # it's no longer logged
+      self.lec = lec
+      lec.journal = self
+      if base is None:
+        n = num_adats = 0
+      else:
+        self._queue('BASE', os.path.abspath(base))
+        if n is None: n = len(lec)
+        if num_adats is None: num_adats = len(lec.adats)
+      for adat in lec.adats[num_adats:]:
+        self._add_audio_block(adat)
+      for i in xrange(n, len(lec)):
+        self._add(lec[i])
+      batch = self._take()
+
+      # Written to the side and renamed over, so there always is a journal.
+      if self.fp is not None:
+        self.fp.close()
+      tmp = self.fname + '~'
+      self.fp = open(tmp, 'wb')
+      self.fp.write(MAGIC_NUMBER)
+      self.fp.write(DCB.VERSION.pack(*self.v))
+      self._write(batch)
+      self.fp.close()
+      os.rename(tmp, self.fname)
+      self.fp = open(self.fname, 'ab')
+      if self._thread is None:
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='Journal writer')
+        self._thread.daemon = True
+        self._thread.start()
+    finally:
+      self._lock.release()
+      self._io_lock.release()
+
+  def compact(self, base, n=None, num_adats=None):
+    '''Starts the journal over from 'base', the file the lecture has just
+    been saved to, holding its first n events and num_adats audio blocks
+    (default: all of them).'''
+    self.start(self.lec, base, n, num_adats)
+
+  def close(self, remove=False):
+    '''Writes out what's waiting and stops.  With 'remove', the journal is
+    then deleted, as it should be when the lecture has been saved.'''
+    self._lock.acquire()
+    try:
+      self._closed = True
+      self._lock.notify()
+    finally:
+      self._lock.release()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    if self.lec is not None and self.lec.journal is self:
+      self.lec.journal = None
+    self.lec = None
+    if self.fp is not None:
+      self.fp.close()
+      self.fp = None
+    if remove and os.path.exists(self.fname):
+      os.remove(self.fname)
+
+  def add(self, e):
+    '''Logs event e, just added to the lecture.'''
+    self._lock.acquire()
+    try:
+      self._add(e)
+      if self._num_events >= self.flush_events:
+        self._lock.notify()
+    finally:
+      self._lock.release()
+
+  def add_audio(self, t, data):
+    '''Logs a piece of raw audio, recorded as part of the block that started
+    at time t.'''
+    self._lock.acquire()
+    try:
+      self._queue('AUDI', (t, AudioData.RAW, data))
+    finally:
+      self._lock.release()
+
+  def _add(self, e):
+    if isinstance(e, AudioRecord):
+      # Refer to the block by its index in the journal, not in the lecture.
+      e = AudioRecord(e.t, self._add_audio_block(e.get_media()), e.get_media())
+    self._queue('EVTS', e)
+    self._num_events += 1
+
+  def _add_audio_block(self, adat):
+    '''Logs a whole block of audio, and returns its index in the journal.'''
+    t = adat.utime()
+    if t not in self._audio_ts:
+      for key in (AudioData.SPX, AudioData.ZLB, AudioData.RAW):
+        if key in adat.dats:
+          data = adat.dats[key]
+          if isinstance(data, list):
+            data = ''.join(data)
+          self._queue('AUDI', (t, key, data))
+          break
+      else:
+        self._queue('AUDI', (t, AudioData.RAW, ''))
+    return self._audio_ts[t]
+
+  def _queue(self, tag, item):
+    if tag == 'AUDI' and item[0] not in self._audio_ts:
+      self._audio_ts[item[0]] = len(self._audio_ts)
+    if self._since is None:
+      self._since = time.time()
+    self._pending.append((tag, item))
+
+  def _take(self):
+    '''Returns what's waiting, and forgets it.'''
+    batch = self._pending
+    self._pending = []
+    self._num_events = 0
+    self._since = None
+    return batch
+
+  def _due(self):
+    if self._num_events >= self.flush_events:
+      return True
+    return (self._since is not None and
+            time.time() - self._since >= self.flush_ms / 1000.)
+
+  def _run(self):
+    '''The writer thread: writes out a group whenever one is due.'''
+    while True:
+      self._lock.acquire()
+      try:
+        while not self._closed and not self._due():
+          if self._since is None:
+            timeout = self.flush_ms / 1000.
+          else:
+            timeout = self._since + self.flush_ms / 1000. - time.time()
+          self._lock.wait(max(timeout, .001))
+        batch = self._take()
+        gen = self._gen
+        closed = self._closed
+      finally:
+        self._lock.release()
+      self._io_lock.acquire()
+      try:
+        if len(batch) > 0 and gen == self._gen and self.fp is not None:
+          self._write(batch)
+      except (IOError, OSError) as e:
+        sys.stderr.write("Warning: can't write the journal: %s\n" % e)
+      finally:
+        self._io_lock.release()
+      if closed:
+        return
+
+  def _write(self, batch):
+    '''Writes the records for 'batch' to self.fp, and syncs it to disk.
+    Events in a row go in one EVTS record.'''
+    diag = self.diag
+    i = 0
+    while i < len(batch):
+      tag, item = batch[i]
+      i += 1
+      if tag == 'EVTS':
+        events = [item]
+        while i < len(batch) and batch[i][0] == 'EVTS':
+          events.append(batch[i][1])
+          i += 1
+        payload = self._encode_events(EventStore(events), 0, len(events))
+        if diag.counting: diag.count('event', len(events))
+      elif tag == 'AUDI':
+        payload = DCB.AUDIO_V4.pack(item[0], item[1]) + item[2]
+        if diag.counting: diag.count('audio')
+      else:
+        payload = item
+      record = DCB.CHUNK.pack(tag, len(payload)) + payload
+      self.fp.write(record)
+      self.fp.write(Journal.CRC.pack(zlib.crc32(record) & 0xffffffff))
+      if diag.tracing:
+        diag.trace('chunk', '%s: %d bytes', tag, len(payload))
+    self.fp.flush()
+    os.fsync(self.fp.fileno())
+
+  def load(self):
+    '''Returns the lecture in the journal, as far as it was written out.
+    Raises MissingBaseError if the file it continues from is gone or can't
+    be loaded: what's logged is only the rest of the lecture.'''
+    self.fp = open(self.fname, 'rb')
+    try:
+      buf = self.fp.read()
+    finally:
+      self.fp.close()
+      self.fp = None
+    if buf[:len(MAGIC_NUMBER)] != MAGIC_NUMBER:
+      raise FormatError("No (wrong) magic number.")
+    self.v = DCB.VERSION.unpack_from(buf, len(MAGIC_NUMBER))
+    if self.v != Journal.EVENTS_VERSION:
+      raise VersionError(self.v)
+
+    self.lec = Lecture()
+    self._audio = []
+    self._audio_used = set()
+    audio_ts = {}
+    off = DCB.HEADER_SIZE
+    while off + DCB.CHUNK.size <= len(buf):
+      tag, length = DCB.CHUNK.unpack_from(buf, off)
+      start = off + DCB.CHUNK.size
+      end = start + length
+      if end + Journal.CRC.size > len(buf) or \
+          Journal.CRC.unpack_from(buf, end)[0] != \
+          zlib.crc32(buffer(buf, off, end - off)) & 0xffffffff:
+        break
+      if tag == 'BASE':
+        base = buf[start:end]
+        try:
+          self.lec = load(base) if os.path.exists(base) else ()
+        except (FormatError, IOError):
+          self.lec = ()
+        if not isinstance(self.lec, Lecture):
+          raise MissingBaseError(base)
+        self._audio = []
+        audio_ts = {}
+      elif tag == 'AUDI':
+        t, key = DCB.AUDIO_V4.unpack_from(buf, start)
+        if t not in audio_ts:
+          audio_ts[t] = len(self._audio)
+          self._audio.append(AudioData(t))
+          self._audio[-1].add_type(key, [])
+        adat = self._audio[audio_ts[t]]
+        adat.dats[adat.dats.keys()[0]].append(buf[start+DCB.AUDIO_V4.size:end])
+      elif tag == 'EVTS':
+        self._decode_events(buf, start, end)
+      off = end + Journal.CRC.size
+    if off < len(buf):
+      sys.stderr.write("Warning: the journal was cut off %d bytes early.\n"
+                       % (len(buf) - off))
+
+    for adat in self._audio:
+      for key in adat.dats:
+        adat.dats[key] = ''.join(adat.dats[key])
+    DCB._inflate_audio(self._audio)
+    self.lec.adats.extend(adat for i, adat in enumerate(self._audio)
+                          if i not in self._audio_used)
+    self._audio = self._audio_used = None
+    try:
+      return self.lec
+    finally:
+      self.lec = None
+
 
 ################################################################################
 # ----------------------------------- DCD ------------------------------------ #
 ################################################################################
 
 class DCD(DCB):
-  def __init__(self, fname, version=DEFAULT_VERSION):
-    DCB.__init__(self, fname, version)
+  def __init__(self, fname, version=DEFAULT_VERSION, summaries=False,
+               diag=None):
+    DCB.__init__(self, fname, version, summaries, diag)
 
   def write_metadata(self):
     self.fp.write(MAGIC_NUMBER + '\n')
     self.fp.write("%d.%d.%d\n" % self.v)
-    self.fp.write("%f" % self.lec.aspect_ratio())
-    self.fp.close()
+    self.fp.write("%f\n" % self.lec.aspect_ratio())
+    if self.summaries:
+      for summary in self.lec.slide_summaries():
+        self.fp.write(DCB._format_summary(summary))
+
+  def load_summaries(self):
+    '''Reads the slide summaries from the metadata, or returns None if there
+    are none.'''
+    self.fp = open(os.path.join(self.fname, 'metadata'))
+    try:
+      if self.fp.readline().strip() != MAGIC_NUMBER:
+        raise FormatError("No (wrong) magic number.")
+      self.fp.readline()  # version
+      self.fp.readline()  # aspect ratio
+      summaries = [DCD._read_summary(line) for line in self.fp if line.strip()]
+    finally:
+      self.fp.close()
+    return summaries if len(summaries) > 0 else None
 
   def save(self, lec = None):
     if os.path.exists(self.fname):
@@ -573,75 +2354,129 @@ class DCD(DCB):
     self.lec = lec
 
     os.mkdir(self.fname)
+    diag = self.diag
+    diag.begin(os.path.join(self.fname, "write_log.txt"))
     self.fp = open(os.path.join(self.fname, "metadata"), "w")
     self.write_metadata()
+    self.fp.close()
 
-    self.log = open(os.path.join(self.fname, "write.txt"), "w")
-
-    it = iter(self.lec)
-    while it.has_next():
-      e = next(it)
-      if isinstance(e, Start):
-        self.state.size = e.size
-        
-        slide_dir = os.path.join(self.fname, "slide000")
+    try:
+      for slide_i, slide in enumerate(self.lec.slides()):
+        slide_dir = os.path.join(self.fname, "slide%03d" % slide_i)
         os.mkdir(slide_dir)
-        num_strokes = 0
 
         self.fp = open(os.path.join(slide_dir, "metadata"), "w")
-        self.fp.write("%f\n" % e.t)
+        self.fp.write("%f\n" % slide.t)
         self.fp.close()
 
-        self.log.write("Slide started at %f\n" % e.t)
-      elif isinstance(e, Move):
-        print 'Ignoring Move'
-      elif isinstance(e, Click):
-        stroke = [e]
-      elif isinstance(e, Point):
-        stroke.append(e)
-      elif isinstance(e, Drag):
-        self._save_drag(e)
-      elif isinstance(e, Release):
-        self.fp = open(os.path.join(slide_dir, "stroke%03d" % num_strokes))
-        self._save_click(stroke[1], len(stroke) + 1)
-        for ev in stroke[1:]:
-          self._save_point(ev)
-        self._save_release(e)
-        self.fp.close()
-        num_strokes += 1
-      elif isinstance(e, AudioRecord):
-        print 'Ignoring AudioRecord'
-      elif isinstance(e, VideoRecord):
-        print 'Ignoring VideoRecord'
-      elif isinstance(e, Clear):
-        print 'Ignoring Clear'
-      elif isinstance(e, Color):
-        self.state.color = e.color
-      elif isinstance(e, Thickness):
-        pass
-      elif isinstance(e, Resize):
-        pass
-      elif isinstance(e, End):
-        pass
-      else:
-        raise InternalError("Unrecognized Event " + e)
+        if diag.counting: diag.count('slide')
+        if diag.tracing: diag.trace('slide', "Slide started at %f", slide.t)
+
+        for stroke_i, stroke in enumerate(slide.strokes):
+          start = time.time()
+          self.fp = open(os.path.join(slide_dir, "stroke%03d" % stroke_i), "wb")
+          self._save_stroke({'points': stroke.points(),
+                             'color': stroke.color,
+                             'aspect_ratio': slide.aspect_ratio(),
+                             'thickness': stroke.thickness})
+          if diag.counting: diag.section('slides', start, self.fp.tell())
+          self.fp.close()
+    finally:
+      diag.end()
+
+  def iter_events(self, t0=None, t1=None):
+    '''Yields the events in the directory in time order, reading a slide (or
+    an audio file) at a time (see fileio.iter_events()).'''
+    t0, t1 = _time_range(t0, t1)
+    slides, afiles = self._walk()
+    self.fp = open(os.path.join(self.fname, 'metadata'))
+    try:
+      if self.fp.readline().strip() != MAGIC_NUMBER:
+        raise FormatError("No (wrong) magic number.")
+    finally:
+      self.fp.close()
+      self.fp = None
+    for e in _in_time_order(self._iter_slide_dirs(slides, t0, t1),
+                            self._iter_audio_files(afiles, t0, t1)):
+      yield e
+
+  def _iter_slide_dirs(self, slides, t0, t1):
+    '''Yields (t, i, event) for the events in the slide directories that are
+    after t0, up to and including t1, in order, a slide at a time.  Slides
+    that end before t0 or start after t1 aren't read.'''
+    times = []
+    for slide_entry in slides:
+      f = open(os.path.join(self.fname, slide_entry, 'metadata'))
+      try:
+        times.append(float(f.readline()))
+      finally:
+        f.close()
+    i = 0
+    for k, slide_entry in enumerate(slides):
+      if times[k] > t1:
+        return
+      if k + 1 < len(times) and times[k+1] <= t0:
+        continue
+      slide_dir = os.path.join(self.fname, slide_entry)
+      self.lec = Lecture()
+      self.lec.append(times[k])
+      for stroke_entry in sorted(os.listdir(slide_dir)):
+        if stroke_entry == 'metadata': continue
+        f = open(os.path.join(slide_dir, stroke_entry), 'rb')
+        try:
+          self._decode_stroke(f.read(), 0)
+        finally:
+          f.close()
+      for e in self.lec.events_between(t0, t1):
+        yield e.utime(), i, e
+        i += 1
+      self.lec = None
 
-  def load(self):
+  def _iter_audio_files(self, afiles, t0, t1):
+    '''Like _iter_slide_dirs(), for the audio files.  Only their times are
+    read up front; each is read in whole when its turn comes.'''
+    entries = []
+    for i, afile in enumerate(afiles):
+      f = open(os.path.join(self.fname, afile), 'rb')
+      try:
+        entries.append((DCB.AUDIO.unpack(f.read(DCB.AUDIO.size))[0] / 1000.,
+                        i, afile))
+      finally:
+        f.close()
+    entries.sort()
+    for t, i, afile in entries:
+      if t0 < t <= t1:
+        f = open(os.path.join(self.fname, afile), 'rb')
+        try:
+          adat = self._read_audio(f.read(), 0)[0]
+        finally:
+          f.close()
+        DCB._inflate_audio([adat])
+        yield t, i, AudioRecord(t, i, adat)
+
+  def _walk(self):
+    '''Returns the names of the slide directories and of the audio files, in
+    order.'''
     if not os.path.exists(self.fname):
       raise IOError("No such directory: " + self.fname)
-
-    # Get the information about the directory.
     info = os.walk(self.fname).next()
     info[1].sort()
     info[2].remove('metadata')
     if 'write_log.txt' in info[2]: info[2].remove('write_log.txt')
     if 'read_log.txt' in info[2]: info[2].remove('read_log.txt')
     info[2].sort()
+    return info[1], [afile for afile in info[2]
+                     if not afile.endswith('~') and not afile.endswith(".txt")]
+
+  def load(self):
+    # Get the information about the directory.
+    info = (None,) + self._walk()
 
     # Create the lecture.
+    diag = self.diag
+    diag.begin(os.path.join(self.fname, 'read_log.txt'))
     try:
       self.fp = open(os.path.join(self.fname, 'metadata'))
-      self.log = open(os.path.join(self.fname, 'write-log.txt'), 'w')
       if self.fp.readline().strip() != MAGIC_NUMBER:
         raise FormatError("No (wrong) magic number.")
       v = tuple(map(lambda x: int(x), self.fp.readline().split('.')))
@@ -669,25 +2504,31 @@ class DCD(DCB):
 
       for stroke_entry in slide_info[2]:
         stroke_fname = os.path.join(slide_dir, stroke_entry)
-        self.fp = open(stroke_fname, 'r')
-        self._load_stroke()
+        self.fp = open(stroke_fname, 'rb')
+        start = time.time()
+        off = self._decode_stroke(self.fp.read(), 0)
+        if diag.counting: diag.section('slides', start, off)
         self.fp.close()
 
     # Populate it with audio data.
     self.lec.adats = []
+    audio = []
     for afile in info[2]:
-      if afile.endswith('~') or afile.endswith(".txt"): continue
       afile_name = os.path.join(self.fname, afile)
       print 'audio file:', afile_name
-      self.fp = open(afile_name, 'r')
-      self._load_audio()
+      self.fp = open(afile_name, 'rb')
+      start = time.time()
+      off = self._decode_audio(self.fp.read(), 0, audio)
+      if diag.counting: diag.section('audio', start, off)
       self.fp.close()
+    DCB._inflate_audio(self.lec.adats)
+    audio.sort(key=lambda e: e.utime())
+    self.lec.merge(audio)
 
-    self.log.close()
+    diag.end()
     try:
       return self.lec
     finally:
-      self.log = None
       self.fp = None
       self.lec = None
 
@@ -698,8 +2539,23 @@ class DCD(DCB):
 ################################################################################
 
 class DCT(DCD):
-  def __init__(self, fname, version=DEFAULT_VERSION):
-    DCD.__init__(self, fname, version)
+  '''A DCD directory in a (plain) tar file:
+
+    metadata            as in a DCD
+    slideNNN/metadata   the time of slide NNN
+    slideNNN/strokes    its strokes, one after the other, as in a DCD
+    audioNNN            the NNN'th audio file, as in a DCD
+
+  Members are written straight from memory, and read on demand: opening
+  the file only reads the tar's headers, so a slide (load_slide()) or the
+  audio (load_audio()) can be read on its own.  Subclasses can keep the
+  same members in another kind of archive (see DAR) by overriding
+  _archive(), _add(), _names(), _member() and _read_members().'''
+  ARCHIVE_ERRORS = (tarfile.TarError,)
+
+  def __init__(self, fname, version=DEFAULT_VERSION, summaries=False,
+               diag=None):
+    DCD.__init__(self, fname, version, summaries, diag)
 
   def save(self, lec = None):
     if os.path.exists(self.fname):
@@ -707,17 +2563,218 @@ class DCT(DCD):
 
     self.lec = lec
 
-    self.tf = tarfile.open(self.fname, 'w')
+    diag = self.diag
+    diag.begin(self.fname + '.save_log')
+    arc = self._archive('w')
+    try:
+      self.fp = io.BytesIO()
+      self.write_metadata()
+      self._add(arc, 'metadata')
+
+      for slide_i, slide in enumerate(self.lec.slides()):
+        self.fp = io.BytesIO()
+        self.fp.write("%f\n" % slide.t)
+        self._add(arc, "slide%03d/metadata" % slide_i)
+
+        if diag.counting: diag.count('slide')
+        if diag.tracing: diag.trace('slide', "Slide started at %f", slide.t)
+
+        start = time.time()
+        self.fp = io.BytesIO()
+        for stroke in slide.strokes:
+          self._save_stroke({'points': stroke.points(),
+                             'color': stroke.color,
+                             'aspect_ratio': slide.aspect_ratio(),
+                             'thickness': stroke.thickness})
+        if diag.counting: diag.section('slides', start, self.fp.tell())
+        self._add(arc, "slide%03d/strokes" % slide_i)
+
+      for audio_i, adat in enumerate(self.lec.adats):
+        start = time.time()
+        self.fp = io.BytesIO()
+        raw = ''.join(_raw_audio(adat))
+        if self.v[1] < 3:
+          self._save_audio((adat.utime(), raw))  # compressed
+        else:
+          self.fp.write(DCB.AUDIO.pack(int(adat.utime() * 1000), len(raw)))
+          self.fp.write(raw)
+        if diag.counting:
+          diag.count('audio')
+          diag.section('audio', start, self.fp.tell())
+        self._add(arc, "audio%03d" % audio_i)
+    finally:
+      arc.close()
+      self.fp = None
+      self.lec = None
+      diag.end()
+
+  def _archive(self, mode):
+    '''Opens the file as an archive to read ('r') or write ('w').'''
+    return tarfile.open(self.fname, mode)
+
+  def _add(self, arc, name):
+    '''Adds what's been written to self.fp (a BytesIO) to arc as 'name'.'''
+    info = tarfile.TarInfo(name)
+    info.size = self.fp.tell()
+    info.mtime = time.time()
+    self.fp.seek(0)
+    arc.addfile(info, self.fp)
+
+  def _names(self, arc):
+    '''Returns the names of the members of arc.'''
+    return arc.getnames()
+
+  def _member(self, arc, name):
+    '''Returns a file to read member 'name' of arc from.  Raises KeyError if
+    there's no such member.'''
+    return arc.extractfile(name)
+
+  def _read_members(self, arc, names):
+    '''Returns the contents of the members 'names' of arc.'''
+    return [self._member(arc, name).read() for name in names]
+
+  def _open(self):
+    '''Opens the file and checks its metadata.  Returns the archive, the
+    names of the slides' members (less the '/metadata' or '/strokes') and of
+    the audio members, in order, and the version and aspect ratio.'''
+    try:
+      arc = self._archive('r')
+    except (IOError,) + self.ARCHIVE_ERRORS as e:
+      raise FormatError("Cannot open file: %s" % e)
+    try:
+      fp = self._member(arc, 'metadata')
+      if fp.readline().strip() != MAGIC_NUMBER:
+        raise FormatError("No (wrong) magic number.")
+      v = tuple(map(lambda x: int(x), fp.readline().split('.')))
+      ar = float(fp.readline())
+      names = self._names(arc)
+      self.v = v  # to read it as it was written
+    except (KeyError, ValueError) + self.ARCHIVE_ERRORS:
+      arc.close()
+      raise FormatError("Cannot parse file.")
+    except:
+      arc.close()
+      raise
+    slides = sorted(name[:-len('/metadata')] for name in names
+                    if name.startswith('slide') and name.endswith('/metadata'))
+    afiles = sorted(name for name in names if name.startswith('audio'))
+    return arc, slides, afiles, v, ar
+
+  def num_slides(self):
+    arc, slides, afiles, v, ar = self._open()
+    arc.close()
+    return len(slides)
+
+  def load_slide(self, k):
+    '''Returns a Lecture of just slide k, reading only its members.'''
+    arc, slides, afiles, v, ar = self._open()
+    try:
+      self.lec = Lecture()
+      self.lec.aspect_ratio(ar)
+      self._read_slide(arc, slides[k])
+      return self.lec
+    finally:
+      arc.close()
+      self.lec = None
 
-    self.fp = tempfile.NamedTemporaryFile(delete=False)
-    self.write_metadata()
-    self.tf.add(self.fp.name, 'metadata')
-    self.tf.close()
+  def load_audio(self):
+    '''Returns the AudioData of the file, reading only the audio members.'''
+    arc, slides, afiles, v, ar = self._open()
+    try:
+      self.lec = Lecture()
+      audio = []
+      for buf in self._read_members(arc, afiles):
+        self._decode_audio(buf, 0, audio)
+      DCB._inflate_audio(self.lec.adats)
+      return self.lec.adats
+    finally:
+      arc.close()
+      self.lec = None
 
-    # TODO finish me
+  def _read_slide(self, arc, name, buf=None):
+    '''Appends the slide in the members name/* of arc to self.lec.  'buf' is
+    the name/strokes member if it's been read already.'''
+    self.lec.append(float(self._member(arc, name + '/metadata').readline()))
+    if buf is None:
+      try:
+        buf = self._member(arc, name + '/strokes').read()
+      except KeyError:
+        return  # no strokes
+    off = 0
+    start = time.time()
+    while off < len(buf):
+      off = self._decode_stroke(buf, off)
+    if self.diag.counting: self.diag.section('slides', start, off)
 
   def load(self):
-    pass
+    arc, slides, afiles, v, ar = self._open()
+    diag = self.diag
+    diag.begin(self.fname + '.load_log')
+    try:
+      self.lec = Lecture()
+      self.lec.aspect_ratio(ar)
+      names = set(self._names(arc))
+      strokes = [name + '/strokes' for name in slides
+                 if name + '/strokes' in names]
+      bufs = dict(zip(strokes, self._read_members(arc, strokes)))
+      for name in slides:
+        self._read_slide(arc, name, bufs.pop(name + '/strokes', ''))
+
+      audio = []
+      for buf in self._read_members(arc, afiles):
+        start = time.time()
+        off = self._decode_audio(buf, 0, audio)
+        if diag.counting: diag.section('audio', start, off)
+      DCB._inflate_audio(self.lec.adats)
+      audio.sort(key=lambda e: e.utime())
+      self.lec.merge(audio)
+      return self.lec
+    finally:
+      arc.close()
+      diag.end()
+      self.lec = None
+
+  def iter_events(self, t0=None, t1=None):
+    '''Yields the events in the file in time order, reading a slide (or an
+    audio file) at a time (see fileio.iter_events()).'''
+    t0, t1 = _time_range(t0, t1)
+    arc, slides, afiles, v, ar = self._open()
+    try:
+      for e in _in_time_order(self._iter_slides(arc, slides, t0, t1),
+                              self._iter_audio(arc, afiles, t0, t1)):
+        yield e
+    finally:
+      arc.close()
+
+  def _iter_slides(self, arc, slides, t0, t1):
+    '''Like DCD._iter_slide_dirs(), for the slide members.'''
+    times = [float(self._member(arc, name + '/metadata').readline())
+             for name in slides]
+    i = 0
+    for k, name in enumerate(slides):
+      if times[k] > t1:
+        return
+      if k + 1 < len(times) and times[k+1] <= t0:
+        continue
+      self.lec = Lecture()
+      self._read_slide(arc, name)
+      for e in self.lec.events_between(t0, t1):
+        yield e.utime(), i, e
+        i += 1
+      self.lec = None
+
+  def _iter_audio(self, arc, afiles, t0, t1):
+    '''Like DCD._iter_audio_files(), for the audio members.'''
+    entries = []
+    for i, afile in enumerate(afiles):
+      head = self._member(arc, afile).read(DCB.AUDIO.size)
+      entries.append((DCB.AUDIO.unpack(head)[0] / 1000., i, afile))
+    entries.sort()
+    for t, i, afile in entries:
+      if t0 < t <= t1:
+        adat = self._read_audio(self._member(arc, afile).read(), 0)[0]
+        DCB._inflate_audio([adat])
+        yield t, i, AudioRecord(t, i, adat)
 
 
 
@@ -725,20 +2782,53 @@ class DCT(DCD):
 # -------------------------------- DAR ----------------------------------- #
 ############################################################################
 
-class DAR(DCD):
-  def __init__(self, fname, version=DEFAULT_VERSION):
-    self.fname = fname
-    self.v = version
-    self.fp = None
-    self.log = None
-
-  def save(self, lec = None):
-    '''Saves the thing into a DAR archive.'''
-    tempfile.mktemp(prefix='/home/jamoozy/.deskcorder/file-')
-    pass # TODO write me
-
-  def load(self):
-    pass # TODO write me
+class DAR(DCT):
+  '''The members of a DCT (see there), in a zip file instead, each deflated
+  on its own (but for the small metadata ones, which are stored as they
+  are).  The zip's central directory says where each member is, so one can
+  be read without reading the others, and members of zip64 size are fine.
+  When loading, the members are inflated in parallel by the audio workers
+  (see _audio_map()), if there's enough to them.'''
+  ARCHIVE_ERRORS = (zipfile.BadZipfile, zipfile.LargeZipFile)
+
+  def __init__(self, fname, version=DEFAULT_VERSION, summaries=False,
+               diag=None):
+    DCT.__init__(self, fname, version, summaries, diag)
+
+  def _archive(self, mode):
+    return zipfile.ZipFile(self.fname, mode, allowZip64=True)
+
+  def _add(self, arc, name):
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    if name.endswith('metadata'):
+      info.compress_type = zipfile.ZIP_STORED
+    else:
+      info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0644 << 16
+    arc.writestr(info, self.fp.getvalue())
+
+  def _names(self, arc):
+    return arc.namelist()
+
+  def _member(self, arc, name):
+    return arc.open(name)
+
+  def _read_members(self, arc, names):
+    nbytes = sum(arc.getinfo(name).file_size for name in names)
+    if nbytes < PARALLEL_AUDIO_BYTES:  # not worth reopening the file for
+      return DCT._read_members(self, arc, names)
+    return _audio_map(_read_zip_member, [(self.fname, name) for name in names],
+                      nbytes)
+
+def _read_zip_member(item):
+  '''Returns the contents of member 'name' of zip file 'fname', for
+  (fname, name).  Module-level, for the audio workers to find.'''
+  fname, name = item
+  arc = zipfile.ZipFile(fname, 'r')
+  try:
+    return arc.read(name)
+  finally:
+    arc.close()
 
 
 
@@ -746,89 +2836,275 @@ class DAR(DCD):
 # ----------------------------------- DCX ------------------------------------ #
 ################################################################################
 
-def _save_dcx(fname = 'save.dcx', lecture = [], audiofiles = [], req_v = DEFAULT_VERSION):
-  '''Saves DCX-v0.1.1
-  @lecture: A complex list.  See the Canvas object for details.
-  @audiofiles: A list of (t,data) tuples'''
-  f = open(fname, 'w')
-  f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-  f.write('<document version="0.1.1">\n')
-  for slide in lecture:
-    if isinstance(slide, float):
-      f.write('  <slide cleartime="%lf">\n' % slide)
-    else:
-      for stroke in slide:
-        if len(stroke) <= 0: continue
-        f.write('    <stroke color="#%s">\n' %
-            reduce(lambda a,b: a+b,
-              map(lambda x: '0' + x if len(x) == 1 else x,
-              map(lambda x: hex(int(255*x))[2:], stroke[0][3]))))
-        for point in stroke:
-          thickness = point[2] / (math.sqrt(point[4][0] * point[4][0] +
-                                            point[4][1] * point[4][1]))
-          f.write('      <point x="%lf" y="%lf" time="%lf" thickness="%lf"/>\n' %
-              (point[1][0] / float(point[4][0]), point[1][1] / float(point[4][1]), point[0], thickness))
-        f.write('    </stroke>\n')
-      f.write('  </slide>\n')
-#  for pos in lecture
-#    f.write('  <position x="%lf" y="%lf" time="%lf" />\n' %
-#        (pos[1][0] / float(pos[2][0]), pos[1][1] / float(pos[2][1]), pos[0]))
-  if isinstance(audiofiles, list):
-    for af in audiofiles:
-      f.write('  <audiofile time="%lf" type="wav" encoding="base64">' % af[0])
-      f.write(base64.b64encode(af[1]))
-      f.write('</audiofile>\n')
-  elif isinstance(audiofiles, str):
-    f.write('  <audiofile type="wav" encoding="base64">')
-    f.write(base64.b64encode(audiofiles))
-    f.write('</audiofile>\n')
-  f.write('</document>\n')
-  f.flush()
-  f.close()
+def _save_dcx(fname = 'save.dcx', lec = None, req_v = DEFAULT_VERSION):
+  '''Saves DCX-v0.1.1 (see _DCXWriter).  Coordinates are stored as they are
+  in lec, in [0,1].'''
+  _DCXWriter(fname).write(lec)
+
+class _DCXWriter(object):
+  '''Writes a Lecture out as DCX-v0.1.1: its slides and their strokes, then
+  its Moves as <position>s, then its audio.  Lines are put together and
+  written BATCH at a time, reading the points straight out of the lecture's
+  event columns, and audio is base64-encoded B64_BYTES at a time as it's
+  written (zlib-compressed audio is inflated a piece at a time, too), so
+  memory use doesn't grow with the length of the audio.'''
+  BATCH = 4096  # lines
+  B64_BYTES = 3 << 14  # a multiple of 3
+
+  def __init__(self, fname):
+    self.fname = fname
+
+  def write(self, lec):
+    self.lines = []
+    self.f = open(self.fname, 'wb')
+    try:
+      self.lines.append('<?xml version="1.0" encoding="UTF-8"?>\n')
+      self.lines.append('<document version="0.1.1">\n')
+      for slide in lec.slides():
+        self._write_slide(slide)
+      self._write_moves(lec.events)
+      for adat in lec.adats:
+        self._write_audio(adat)
+      self.lines.append('</document>\n')
+      self._flush()
+    finally:
+      self.f.close()
+
+  def _flush(self):
+    self.f.write(''.join(self.lines))
+    self.lines = []
+
+  def _write_slide(self, slide):
+    self.lines.append('  <slide cleartime="%lf">\n' % slide.t)
+    for stroke in slide.strokes:
+      self._write_stroke(stroke)
+    self.lines.append('  </slide>\n')
+
+  def _write_stroke(self, stroke):
+    '''Writes a stroke's points with their thickness: the stroke's, times
+    the pressure for Points (so that the thickest is the stroke's, as
+    _dcx_stroke() reads it back).'''
+    if stroke.num_points == 0: return
+    events = stroke.events
+    kinds, ts, xs, ys, ps = (events.kinds, events.ts, events.xs, events.ys,
+                             events.ps)
+    pen = EventStore.POINT_KINDS
+    point = Point.kind
+    th = stroke.thickness
+    lines = self.lines
+    lines.append('    <stroke color="#%02x%02x%02x">\n'
+                 % tuple(int(round(255 * c)) for c in stroke.color))
+    for i in xrange(stroke.start, stroke.end):
+      k = kinds[i]
+      if k in pen:
+        lines.append(
+            '      <point x="%lf" y="%lf" time="%lf" thickness="%g"/>\n'
+            % (xs[i], ys[i], ts[i], th * ps[i] if k == point else th))
+        if len(lines) >= _DCXWriter.BATCH:
+          self._flush()
+    lines.append('    </stroke>\n')
+
+  def _write_moves(self, events):
+    kinds, ts, xs, ys = events.kinds, events.ts, events.xs, events.ys
+    move = Move.kind
+    for i in xrange(len(kinds)):
+      if kinds[i] == move:
+        self.lines.append('  <position x="%lf" y="%lf" time="%lf"/>\n'
+                          % (xs[i], ys[i], ts[i]))
+        if len(self.lines) >= _DCXWriter.BATCH:
+          self._flush()
+
+  def _write_audio(self, adat):
+    self.lines.append('  <audiofile time="%lf" type="wav" encoding="base64">'
+                      % adat.utime())
+    self._flush()
+    rest = ''  # < 3 bytes left over from the last piece
+    for piece in _raw_audio(adat, _DCXWriter.B64_BYTES):
+      piece = rest + piece if rest else piece
+      end = len(piece) - len(piece) % 3
+      for i in xrange(0, end, _DCXWriter.B64_BYTES):
+        self.f.write(base64.b64encode(piece[i:min(i + _DCXWriter.B64_BYTES,
+                                                  end)]))
+      rest = piece[end:]
+    self.f.write(base64.b64encode(rest))
+    self.lines.append('</audiofile>\n')
 
 def _load_dcx(fname = 'save.dcx', win_sz = (1,1)):
-  '''Reads DCX-v*.
-  @win_sz: Needed to scale the (x,y) coords.'''
-  # TODO unify these functions.
-  xmlDoc = xml.dom.minidom.parse(fname)
-  document = xmlDoc.getElementsByTagName('document')[0]
-  v_str = document.getAttribute('version')
-  v = __parse_version_string(v_str) if v_str else (0,0,0)
-  if v[0] == 0:
-    if v[0] == 0:
-      if v[1] == 0:
-        trace, positions = load_dcx_0(fname, win_sz)
-        return (trace, positions, [])
-    if v[1] == 1:
-      trace = []
-      positions = []
-      audiofiles = []
-      for slide in document.getElementsByTagName('slide'):
-        trace.append(float(slide.getAttribute('cleartime')))
-        trace.append([])
-        for stroke in slide.getElementsByTagName('stroke'):
-          cs = stroke.getAttribute('color') # Of the form "#RRGGBB"
-          color = tuple(map(lambda x: int(x, 16), (cs[1:3], cs[3:5], cs[5:])))
-          trace[-1].append([])
-          for point in stroke.getElementsByTagName('point'):
-            trace[-1][-1].append((float(point.getAttribute('time')),
-              (float(point.getAttribute('x')) * win_sz[0], float(point.getAttribute('y')) * win_sz[1]),
-              float(point.getAttribute('thickness')) * math.sqrt(win_sz[0] * win_sz[0] + win_sz[1] * win_sz[1]),
-              color, win_sz))
-      for pos in document.getElementsByTagName('position'):
-        positions.append((float(pos.getAttribute('time')),
-          (float(pos.getAttribute('x')) * win_sz[0], float(pos.getAttribute('y')) * win_sz[1]),
-          win_sz))
-      for af in document.getElementsByTagName('audiofile'):
-        if v[2] == 1:
-          audiofiles.append((float(af.getAttribute('time')), base64.b64decode(af.firstChild.wholeText)))
-        elif v[2] == 0:
-          audiofiles.append(base64.b64decode(af.firstChild.wholeText))
-        else:
-          print 'Warning: unrecognized bug version: ' + v_str
-      return trace, positions, audiofiles
-  raise VersionError(v)
+  '''Reads DCX-v*.  DCX-v0.1.x files are read into a Lecture a block at a
+  time (see _DCXReader), with coordinates left in [0,1], as stored.
+  @win_sz: Needed to scale the (x,y) coords of DCX-v0.0.0 files.'''
+  v = _dcx_version(fname)
+  if v[:2] == (0,0):
+    trace, positions = load_dcx_0(fname, win_sz)
+    return (trace, positions, [])
+  if v[:2] != (0,1):
+    raise VersionError(v)
+
+  # Positions and audio files come after all the slides, so they're merged
+  # in with them at the end, as DCB.load() does.
+  lec = Lecture()
+  moves = []
+  audio = []
+  for tag, e in _DCXReader(fname):
+    if tag == 'slide':
+      lec.append(e)
+    elif tag == 'position':
+      moves.append(e)
+    else:
+      lec.adats.append(e.get_media())
+      audio.append(e)
+  moves.sort(key=lambda e: e.utime())  # fast when they're in order already
+  audio.sort(key=lambda e: e.utime())
+  lec.merge(moves, audio)
+  return lec
+
+def _dcx_version(fname):
+  '''Returns the version in a DCX file's <document> tag, reading no
+  further than that.'''
+  for event, elem in ElementTree.iterparse(fname, ('start',)):
+    v_str = elem.get('version')
+    break
+  return __parse_version_string(v_str) if v_str else (0,0,0)
+
+def _iter_dcx(fname, t0=None, t1=None):
+  '''Yields the events in a DCX-v0.1.x file in time order (see
+  fileio.iter_events()), parsing it as it goes.  Coordinates are left in
+  [0,1], as stored.'''
+  t0, t1 = _time_range(t0, t1)
+  v = _dcx_version(fname)
+  if v[:2] != (0,1):
+    raise VersionError(v)
+  for e in _in_time_order(_iter_dcx_tag(fname, 'slide', t0, t1),
+                          _iter_dcx_tag(fname, 'position', t0, t1),
+                          _iter_dcx_tag(fname, 'audiofile', t0, t1)):
+    yield e
+
+def _iter_dcx_tag(fname, tag, t0, t1):
+  '''Yields (t, i, event) for the events that the elements named 'tag'
+  make, in order, in one pass over the file.'''
+  i = 0
+  for _, e in _DCXReader(fname, (tag,)):
+    t = e.utime()
+    if t0 < t <= t1:
+      yield t, i, e
+      i += 1
+    elif t > t1 and isinstance(e, Clear):
+      return
 
+class _DCXReader(object):
+  '''Reads the events out of a DCX-v0.1.x file with expat, BLOCK bytes at a
+  time, yielding (tag, event) for each as the element that makes it closes,
+  in file order.  'tag' is that of the element: 'slide' (for the Clear and
+  each stroke's events), 'position', or 'audiofile'.  Only the tags in
+  'tags' are turned into events.  Nothing is kept of an element once its
+  events are out, and an audio file's base64 text is decoded B64_CHARS at
+  a time as it comes in, so memory stays bounded by the largest stroke and
+  audio file, not the file.'''
+  BLOCK = 1 << 16
+  B64_CHARS = 1 << 16  # a multiple of 4
+
+  def __init__(self, fname, tags=('slide', 'position', 'audiofile')):
+    self.fname = fname
+    self.tags = tags
+
+  def __iter__(self):
+    self.ready = []
+    self.points = None
+    self.audio = None
+    self.num_adats = 0
+    parser = xml.parsers.expat.ParserCreate()
+    parser.returns_unicode = False
+    parser.StartElementHandler = self._start
+    parser.EndElementHandler = self._end
+    parser.CharacterDataHandler = self._text
+    f = open(self.fname, 'rb')
+    try:
+      while True:
+        block = f.read(_DCXReader.BLOCK)
+        parser.Parse(block, not block)
+        for item in self.ready:
+          yield item
+        self.ready = []
+        if not block:
+          break
+    finally:
+      f.close()
+
+  def _start(self, name, attrs):
+    if name == 'slide':
+      if 'slide' in self.tags:
+        t = float(attrs['cleartime'])
+        self.ready.append(('slide', Clear(t, None)))
+    elif name == 'stroke':
+      if 'slide' in self.tags:
+        self.color = attrs['color']
+        self.points = []
+    elif name == 'point':
+      if self.points is not None:
+        self.points.append((float(attrs['time']),
+            (float(attrs['x']), float(attrs['y'])),
+            float(attrs['thickness'])))
+    elif name == 'position':
+      if 'position' in self.tags:
+        t = float(attrs['time'])
+        self.ready.append(('position',
+                           Move(t, (float(attrs['x']), float(attrs['y'])))))
+    elif name == 'audiofile':
+      if 'audiofile' in self.tags:
+        self.audio = AudioData(float(attrs.get('time', 0.)))
+        self.data = []  # decoded so far
+        self.b64 = []   # not yet decoded
+        self.b64_len = 0
+
+  def _end(self, name):
+    if name == 'stroke' and self.points is not None:
+      for e in _dcx_stroke(self.color, self.points):
+        self.ready.append(('slide', e))
+      self.points = None
+    elif name == 'audiofile' and self.audio is not None:
+      self._decode(True)
+      adat = self.audio
+      adat.add_type(AudioData.RAW, ''.join(self.data))
+      self.ready.append(('audiofile',
+                         AudioRecord(adat.t, self.num_adats, adat)))
+      self.num_adats += 1
+      self.audio = self.data = self.b64 = None
+
+  def _text(self, text):
+    if self.audio is not None:
+      self.b64.append(text)
+      self.b64_len += len(text)
+      if self.b64_len >= _DCXReader.B64_CHARS:
+        self._decode(False)
+
+  def _decode(self, last):
+    '''Decodes the base64 text read so far, up to the last whole 4-char
+    group unless this is the 'last' of it.'''
+    text = ''.join(''.join(self.b64).split())
+    n = len(text) if last else len(text) - len(text) % 4
+    self.data.append(base64.b64decode(text[:n]))
+    self.b64 = [text[n:]]
+    self.b64_len = len(text) - n
+
+def _dcx_stroke(cs, points):
+  '''Returns the events that a DCX <stroke> element makes, given its color
+  ("#RRGGBB") and its points' (t, (x,y), thickness).'''
+  if not points:
+    return []
+  color = tuple(int(x, 16) / 255. for x in (cs[1:3], cs[3:5], cs[5:]))
+  th0 = max(th for t, pos, th in points)
+  events = []
+  for k, (t, pos, th) in enumerate(points):
+    if k == 0:
+      events += [Color(t, color), Thickness(t, th0), Click(t, pos)]
+    elif k == len(points) - 1:
+      events.append(Release(t, pos))
+    else:
+      events.append(Point(t, pos, th / th0 if th0 else 1.))
+  if len(points) == 1:  # a dot: it's released where it was made
+    t, pos, th = points[0]
+    events.append(Release(t, pos))
+  return events
 
 def save_dcx_0(fname = "save.dcx", trace = [], position = [], audiofiles = []):
   '''Saves DCX-v0.0.0'''
@@ -62,14 +62,20 @@ class Canvas(gtk.DrawingArea):
     self.frozen = False
 
   def draw_last_slide(self):
-    
-    it = self.dc.lec.last_slide_iter()
+    self._draw_events(self.dc.lec.last_slide_iter())
+
+  def draw_to_ttpt(self):
+    '''Draw all events leading up to the ttpt variable.'''
+    self._draw_events(self.dc.lec.events_to_time(self.ttpt))
+
+  def _draw_events(self, it):
+    '''Draws the strokes in the events left in Lecture.Iterator it.'''
     try:
       last_point = None
       while True:
         point = it.next()
         if isinstance(point, Point):
-          if last_point is None:
+          if last_point is None or isinstance(point, Click):
             self.draw(it.state.color, it.state.thickness * point.p,
                 point.pos)
           else:
@@ -79,21 +85,6 @@ class Canvas(gtk.DrawingArea):
     except StopIteration:
       pass
 
-  def draw_to_ttpt(self):
-    '''Draw all events leading up to the ttpt variable.'''
-    it = self.dc.lec.events_to_time(self.ttpt)
-    try:
-      last_point = it.next()
-      self.draw(it.state.color, it.state.thickness * last_point.p,
-          last_point.pos)
-      while True:
-        point = it.next()
-        self.draw(it.state.color, it.state.thickness * last_point.p,
-            last_point.pos, point.pos)
-        last_point = point
-    except StopIteration:
-      pass
-
   def _configure(self):
     
     self.dc.lec.resize(self.window.get_size())
@@ -597,6 +588,23 @@ Draw and record yourself, then play it back for your friends!  What a party tric
       print 'Unknown button: %d' % rtn
       return False
 
+  def ask_recover(self):
+    '''Asks whether to recover the lecture left from a session that didn't
+    end cleanly.'''
+    d = gtk.MessageDialog(None, 0, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO,
+        "Deskcorder didn't shut down properly last time.  Would you like to "
+        "recover what you had?")
+    d.set_default_response(gtk.RESPONSE_YES)
+    rtn = d.run()
+    d.destroy()
+    return rtn == gtk.RESPONSE_YES
+
+  def recover_failed(self, msg):
+    '''Tells the user the lecture couldn't be recovered, and that what was
+    left is kept for next time.'''
+    self.ext_err("Couldn't recover the last session: %s  It will be offered "
+        "again next time Deskcorder starts." % msg)
+
   def int_err(self, msg):
     '''Internal error notification dialog box.'''
     d = gtk.MessageDialog(None, 0, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK, 'Internal Error!  ' + msg)
@@ -704,6 +712,8 @@ Draw and record yourself, then play it back for your friends!  What a party tric
   # ---- Up and down ---------------------
 
   def init(self):
+    # Let other threads (saving, the journal) run while gtk waits.
+    gobject.threads_init()
     self['root'].show()
     self.canvas._configure()  # Some arch's need this or nothing is shown.
 
@@ -717,12 +727,13 @@ Draw and record yourself, then play it back for your friends!  What a party tric
 
 
 class Audio:
-  def __init__(self, lec):
+  def __init__(self, dc):
     self.data = []  # K.I.S.S.  Data stored as a string.
     # next version: store an array of strings.  Do smart things to determine
     # when no one is talking.
 
-    self.lec = lec
+    self.dc = dc  # the Main this records for; its journal logs the audio
+    self.lec = dc
     self.startTime = time.time()
 
     self.play_start = None
@@ -802,6 +813,9 @@ class Audio:
       if l > 0:
         if not self.paused:
           self.data[-1][1].append(data)
+          journal = getattr(self.dc, 'journal', None)
+          if journal is not None:
+            journal.add_audio(self.data[-1][0], data)
       else:
         return True
     else:
@@ -54,23 +54,12 @@ class Canvas(QGraphicsScene):
       for item in self.items():
         self.removeItem(item)
 
-      color = QColor(0, 0, 0)
-      it = iter(self.dc.lec)
-      p1 = None
-      while it.has_next():
-        e = it.next()
-        if isinstance(e, Color):
-          color = QColor(e.r(), e.g(), e.b())
-        elif isinstance(e, Click):
-          pen = QPen()
-          pen.setColor(color)
-          p1 = e
-        elif isinstance(e, Point):
-          self.addLine(p1.x(), p1.y(), e.x(), e.y(), pen)
-          p1 = e
-        elif isinstance(e, Release):
-          self.addLine(p1.x(), p1.y(), e.x(), e.y(), pen)
-          p1 = None
+      for stroke in self.dc.lec.strokes():
+        pen = QPen()
+        pen.setColor(QColor(stroke.r() * 255, stroke.g() * 255, stroke.b() * 255))
+        points = stroke.points()
+        for p1, p2 in zip(points, points[1:]):
+          self.addLine(p1.x(), p1.y(), p2.x(), p2.y(), pen)
       self.last_size = size
 
   # ---------------- Drawing -----------------------------
@@ -132,7 +121,8 @@ class GUI:
 Deskcorder Binary (*.dcb);;\
 Deskcorder XML (*.dcx);;\
 Deskcorder Text (*.dct);;\
-All Deskcorder Files (*.dcb *.dcx *.dct);;\
+Deskcorder Archive (*.dar);;\
+All Deskcorder Files (*.dcb *.dcx *.dct *.dar);;\
 All Files (*.*)'''
   def __init__(self, dc):
     self.dc = dc
@@ -236,6 +226,19 @@ All Files (*.*)'''
     mb.setStandardButtons(QMessageBox.Ok)
     return mb.exec_() == QMessageBox.Ok
 
+  def ask_recover(self):
+    mb = QMessageBox(QMessageBox.Question, 'Recover?',
+        "Deskcorder didn't shut down properly last time.  Would you like to "
+        "recover what you had?")
+    mb.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+    mb.setDefaultButton(QMessageBox.Yes)
+    return mb.exec_() == QMessageBox.Yes
+
+  def recover_failed(self, msg):
+    QMessageBox(QMessageBox.Critical, 'Recovery failed',
+        "Couldn't recover the last session: %s  It will be offered again next "
+        "time Deskcorder starts." % msg).exec_()
+
   def dirty_ok_save(self):
     mb = QMessageBox(QMessageBox.Warning,
         'The document has been modified.', "Are you sure you want to continue?")
@@ -0,0 +1,767 @@
+#!/usr/bin/python
+
+'''
+Rough benchmarks for the Lecture/fileio internals.  Run from this directory:
+
+  $ python benchmarks.py [name ...]
+
+With no names, everything is run.
+'''
+
+import sys
+import time
+import base64
+sys.path.append('../src')
+from datatypes import *
+
+
+def _deep_sizeof(obj, seen=None):
+  '''Sums sys.getsizeof() over obj and everything it refers to (attributes,
+  tuple/list entries).  Shared objects are only counted once.'''
+  if seen is None: seen = set()
+  if id(obj) in seen: return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, (list, tuple)):
+    size += sum(_deep_sizeof(o, seen) for o in obj)
+  elif isinstance(obj, dict):
+    size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen)
+                for k, v in obj.iteritems())
+  else:
+    if hasattr(obj, '__dict__'):
+      size += _deep_sizeof(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+      for slot in cls.__dict__.get('__slots__', ()):
+        if hasattr(obj, slot):
+          size += _deep_sizeof(getattr(obj, slot), seen)
+  return size
+
+def _synthetic_points(n):
+  '''Yields a session of n pen samples: strokes of 100 samples each.'''
+  t = 1000.
+  for i in xrange(n):
+    t += .01
+    pos = ((i % 997) / 997., (i % 991) / 991.)
+    if i % 100 == 0:
+      yield Click(t, pos)
+    elif i % 100 == 99:
+      yield Release(t, pos)
+    else:
+      yield Point(t, pos, (i % 89) / 89.)
+
+def _report(name, value, unit):
+  print '  %-40s %12.2f %s' % (name, value, unit)
+
+
+def bench_point_store(n=1000000):
+  '''Memory used by n points as a list of objects vs. in an EventStore.'''
+  print 'point store (%d points)' % n
+  events = list(_synthetic_points(n))
+  list_bytes = _deep_sizeof(events)
+  _report('list of objects', list_bytes / 2.**20, 'MB')
+  _report('list of objects, per event', list_bytes / float(n), 'B')
+
+  start = time.time()
+  store = EventStore(events)
+  _report('EventStore build', time.time() - start, 's')
+  del events
+  _report('EventStore', store.nbytes() / 2.**20, 'MB')
+  _report('EventStore, per event', store.nbytes() / float(n), 'B')
+
+  start = time.time()
+  for e in store: pass
+  _report('EventStore full iteration', time.time() - start, 's')
+
+
+def _synthetic_session(n):
+  '''Yields a session of about n events: pen samples with a color and
+  thickness change every stroke and a new slide every 50 strokes.'''
+  yield Start(999., (640, 480))
+  for i, e in enumerate(_synthetic_points(n)):
+    if isinstance(e, Click):
+      if i % 5000 == 0: yield Clear(e.t, (1, 1, 1))
+      yield Color(e.t, ((i % 3) / 3., .5, .5))
+      yield Thickness(e.t, (i % 7) / 7.)
+    yield e
+
+def _classify_isinstance(state, e):
+  '''The old isinstance() chain from Lecture.State.update.'''
+  if isinstance(e, Thickness):
+    state.thickness = e.thickness
+  elif isinstance(e, Start):
+    state.win_sz = (e.width(), e.height())
+  elif isinstance(e, Color):
+    state.color = e.color
+
+def bench_dispatch(n=1000000):
+  '''Replaying a session through an isinstance() chain vs. Dispatcher.'''
+  print 'dispatch (%d events)' % n
+  events = list(_synthetic_session(n))
+
+  state = Lecture.State()
+  start = time.time()
+  for e in events: _classify_isinstance(state, e)
+  _report('replay, isinstance chain', time.time() - start, 's')
+
+  state = Lecture.State()
+  start = time.time()
+  for e in events: state.update(e)
+  _report('replay, Dispatcher', time.time() - start, 's')
+
+  # The savers classify every event, not just the state-changing ones.
+  classes = (Point, Click, Release, Color, Thickness, Start, Clear)
+  start = time.time()
+  for e in events:
+    for cls in classes:
+      if isinstance(e, cls): break
+  _report('classify all, isinstance chain', time.time() - start, 's')
+
+  d = Dispatcher(dict((cls, None) for cls in classes))
+  start = time.time()
+  for e in events: d[e]
+  _report('classify all, Dispatcher', time.time() - start, 's')
+
+  table = d.table
+  start = time.time()
+  for e in events: table[e.kind]
+  _report('classify all, Dispatcher.table', time.time() - start, 's')
+
+def _sample_events(n):
+  '''Yields (name, list of n fresh events) for the common event classes.
+  Colors and thicknesses are built anew every time, the way the GUI does,
+  but only take a few different values.'''
+  pos = lambda i: (i / 997., i / 991.)
+  yield 'Point', [Point(i + .5, pos(i), i / 89.) for i in xrange(n)]
+  yield 'Click', [Click(i + .5, pos(i)) for i in xrange(n)]
+  yield 'Release', [Release(i + .5, pos(i)) for i in xrange(n)]
+  yield 'Move', [Move(i + .5, pos(i)) for i in xrange(n)]
+  yield 'Color', [Color(i + .5, ((i % 3) / 2., (i % 2) / 1., 0.))
+                  for i in xrange(n)]
+  yield 'Thickness', [Thickness(i + .5, (i % 5) / 4.) for i in xrange(n)]
+  yield 'Clear', [Clear(i + .5, (1., 1., 1.)) for i in xrange(n)]
+  yield 'Resize', [Resize(i + .5, (800 + i % 2, 600)) for i in xrange(n)]
+
+def bench_event_sizes(n=100000):
+  '''Memory used per event object, by class.'''
+  print 'event sizes (%d of each)' % n
+  for name, events in _sample_events(n):
+    size = _deep_sizeof(events) - sys.getsizeof(events)
+    _report(name, size / float(n), 'B/event')
+
+def bench_strokes(n=1000000):
+  '''Rebuilding strokes from the events by hand vs. Lecture.strokes().'''
+  print 'strokes (%d events)' % n
+  lec = Lecture()
+  for e in _synthetic_session(n): lec.append(e)
+
+  start = time.time()
+  strokes = []
+  for e in lec:
+    if isinstance(e, Click): strokes.append([e])
+    elif isinstance(e, Point): strokes[-1].append(e)
+  _report('by hand, from events', time.time() - start, 's')
+
+  start = time.time()
+  lec.strokes()
+  _report('strokes(), first call', time.time() - start, 's')
+  start = time.time()
+  lec.strokes()
+  _report('strokes(), again', time.time() - start, 's')
+  start = time.time()
+  lec.append(Click(lec.last().utime() + 1, (.5, .5)))
+  lec.strokes()
+  _report('strokes(), after an append', time.time() - start, 's')
+  start = time.time()
+  lec.slides()
+  _report('slides()', time.time() - start, 's')
+
+def bench_events_between(n=1000000, queries=1000):
+  '''Counting the Clicks in short time windows: filtering a full pass over
+  the events vs. Lecture.events_between().'''
+  print 'events_between (%d events, %d queries)' % (n, queries)
+  lec = Lecture()
+  for e in _synthetic_session(n): lec.append(e)
+  t0, t1 = lec.first().utime(), lec.last().utime()
+  windows = [(t0 + (t1 - t0) * q / queries, t0 + (t1 - t0) * q / queries + 5)
+             for q in xrange(queries)]
+
+  start = time.time()
+  for a, b in windows[:10]:
+    len([e for e in lec.events if a < e.utime() <= b and isinstance(e, Click)])
+  _report('full pass, per query', (time.time() - start) / 10 * 1e3, 'ms')
+
+  start = time.time()
+  for a, b in windows:
+    len(lec.events_between(a, b, Click))
+  _report('events_between, per query',
+          (time.time() - start) / queries * 1e3, 'ms')
+
+  start = time.time()
+  it = iter(lec)
+  prog = 0
+  while it.has_next():
+    prog += 1 / 15.
+    it.next(prog)
+  _report('Iterator.next(prog) playback at 15 fps', time.time() - start, 's')
+
+def bench_summaries(n=100000):
+  '''Getting a slide overview: loading the whole file vs. reading only the
+  slide summaries from its header.'''
+  import os, shutil, tempfile
+  import fileio
+  print 'summaries (%d events)' % n
+  lec = Lecture()
+  for e in _synthetic_session(n): lec.append(e)
+  tmp = tempfile.mkdtemp()
+  try:
+    fname = os.path.join(tmp, 'bench.dcd')
+    start = time.time()
+    fileio.save(fname, lec, summaries=True)
+    _report('DCD save, with summaries', time.time() - start, 's')
+
+    start = time.time()
+    fileio.load(fname).slide_summaries()
+    _report('load, then slide_summaries()', time.time() - start, 's')
+    start = time.time()
+    fileio.load_summaries(fname)
+    _report('load_summaries()', time.time() - start, 's')
+  finally:
+    shutil.rmtree(tmp)
+
+def bench_dcb_load(n=500000):
+  '''Saving and loading a DCB file of about n events (pen samples, with a
+  new slide every 50 strokes), sequential (v0.3) vs. chunked (v0.4).'''
+  import os, tempfile
+  import fileio
+  print 'DCB load (%d events)' % n
+  lec = Lecture()
+  for e in _synthetic_session(n): lec.append(e)
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  try:
+    for v in ((0,3,0), (0,4,0)):
+      start = time.time()
+      fileio.save(fname, lec, v)
+      _report('v%d.%d.%d save' % v, time.time() - start, 's')
+      _report('v%d.%d.%d file size' % v, os.path.getsize(fname) / 2.**20, 'MB')
+      start = time.time()
+      fileio.load(fname)
+      _report('v%d.%d.%d load' % v, time.time() - start, 's')
+    start = time.time()
+    fileio.DCB(fname).index()
+    _report('v0.4.0 index (to seek to any slide)', time.time() - start, 's')
+  finally:
+    os.remove(fname)
+
+def bench_append(n=200000, saves=60):
+  '''Saving a lecture of about n events over and over as it's recorded
+  ('saves' times, e.g. once a minute), in whole vs. appending what's new.'''
+  import os, tempfile
+  import fileio
+  print 'saving as it grows (%d events, %d saves)' % (n, saves)
+  events = list(_synthetic_session(n))
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  try:
+    for append in (False, True):
+      name = 'append' if append else 'whole'
+      os.remove(fname)
+      lec = Lecture()
+      times = []
+      for k in xrange(saves):
+        for e in events[k * len(events) // saves:
+                        (k + 1) * len(events) // saves]:
+          lec.append(e)
+        start = time.time()
+        fileio.save(fname, lec, append=append)
+        times.append(time.time() - start)
+      _report('%s: first save' % name, times[0] * 1000, 'ms')
+      _report('%s: last save' % name, times[-1] * 1000, 'ms')
+      _report('%s: all saves' % name, sum(times), 's')
+      _report('%s: file size' % name, os.path.getsize(fname) / 2.**20, 'MB')
+  finally:
+    os.remove(fname)
+
+def bench_background_save(n=1000000):
+  '''How long saving a lecture of about n events holds up the caller (the
+  GUI): saving it there vs. snapshotting it and saving on another thread.'''
+  import os, tempfile
+  import fileio
+  print 'background save (%d events)' % n
+  lec = Lecture()
+  for e in _synthetic_session(n): lec.append(e)
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  try:
+    start = time.time()
+    fileio.save(fname, lec)
+    _report('save: caller blocked', time.time() - start, 's')
+    start = time.time()
+    saver = fileio.save_in_background(fname, lec)
+    _report('background: caller blocked', time.time() - start, 's')
+    saver.join()
+    _report('background: until saved', time.time() - start, 's')
+  finally:
+    os.remove(fname)
+
+def bench_lazy(n=1000000):
+  '''Opening a v0.4 DCB file of about n events and drawing one slide from the
+  middle: loading it whole vs. as a LazyLecture.'''
+  import os, tempfile
+  import fileio
+  print 'lazy loading (%d events)' % n
+  lec = Lecture()
+  for e in _synthetic_session(n): lec.append(e)
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  try:
+    fileio.save(fname, lec, (0,4,0))
+    del lec
+    start = time.time()
+    lec = fileio.load(fname)
+    _report('whole: load', time.time() - start, 's')
+    _report('whole: memory', _deep_sizeof(lec) / 2.**20, 'MB')
+    slides = len(lec.slides())
+    del lec
+
+    start = time.time()
+    lazy = fileio.load(fname, lazy=True)
+    _report('lazy: open', time.time() - start, 's')
+    start = time.time()
+    strokes = lazy.slides()[slides // 2].strokes
+    _report('lazy: first touch of a slide', time.time() - start, 's')
+    _report('lazy: memory', sum(_deep_sizeof(lazy.slide(k))
+                                for k in lazy._cache.items) / 2.**20, 'MB')
+    lazy.close()
+  finally:
+    os.remove(fname)
+
+def bench_journal(n=200000):
+  '''Appending a session of about n events to a lecture, without and with a
+  session journal, and recovering it from the journal.'''
+  import os, shutil, tempfile
+  import fileio
+  print 'journal (%d events)' % n
+  events = list(_synthetic_session(n))
+  start = time.time()
+  lec = Lecture()
+  for e in events: lec.append(e)
+  plain = time.time() - start
+  _report('append, no journal', plain / len(events) * 1e6, 'us/event')
+  tmp = tempfile.mkdtemp()
+  try:
+    journal = fileio.Journal(tmp)
+    lec = Lecture()
+    journal.start(lec)
+    start = time.time()
+    for e in events: lec.append(e)
+    _report('append, journal', (time.time() - start) / len(events) * 1e6,
+            'us/event')
+    journal.close()
+    _report('journal size', os.path.getsize(journal.fname) / 2.**20, 'MB')
+    start = time.time()
+    fileio.recover(tmp)
+    _report('recover', time.time() - start, 's')
+  finally:
+    shutil.rmtree(tmp)
+
+def _peak_memory(fun):
+  '''Runs fun() in a child process and returns its peak memory use (MB).'''
+  import os, resource
+  r, w = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(r)
+    fun()
+    os.write(w, str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    os._exit(0)
+  os.close(w)
+  peak = int(os.read(r, 64))
+  os.close(r)
+  os.waitpid(pid, 0)
+  return peak / 1024.
+
+def bench_iter_events(n=1000000):
+  '''Reading every event of a DCB file of about n events, in order: loading
+  it whole vs. fileio.iter_events(), for v0.3 and v0.5 files.'''
+  import os, tempfile
+  import fileio
+  print 'iter_events (%d events)' % n
+  lec = Lecture()
+  for e in _synthetic_session(n): lec.append(e)
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  def whole():
+    for e in fileio.load(fname): pass
+  def streamed():
+    for e in fileio.iter_events(fname): pass
+  try:
+    for v in ((0,3,0), (0,5,0)):
+      fileio.save(fname, lec, v)
+      base = _peak_memory(lambda: None)
+      for name, fun in (('whole', whole), ('streamed', streamed)):
+        start = time.time()
+        fun()
+        _report('v0.%d %s: time' % (v[1], name), time.time() - start, 's')
+        _report('v0.%d %s: peak memory' % (v[1], name),
+                _peak_memory(fun) - base, 'MB')
+  finally:
+    os.remove(fname)
+
+def _write_dcx(fname, n, audio_bytes):
+  '''Writes a DCX-v0.1.1 file of about n points, in strokes of 100 and
+  slides of 50 strokes, and one audio file of audio_bytes bytes.'''
+  f = open(fname, 'w')
+  f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+  f.write('<document version="0.1.1">\n')
+  t = 0.
+  for i, e in enumerate(_synthetic_points(n)):
+    if i % 100 == 0 and i:
+      f.write('    </stroke>\n')
+    if i % 5000 == 0:
+      if i: f.write('  </slide>\n')
+      f.write('  <slide cleartime="%lf">\n' % t)
+    if i % 100 == 0:
+      f.write('    <stroke color="#ff0000">\n')
+    t = e.utime()
+    f.write('      <point x="%lf" y="%lf" time="%lf" thickness="%lf"/>\n' %
+            (e.pos[0], e.pos[1], t, .01))
+  f.write('    </stroke>\n  </slide>\n')
+  f.write('  <audiofile time="0.0" type="wav" encoding="base64">')
+  block = 'x' * 3 * (1 << 16)
+  for i in xrange(0, audio_bytes, len(block)):
+    f.write(base64.b64encode(block[:audio_bytes - i]))
+  f.write('</audiofile>\n</document>\n')
+  f.close()
+
+def bench_dcx_load(n=200000, audio_bytes=8 << 20):
+  '''Loading a DCX file of about n points and audio_bytes of audio: just
+  parsing it into a DOM with minidom (what fileio.load() used to start with)
+  vs. fileio.load() reading it a block at a time.'''
+  import os, tempfile, xml.dom.minidom
+  import fileio
+  print 'dcx_load (%d points, %d MB audio)' % (n, audio_bytes >> 20)
+  fd, fname = tempfile.mkstemp(suffix='.dcx')
+  os.close(fd)
+  try:
+    _write_dcx(fname, n, audio_bytes)
+    funs = (('minidom', lambda: xml.dom.minidom.parse(fname)),
+            ('streamed', lambda: fileio.load(fname)))
+    # Memory first: what minidom leaves allocated here would count in the
+    # children's.
+    base = _peak_memory(lambda: None)
+    for name, fun in funs:
+      _report('%s: peak memory' % name, _peak_memory(fun) - base, 'MB')
+    for name, fun in funs:
+      start = time.time()
+      fun()
+      _report('%s: time' % name, time.time() - start, 's')
+  finally:
+    os.remove(fname)
+
+def _save_dcx_per_point(fname, lec):
+  '''Writes lec as DCX-v0.1.1 the way fileio._save_dcx() used to: a write
+  per line, colors through reduce/map/hex, and each audio file encoded
+  whole.'''
+  f = open(fname, 'w')
+  f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+  f.write('<document version="0.1.1">\n')
+  for slide in lec.slides():
+    f.write('  <slide cleartime="%lf">\n' % slide.t)
+    for stroke in slide.strokes:
+      f.write('    <stroke color="#%s">\n' %
+          reduce(lambda a,b: a+b,
+            map(lambda x: '0' + x if len(x) == 1 else x,
+            map(lambda x: hex(int(255*x))[2:], stroke.color))))
+      for point in stroke.points():
+        f.write('      <point x="%lf" y="%lf" time="%lf" thickness="%lf"/>\n'
+                % (point.pos[0], point.pos[1], point.t,
+                   stroke.thickness * point.p))
+      f.write('    </stroke>\n')
+    f.write('  </slide>\n')
+  for adat in lec.adats:
+    f.write('  <audiofile time="%lf" type="wav" encoding="base64">'
+            % adat.utime())
+    f.write(base64.b64encode(adat.dats[AudioData.RAW]))
+    f.write('</audiofile>\n')
+  f.write('</document>\n')
+  f.close()
+
+def bench_dcx_save(n=1000000, audio_bytes=64 << 20):
+  '''Saving a lecture of about n points and audio_bytes of audio as DCX:
+  the way fileio.save() used to vs. now.'''
+  import os, tempfile
+  import fileio
+  print 'dcx_save (%d points, %d MB audio)' % (n, audio_bytes >> 20)
+  lec = Lecture()
+  lec.append(Clear(999., None))
+  for e in _synthetic_points(n): lec.append(e)
+  adat = AudioData(1000.)
+  adat.add_type(AudioData.RAW, 'x' * audio_bytes)
+  lec.append(AudioRecord(1000., 0, adat))
+  lec.slides()  # so that neither pays for finding the strokes
+  fd, fname = tempfile.mkstemp(suffix='.dcx')
+  os.close(fd)
+  funs = (('per point', lambda: _save_dcx_per_point(fname, lec)),
+          ('batched', lambda: fileio.save(fname, lec)))
+  try:
+    base = _peak_memory(lambda: None)
+    for name, fun in funs:
+      _report('%s: peak memory' % name, _peak_memory(fun) - base, 'MB')
+    for name, fun in funs:
+      start = time.time()
+      fun()
+      _report('%s: time' % name, time.time() - start, 's')
+  finally:
+    os.remove(fname)
+
+def bench_dct(n=1000000):
+  '''A DCT file of about n points on slides of 10000: saving it, loading it
+  whole, and reading one slide out of it.'''
+  import os, tempfile
+  import fileio
+  print 'dct (%d points)' % n
+  lec = Lecture()
+  for i, e in enumerate(_synthetic_points(n)):
+    if i % 10000 == 0: lec.append(Clear(e.utime(), None))
+    lec.append(e)
+  fd, fname = tempfile.mkstemp(suffix='.dct')
+  os.close(fd)
+  dct = fileio.DCT(fname)
+  try:
+    for name, fun in (('save', lambda: dct.save(lec)),
+                      ('load', dct.load),
+                      ('load_slide', lambda: dct.load_slide(n // 20000))):
+      start = time.time()
+      fun()
+      _report(name, time.time() - start, 's')
+  finally:
+    os.remove(fname)
+
+def bench_dar(n=1000000, blocks=24, seconds=30):
+  '''A lecture of about n points on slides of 10000, and 'blocks' blocks of
+  audio like bench_audio()'s, as a DCT and as a DAR: file size, save, load
+  (for DAR, serial and on a worker per core) and reading one slide.'''
+  import math, os, random, struct, tempfile
+  import fileio
+  print 'dar (%d points, %d blocks of %d s)' % (n, blocks, seconds)
+  rand = random.Random(1)
+  samples = struct.pack('<%dh' % (16000 * seconds), *[
+      int(8000 * math.sin(i / 20.) + rand.gauss(0, 500))
+      for i in xrange(16000 * seconds)])
+  lec = Lecture()
+  for i, e in enumerate(_synthetic_points(n)):
+    if i % 10000 == 0: lec.append(Clear(e.utime(), None))
+    lec.append(e)
+  for i in xrange(blocks):
+    adat = AudioData(1000. + i * seconds)
+    adat.add_type(AudioData.RAW, samples[i:] + samples[:i])
+    lec.append(AudioRecord(adat.utime(), i, adat))
+  workers = fileio.AUDIO_WORKERS
+  for cls, suffix in ((fileio.DCT, '.dct'), (fileio.DAR, '.dar')):
+    fd, fname = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    f = cls(fname)
+    try:
+      start = time.time()
+      f.save(lec)
+      _report('%s: save' % suffix, time.time() - start, 's')
+      _report('%s: size' % suffix, os.path.getsize(fname) / 1e6, 'MB')
+      for fileio.AUDIO_WORKERS in ((1, None) if cls is fileio.DAR else (1,)):
+        name = 'serial' if fileio.AUDIO_WORKERS == 1 else 'parallel'
+        start = time.time()
+        f.load()
+        _report('%s: load (%s)' % (suffix, name), time.time() - start, 's')
+      start = time.time()
+      f.load_slide(n // 20000)
+      _report('%s: load_slide' % suffix, time.time() - start, 's')
+    finally:
+      fileio.AUDIO_WORKERS = workers
+      os.remove(fname)
+
+def _handwriting(n, seed=1):
+  '''Yields n pen samples that move like handwriting: strokes of 20 to 200
+  samples about 8 ms apart, drifting a few pixels (of 1024) at a time, with
+  pauses between strokes.'''
+  import random
+  rand = random.Random(seed)
+  t = 1300000000.
+  x = y = .5
+  left = 0
+  for i in xrange(n):
+    if left == 0:
+      left = rand.randint(20, 200)
+      t += rand.uniform(.2, 2.)
+      x = min(max(x + rand.uniform(-.1, .1), 0.), 1.)
+      y = min(max(y + rand.uniform(-.1, .1), 0.), 1.)
+      yield Click(t, (x, y))
+    else:
+      t += rand.gauss(.008, .001)
+      x += rand.gauss(0., 3. / 1024)
+      y += rand.gauss(0., 3. / 1024)
+      if left == 1:
+        yield Release(t, (x, y))
+      else:
+        yield Point(t, (x, y), min(max(rand.gauss(.6, .1), 0.), 1.))
+    left -= 1
+
+def bench_point_codec(n=1000000):
+  '''Size and speed of PointCodec on n samples of handwriting, plain Python
+  vs. numpy, and DCB v0.4 (columns) vs. v0.5 (PointCodec) files.'''
+  import os, tempfile
+  import fileio
+  print 'point codec (%d pen samples)' % n
+  store = EventStore(_handwriting(n))
+  cols = (store.ts, store.xs, store.ys, store.ps)
+  for vectorized in (False, True):
+    if vectorized and not use_numpy: continue
+    name = 'numpy' if vectorized else 'Python'
+    codec = PointCodec(vectorized=vectorized)
+    start = time.time()
+    data = codec.encode(*cols)
+    _report('%s: encode' % name, n / (time.time() - start) / 1e6,
+            'M samples/s')
+    start = time.time()
+    codec.decode(data, 0, n)
+    _report('%s: decode' % name, n / (time.time() - start) / 1e6,
+            'M samples/s')
+  _report('bytes per sample', len(data) / float(n), 'B')
+  _report('compression vs. v0.4 columns (21 B)', 21. * n / len(data), 'x')
+
+  lec = Lecture()
+  lec.append(Start(999., (640, 480)))
+  lec.append_samples(store.kinds, store.ts, store.xs, store.ys, store.ps)
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  try:
+    for v in ((0,4,0), (0,5,0)):
+      fileio.save(fname, lec, v)
+      _report('v%d.%d.%d file size' % v, os.path.getsize(fname) / 2.**20, 'MB')
+      start = time.time()
+      fileio.load(fname)
+      _report('v%d.%d.%d load' % v, time.time() - start, 's')
+  finally:
+    os.remove(fname)
+
+def bench_audio(blocks=24, seconds=30):
+  '''DCB save and load of a lecture with 'blocks' blocks of audio (16 kHz,
+  16-bit, 'seconds' long each), serial vs. on a worker per core.'''
+  import math, os, random, struct, tempfile
+  import multiprocessing
+  import fileio
+  print 'audio (%d blocks of %d s, %d cores)' % \
+      (blocks, seconds, multiprocessing.cpu_count())
+  rand = random.Random(1)
+  samples = struct.pack('<%dh' % (16000 * seconds), *[
+      int(8000 * math.sin(i / 20.) + rand.gauss(0, 500))
+      for i in xrange(16000 * seconds)])
+  lec = Lecture()
+  lec.append(Start(999., (640, 480)))
+  for i in xrange(blocks):
+    adat = AudioData(1000. + i * seconds)
+    adat.add_type(AudioData.RAW, samples[i:] + samples[:i])
+    lec.append(AudioRecord(adat.utime(), i, adat))
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  workers = fileio.AUDIO_WORKERS
+  try:
+    for fileio.AUDIO_WORKERS in (1, None):
+      name = 'serial' if fileio.AUDIO_WORKERS == 1 else 'parallel'
+      start = time.time()
+      fileio.save(fname, lec)
+      _report('%s: save' % name, time.time() - start, 's')
+      start = time.time()
+      fileio.load(fname)
+      _report('%s: load' % name, time.time() - start, 's')
+  finally:
+    fileio.AUDIO_WORKERS = workers
+    os.remove(fname)
+
+def bench_moves(n=100000):
+  '''Loading a DCB file with n pointer moves between as many pen samples:
+  the moves are merged into the timeline at the end of the load.  Compared
+  with inserting them one at a time, as the loader used to.'''
+  import os, struct, tempfile
+  import fileio
+  print 'moves (%d moves, %d pen samples)' % (n, n)
+  lec = Lecture()
+  lec.append(Start(999., (640, 480)))
+  for e in _synthetic_points(n): lec.append(e)
+  t0, t1 = lec.first().utime(), lec.last().utime()
+  moves = [Move(t0 + (t1 - t0) * i / n, (.5, .5)) for i in xrange(n)]
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  try:
+    # The v0.3 saver doesn't write moves, so put them in by hand: they go
+    # where the (empty) moves and audio sections were, at the end of the file.
+    fileio.save(fname, lec, (0,3,0))
+    data = open(fname, 'rb').read()[:-8]
+    data += struct.pack("<I", n)
+    data += ''.join(struct.pack("<Qff", m.t * 1000, .5, .5) for m in moves)
+    open(fname, 'wb').write(data + struct.pack("<I", 0))
+
+    start = time.time()
+    fileio.load(fname)
+    _report('load', time.time() - start, 's')
+
+    lec = fileio.load(fname)
+    lec.events = EventStore([e for e in lec if not isinstance(e, Move)])
+    start = time.time()
+    for m in moves[:1000]:
+      lec.events.insert(lec.events.index_of_time(m.t), m)
+    _report('insert one by one, per move',
+            (time.time() - start) / 1000 * 1e3, 'ms')
+  finally:
+    os.remove(fname)
+
+def bench_diagnostics(n=200000):
+  '''DCB v0.3 save and load of n pen samples at each Diagnostics level.'''
+  import os, tempfile
+  import fileio
+  print 'diagnostics (%d events)' % n
+  lec = Lecture()
+  lec.append(Start(999., (640, 480)))
+  for e in _synthetic_points(n): lec.append(e)
+  fd, fname = tempfile.mkstemp(suffix='.dcb')
+  os.close(fd)
+  try:
+    fileio.save(fname, lec, (0,3,0))  # builds the stroke and slide caches
+    for name in ('off', 'counts', 'sampled', 'full'):
+      diag = fileio.Diagnostics(fileio.Diagnostics.LEVELS[name])
+      start = time.time()
+      fileio.save(fname, lec, (0,3,0), diag=diag)
+      _report('save, %s' % name, time.time() - start, 's')
+      start = time.time()
+      fileio.load(fname, diag=diag)
+      _report('load, %s' % name, time.time() - start, 's')
+  finally:
+    for f in (fname, fname + '.save_log', fname + '.load_log'):
+      if os.path.exists(f): os.remove(f)
+
+
+BENCHMARKS = [('point_store', bench_point_store),
+              ('dispatch', bench_dispatch),
+              ('event_sizes', bench_event_sizes),
+              ('strokes', bench_strokes),
+              ('events_between', bench_events_between),
+              ('summaries', bench_summaries),
+              ('dcb_load', bench_dcb_load),
+              ('append', bench_append),
+              ('background_save', bench_background_save),
+              ('lazy', bench_lazy),
+              ('iter_events', bench_iter_events),
+              ('dcx_load', bench_dcx_load),
+              ('dcx_save', bench_dcx_save),
+              ('dct', bench_dct),
+              ('dar', bench_dar),
+              ('journal', bench_journal),
+              ('point_codec', bench_point_codec),
+              ('audio', bench_audio),
+              ('moves', bench_moves),
+              ('diagnostics', bench_diagnostics)]
+
+if __name__ == '__main__':
+  names = sys.argv[1:]
+  for name, fun in BENCHMARKS:
+    if len(names) == 0 or name in names:
+      fun()
@@ -15,6 +15,220 @@ class TestLecture(unittest.TestCase):
   def test_init(self):
     self.assertEqual(1, self.lec.aspect_ratio())
 
+  def _make_slides(self):
+    self.lec.append(Start(10, (800,600)))
+    self.lec.append(Click(11, (.1, .1)))
+    self.lec.append(Release(12, (.1, .2)))
+    self.lec.append(Color(13, (1., 0, 0)))
+    self.lec.append(Clear(20, None))
+    self.lec.append(Click(21, (.1, .1)))
+    self.lec.append(Release(22, (.1, .2)))
+
+  def test_last_slide(self):
+    self.assertEqual([], self.lec.last_slide())
+    self._make_slides()
+    self.assertEqual([21, 22], [e.utime() for e in self.lec.last_slide()])
+    self.lec.append(Clear(30, None))
+    self.assertEqual([], self.lec.last_slide())
+    self.assertEqual([10, 20, 30], self.lec.slide_times())
+
+  def test_slide_at_time(self):
+    self._make_slides()
+    self.assertEqual(0, self.lec.slide_at_time(5))
+    self.assertEqual(0, self.lec.slide_at_time(19.9))
+    self.assertEqual(4, self.lec.slide_at_time(20))
+    self.assertEqual(4, self.lec.slide_at_time(100))
+    self.assertEqual(4, self.lec.slide_start(6))
+    self.assertEqual(0, self.lec.slide_start(3))
+
+  def test_events_to_time(self):
+    self._make_slides()
+    it = self.lec.events_to_time(21)
+    self.assertEqual([20, 21], [e.utime() for e in it.events])
+    self.assertEqual((1., 0, 0), it.state.color)
+    it = self.lec.events_to_time(11.5)
+    self.assertEqual([10, 11], [e.utime() for e in it.events])
+    self.assertEqual(0, len(self.lec.events_to_time(1).events))
+
+  def test_slides_after_insert(self):
+    self._make_slides()
+    self.lec.events.insert(2, Clear(11.5, None))
+    self.assertEqual([10, 11.5, 20], self.lec.slide_times())
+    self.assertEqual(2, self.lec.slide_at_time(12))
+
+  def test_last(self):
+    self.assertEqual(None, self.lec.last(Color))
+    self._make_slides()
+    self.assertEqual(13, self.lec.last(Color).utime())
+    self.assertEqual(20, self.lec.last(Clear).utime())
+    self.assertEqual(10, self.lec.last(ScreenEvent).utime())
+    self.assertEqual(22, self.lec.last(Point).utime())
+    self.assertEqual(21, self.lec.last(Click).utime())
+    self.assertEqual(22, self.lec.last(Event).utime())
+    self.assertEqual(None, self.lec.last(Move))
+    self.assertEqual(20, self.lec.last((Clear, Color)).utime())
+
+  def test_last_after_pop(self):
+    self._make_slides()
+    self.lec.events.pop()
+    self.lec.events.pop()
+    self.assertEqual(11, self.lec.last(Click).utime())
+    self.assertEqual(20, self.lec.last(Event).utime())
+    self.lec.events.pop()
+    self.lec.events.pop()
+    self.assertEqual(None, self.lec.last(Clear))
+    self.assertEqual(12, self.lec.last(Point).utime())
+
+  def test_last_points(self):
+    self.assertEqual([], self.lec.last_points(2))
+    self._make_slides()
+    self.assertEqual([21, 22], [e.utime() for e in self.lec.last_points(2)])
+    self.assertEqual([22], [e.utime() for e in self.lec.last_points(1)])
+    self.lec.append(Move(23, (.0, .0)))
+    self.assertEqual([], self.lec.last_points(2))
+
+  def test_events_between(self):
+    self._make_slides()
+    self.assertEqual([11, 12, 13],
+                     [e.utime() for e in self.lec.events_between(10, 13)])
+    self.assertEqual([20, 21], list(self.lec.events_between(13, 21).times()))
+    self.assertEqual(0, len(self.lec.events_between(22, 30)))
+    self.assertEqual(0, len(self.lec.events_between(30, 20)))
+    points = self.lec.events_between(0, 100, Point)
+    self.assertEqual([1, 2, 5, 6], list(points.indexes()))
+    self.assertEqual(4, len(points))
+    self.assertEqual([Clear], [type(e) for e in
+                               self.lec.events_between(0, 100, Clear)])
+    self.assertFalse(self.lec.events_between(12, 100, (Start, Move)))
+
+  def test_merge(self):
+    self._make_slides()
+    moves = [Move(5, (0, 0)), Move(12, (.5, .5)), Move(21, (0, 0)),
+             Move(40, (1, 1))]
+    audio = [AudioRecord(12, 0, AudioData(12)),
+             AudioRecord(50, 1, AudioData(50))]
+    self.lec.merge(moves, audio, [])
+    self.assertEqual([Move, Start, Click, Release, Move, AudioRecord, Color,
+                      Clear, Click, Move, Release, Move, AudioRecord],
+                     [type(e) for e in self.lec])
+    self.assertEqual([5, 10, 11, 12, 12, 12, 13, 20, 21, 21, 22, 40, 50],
+                     [e.utime() for e in self.lec])
+    self.assertEqual((.5, .5), self.lec[4].pos)
+    self.assertEqual(2, len(self.lec.strokes()))
+    self.assertEqual([0, 4, 9, 11],
+                     list(self.lec.events_between(0, 100, Move).indexes()))
+    self.lec.merge([])
+    self.assertEqual(13, len(self.lec))
+
+  def test_strokes(self):
+    self.assertEqual([], self.lec.strokes())
+    self._make_slides()
+    self.lec.append(Thickness(23, .5))
+    self.lec.append(Click(24, (.3, .3)))
+    self.lec.append(Point(25, (.6, .7), .5))
+    strokes = self.lec.strokes()
+    self.assertEqual([(1, 3), (5, 7), (8, 10)],
+                     [(s.start, s.end) for s in strokes])
+    self.assertEqual([True, True, False], [s.closed for s in strokes])
+    self.assertEqual((0, 0, 0), strokes[0].color)
+    self.assertEqual((1., 0, 0), strokes[1].color)
+    self.assertEqual(.5, strokes[2].thickness)
+    self.assertEqual((.1, .1, .1, .2), strokes[0].bbox())
+    self.assertAlmostEqual(.1, strokes[0].length)
+    self.assertEqual(1, strokes[0].duration())
+
+    # The open stroke is extended, not rebuilt.
+    self.lec.append(Release(26, (.6, .3)))
+    stroke = self.lec.strokes()[-1]
+    self.assertTrue(stroke is strokes[2])
+    self.assertTrue(stroke.closed)
+    self.assertEqual(3, stroke.num_points)
+    self.assertEqual((.3, .3, .6, .7), stroke.bbox())
+    self.assertAlmostEqual(.9, stroke.length)
+    self.assertEqual([24, 25, 26], [p.utime() for p in stroke.points()])
+
+  def test_strokes_after_insert(self):
+    self._make_slides()
+    strokes = self.lec.strokes()
+    self.lec.events.insert(5, Color(20.5, (0, 1., 0)))
+    self.assertTrue(self.lec.strokes()[0] is strokes[0])
+    self.assertEqual((0, 1., 0), self.lec.strokes()[1].color)
+    self.assertEqual((6, 8), (self.lec.strokes()[1].start,
+                              self.lec.strokes()[1].end))
+
+  def test_slides(self):
+    self.assertEqual([], self.lec.slides())
+    self._make_slides()
+    slides = self.lec.slides()
+    self.assertEqual([(0, 4), (4, 7)], [(s.start, s.end) for s in slides])
+    self.assertEqual([10, 20], [s.t for s in slides])
+    self.assertEqual([1, 1], [len(s.strokes) for s in slides])
+    self.assertEqual((800, 600), slides[1].size)
+    self.assertEqual(2, slides[1].num_points)
+    self.assertEqual(3, slides[0].duration())
+    self.assertEqual((.1, .1, .1, .2), slides[1].bbox())
+    self.assertEqual(frozenset([(1., 0, 0)]), slides[1].colors)
+
+    # Slides are extended in place as events come in.
+    self.lec.append(Clear(30, None))
+    self.lec.append(Click(31, (.5, .5)))
+    self.lec.append(Point(32, (.6, .4), .5))
+    new_slides = self.lec.slides()
+    self.assertTrue(new_slides[1] is slides[1])
+    self.assertEqual((4, 7), (slides[1].start, slides[1].end))
+    self.assertEqual([10, 20, 30], [s.t for s in new_slides])
+    self.assertEqual(2, new_slides[2].num_points)
+    self.lec.append(Release(33, (.7, .3)))
+    self.assertEqual(3, self.lec.slides()[2].num_points)
+    self.assertEqual((.5, .3, .7, .5), self.lec.slides()[2].bbox())
+    self.assertEqual(3, self.lec.slides()[2].duration())
+
+  def test_slides_after_change(self):
+    self._make_slides()
+    slides = self.lec.slides()
+    self.lec.events.insert(6, Point(21.5, (.9, .9), .5))
+    new_slides = self.lec.slides()
+    self.assertTrue(new_slides[0] is slides[0])
+    self.assertEqual(3, new_slides[1].num_points)
+    self.assertEqual((.1, .1, .9, .9), new_slides[1].bbox())
+    self.lec.events.pop(4)  # the Clear
+    self.assertEqual([(0, 7)], [(s.start, s.end) for s in self.lec.slides()])
+    self.assertEqual(2, len(self.lec.slides()[0].strokes))
+    self.assertEqual(5, self.lec.slides()[0].num_points)
+
+  def test_slide_summaries(self):
+    self._make_slides()
+    summary = self.lec.slide_summaries()[1]
+    self.assertEqual(20, summary['t'])
+    self.assertEqual(22, summary['t_end'])
+    self.assertEqual(1, summary['strokes'])
+    self.assertEqual(2, summary['points'])
+    self.assertEqual([(1., 0, 0)], summary['colors'])
+
+  def test_slides_without_start(self):
+    self.lec.append(Click(1, (.1, .1)))
+    self.lec.append(Release(2, (.2, .1)))
+    self.lec.append(Clear(3, None))
+    self.assertEqual([(0, 2), (2, 3)],
+                     [(s.start, s.end) for s in self.lec.slides()])
+
+  def test_snapshot(self):
+    self._make_slides()
+    self.lec.resize((640, 480), 23)
+    snap = self.lec.snapshot()
+    self.lec.append(Click(24, (.3, .3)))
+    self.lec.resize((320, 240), 25)  # changes the Resize in place
+    self.lec.set_time(1, 11.5)
+    self.assertEqual(8, len(snap))
+    self.assertEqual(11, snap[1].utime())
+    self.assertEqual((640, 480), snap[-1].size)
+    self.assertEqual((640, 480), snap.state.win_sz)
+    self.assertEqual([10, 20], snap.slide_times())
+    self.assertEqual(2, len(snap.strokes()))
+    self.assertEqual((1., 0, 0), snap.state_at(8).color)
+    snap.append(Clear(30, None))
+    self.assertEqual([10, 20], self.lec.slide_times())
+
 class TestLectureState(unittest.TestCase):
   def setUp(self):
     self.state = Lecture.State()
@@ -30,6 +244,235 @@ class TestLectureIterator(unittest.TestCase):
     iterator = iter(Lecture())
     self.assertRaises(StopIteration, next, iterator)
 
+  def _make_lecture(self):
+    lec = Lecture()
+    lec.append(Start(10, (800,600)))
+    lec.append(Click(11, (.1, .1)))
+    lec.append(Point(12, (.2, .2), .5))
+    lec.append(Point(12, (.3, .3), .5))
+    lec.append(Release(13, (.4, .4)))
+    return lec
+
+  def test_seek_to_time(self):
+    it = iter(self._make_lecture())
+    it.seek_to_time(2)
+    self.assertEqual(4, it.i)  # both events at t=12 are behind us
+    it.seek_to_time(1.5)
+    self.assertEqual(2, it.i)
+    it.seek_to_time(-1)
+    self.assertEqual(0, it.i)
+    it.seek_to_time(100)
+    self.assertFalse(it.has_next())
+
+  def test_seek_with_placeholders(self):
+    lec = self._make_lecture()
+    lec.append(Color(-1, (1., 0, 0)))
+    lec.append(Click(20, (.1, .1)))
+    lec.append(Release(21, (.1, .1)))
+    it = iter(lec)
+    it.seek_to_time(5)  # the -1 stays with the events before it
+    self.assertEqual(6, it.i)
+    lec.set_time(lec.last_index(Color), 20)
+    self.assertEqual(20, lec[5].utime())
+    it.seek_to_time(5)
+    self.assertEqual(5, it.i)
+    it.seek_to_time(10)
+    self.assertEqual(7, it.i)
+
+  def test_seek_restores_state(self):
+    lec = Lecture()
+    lec.append(Start(0, (800,600)))
+    colors = [(i / 1000., .0, .0) for i in xrange(1000)]
+    for i in xrange(1000):
+      lec.append(Color(i + .5, colors[i]))
+      lec.append(Thickness(i + .5, i / 1000.))
+      lec.append(Point(i + .7, (.5, .5), 1.))
+    self.assertTrue(len(lec._ck_idx) > 1)
+    it = iter(lec)
+    for t in [0, 1, 499.6, 499.8, 999, 2000, 10]:
+      it.seek_to_time(t)
+      ref = iter(lec)
+      while ref.has_next() and ref.peek().utime() <= t: ref.next()
+      self.assertEqual(ref.i, it.i)
+      self.assertEqual(ref.state.color, it.state.color)
+      self.assertEqual(ref.state.thickness, it.state.thickness)
+      self.assertEqual((800,600), it.state.win_sz)
+
+  def test_state_after_insert(self):
+    lec = self._make_lecture()
+    lec.append(Color(14, (1., 0, 0)))
+    lec.append(Click(15, (.1, .1)))
+    self.assertEqual((1., 0, 0), lec.state_at(6).color)
+    lec.events.insert(1, Color(10, (0, 1., 0)))
+    self.assertEqual((0, 1., 0), lec.state_at(2).color)
+    self.assertEqual((1., 0, 0), lec.state_at(7).color)
+    lec.events.pop(1)
+    self.assertEqual((.0, .0, .0), lec.state_at(2).color)
+
+  def test_seek_after_insert(self):
+    lec = self._make_lecture()
+    lec.events.insert(1, Move(10.5, (.0, .0)))
+    it = iter(lec)
+    it.seek_to_time(.5)
+    self.assertEqual(2, it.i)
+    lec.events.pop(1)
+    it.seek_to_time(.5)
+    self.assertEqual(1, it.i)
+
+class TestEventStore(unittest.TestCase):
+  def setUp(self):
+    self.store = EventStore()
+    self.store.append(Start(10, (800,600)))
+    self.store.append(Click(11, (.1, .2)))
+    self.store.append(Point(12, (.2, .3), .5))
+    self.store.append(Release(13, (.3, .4)))
+    self.store.append(Move(14, (.4, .5)))
+
+  def test_materialize(self):
+    self.assertEqual(5, len(self.store))
+    self.assertTrue(isinstance(self.store[0], Start))
+    self.assertTrue(isinstance(self.store[1], Click))
+    self.assertTrue(isinstance(self.store[3], Release))
+    p = self.store[2]
+    self.assertEqual(Point, type(p))
+    self.assertEqual((12, (.2, .3), .5), (p.t, p.pos, p.p))
+    m = self.store[-1]
+    self.assertEqual(Move, type(m))
+    self.assertEqual((.4, .5), m.pos)
+    self.assertRaises(IndexError, self.store.__getitem__, 5)
+    self.assertRaises(IndexError, self.store.__getitem__, -6)
+
+  def test_objects_kept(self):
+    s = Start(1, (1,1))
+    self.store.append(s)
+    self.assertTrue(self.store[-1] is s)
+
+  def test_insert_pop(self):
+    self.store.insert(1, Color(10, (1., 0, 0)))
+    self.assertTrue(isinstance(self.store[1], Color))
+    self.assertTrue(isinstance(self.store[2], Click))
+    e = self.store.pop(1)
+    self.assertTrue(isinstance(e, Color))
+    self.assertEqual(1, len(self.store.objs))
+    self.assertEqual([10, 11, 12, 13, 14], [e.utime() for e in self.store])
+    self.assertEqual([14, 13], [e.utime() for e in reversed(self.store)][:2])
+    self.assertEqual([12, 13], [e.utime() for e in self.store[2:4]])
+
+  def test_pop(self):
+    # Only pen samples: there are no objects to drop.
+    store = EventStore([Click(1, (.1, .2)), Point(2, (.2, .3), .5),
+                        Release(3, (.3, .4))])
+    self.assertEqual(Release, type(store.pop()))
+    self.assertEqual(Click, type(store.pop(0)))
+    self.assertEqual([2], [e.utime() for e in store])
+    self.assertEqual([], store.objs)
+
+    # An object in the middle: the ones after it still come back right.
+    self.store.insert(2, Color(11, (1., 0, 0)))
+    self.store.append(Thickness(15, .5))
+    self.assertEqual(Start, type(self.store.pop(0)))
+    self.assertEqual(2, len(self.store.objs))
+    self.assertEqual([Click, Color, Point, Release, Move, Thickness],
+                     [type(e) for e in self.store])
+    self.assertEqual(.5, self.store[-1].thickness)
+    self.assertEqual((1., 0, 0), self.store.pop(1).color)
+    self.assertEqual(.5, self.store[-1].thickness)
+    self.assertEqual(1, len(self.store.objs))
+
+  def test_time_at(self):
+    self.assertEqual(10, self.store.time_at(0))
+    self.assertEqual(14, self.store.time_at(-1))
+
+class TestEvent(unittest.TestCase):
+  def test_palette(self):
+    a = Color(1, (1., 0, 0))
+    b = Color(2, [1., 0, 0])
+    self.assertTrue(a.color is b.color)
+    self.assertEqual((1., 0, 0), b.color)
+    self.assertFalse(a.color is Color(3, (1, 0, 0)).color)
+    self.assertTrue(Thickness(1, .25).thickness is Thickness(2, .25).thickness)
+
+  def test_pickle(self):
+    import pickle
+    events = [Point(1, (.1, .2), .5), Release(2, (.3, .4)),
+              Color(3, (0, 1., 0)), Resize(4, (800, 600))]
+    for proto in xrange(pickle.HIGHEST_PROTOCOL + 1):
+      copies = pickle.loads(pickle.dumps(events, proto))
+      self.assertEqual([type(e) for e in events], [type(e) for e in copies])
+      self.assertEqual((.1, .2), copies[0].pos)
+      self.assertEqual(.5, copies[0].p)
+      self.assertTrue(events[2].color is copies[2].color)
+      self.assertEqual((800, 600), copies[3].size)
+
+  def test_no_dict(self):
+    self.assertRaises(AttributeError, setattr, Point(1, (0, 0), 1), 'foo', 1)
+
+class TestDispatcher(unittest.TestCase):
+  def test_closest_class(self):
+    d = Dispatcher({Point: 'point', Click: 'click', ScreenEvent: 'screen'},
+                   'other')
+    self.assertEqual('click', d[Click(1, (0, 0))])
+    self.assertEqual('point', d[Release(1, (0, 0))])
+    self.assertEqual('screen', d[Resize(1, (800, 600))])
+    self.assertEqual('other', d[Color(1, (0, 0, 0))])
+
+  def test_call(self):
+    d = Dispatcher({Thickness: lambda a, e: a + e.thickness})
+    self.assertEqual(3, d(1, Thickness(1, 2)))
+
+  def test_kinds_unique(self):
+    self.assertEqual(range(len(EVENT_TYPES)),
+                     [cls.kind for cls in EVENT_TYPES])
+
+
+class TestPointCodec(unittest.TestCase):
+  def setUp(self):
+    self.ts = [1300000000.25 + i * .011 for i in xrange(300)]
+    self.xs = [.5 + (i % 17) / 1000. for i in xrange(300)]
+    self.ys = [.5 - i / 1000. for i in xrange(300)]
+    self.ps = [(i % 5) / 4. for i in xrange(300)]
+
+  def _codecs(self):
+    yield PointCodec(vectorized=False)
+    if use_numpy:
+      yield PointCodec(vectorized=True)
+
+  def test_round_trip(self):
+    for codec in self._codecs():
+      data = codec.encode(self.ts, self.xs, self.ys, self.ps)
+      (ts, xs, ys, ps), off = codec.decode(data + 'more', 0, 300)
+      self.assertEqual(len(data), off)
+      self.assertEqual(array.array('d', self.ts), ts)  # all on the grid
+      self.assertEqual(array.array('d', self.ps), ps)
+      for x, y in zip(self.xs + self.ys, xs + ys):
+        self.assertAlmostEqual(x, y, 4)
+
+  def test_size(self):
+    data = PointCodec().encode(self.ts, self.xs, self.ys, self.ps)
+    self.assertTrue(len(data) < 300 * 8)  # vs. 21 bytes a sample in DCB v0.4
+
+  def test_grid(self):
+    codec = PointCodec(t_res=10, xy_res=4, p_res=2, vectorized=False)
+    (ts, xs, ys, ps), off = codec.decode(
+        codec.encode([1.04, -1.06], [.3, .4], [-.3, 7.], [.7, .2]), 0, 2)
+    self.assertEqual(array.array('d', [1., -1.1]), ts)
+    self.assertEqual(array.array('d', [.25, .5]), xs)
+    self.assertEqual(array.array('d', [-.25, 7.]), ys)
+    self.assertEqual(array.array('d', [.5, 0.]), ps)
+
+  def test_vectorized(self):
+    if not use_numpy: return
+    data = PointCodec(vectorized=False).encode(self.ts, self.xs, self.ys,
+                                               self.ps)
+    self.assertEqual(data, PointCodec(vectorized=True).encode(
+        self.ts, self.xs, self.ys, self.ps))
+
+  def test_errors(self):
+    for codec in self._codecs():
+      data = codec.encode(self.ts, self.xs, self.ys, self.ps)
+      self.assertRaises(PointCodec.Error, codec.decode, data[:-1], 0, 300)
+      self.assertEqual([array.array('d')] * 4, codec.decode('', 0, 0)[0])
+
 
 if __name__ == "__main__":
   #import sys;sys.argv = ['', 'Test.testName']
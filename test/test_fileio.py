@@ -4,21 +4,31 @@ Created on Sep 23, 2011
 @author: jamoozy
 '''
 import unittest
+import os
 import sys
 sys.path.append("../src")
 import fileio
 import tempfile
+import zipfile
+import struct
+import base64
+import time
+import StringIO
 import datatypes
 
 class TestDCT(unittest.TestCase):
   def setUp(self):
     self.dct = fileio.DCT(tempfile.NamedTemporaryFile(prefix='TestDCT-').name)
 
+  def tearDown(self):
+    if os.path.exists(self.dct.fname):
+      os.remove(self.dct.fname)
+
   def test_init(self):
     self.assertNotEqual(None, self.dct.fname)
     self.assertEqual(fileio.DEFAULT_VERSION, self.dct.v)
     self.assertEqual(None, self.dct.fp)
-    self.assertEqual(None, self.dct.log)
+    self.assertFalse(self.dct.diag.counting)
     self.assertEqual(None, self.dct.lec)
 
   def test_simple_lecture(self):
@@ -37,6 +47,38 @@ class TestDCT(unittest.TestCase):
     l2 = self.dct.load()
     self.assertFalse(l2.is_empty())
 
+  def test_members(self):
+    lec = datatypes.Lecture()
+    lec.append(datatypes.Clear(10., None))
+    lec.append(datatypes.Color(11., (1., 0, 0)))
+    lec.append(datatypes.Click(11., (.25, .5)))
+    lec.append(datatypes.Point(11.5, (.25, .75), .5))
+    lec.append(datatypes.Release(12., (.75, 1)))
+    audio = datatypes.AudioData(14.)
+    audio.add_type(datatypes.AudioData.RAW, ['abc', 'def'])
+    lec.append(datatypes.AudioRecord(14., 0, audio))
+    lec.append(datatypes.Clear(20., None))
+    lec.append(datatypes.Color(21., (1., 0, 0)))  # each stroke has its own
+    lec.append(datatypes.Click(21., (.5, .5)))
+    lec.append(datatypes.Release(22., (.5, .75)))
+    self.dct.save(lec)
+
+    loaded = self.dct.load()
+    self.assertEqual([(type(e), e.utime()) for e in lec],
+                     [(type(e), e.utime()) for e in loaded])
+    self.assertEqual(.5, loaded[3].p)
+    self.assertEqual('abcdef',
+                     loaded.adats[0].dats[datatypes.AudioData.RAW])
+    self.assertEqual([(type(e), e.utime()) for e in loaded],
+                     [(type(e), e.utime()) for e in
+                      self.dct.iter_events()])
+
+    self.assertEqual(2, self.dct.num_slides())
+    slide = self.dct.load_slide(1)
+    self.assertEqual([datatypes.Clear, datatypes.Color, datatypes.Click,
+                      datatypes.Release], [type(e) for e in slide])
+    self.assertEqual([14.], [a.utime() for a in self.dct.load_audio()])
+
 class TestDCB(unittest.TestCase):
   def setUp(self):
     self.dcb = fileio.DCB(tempfile.NamedTemporaryFile(prefix='TestDCB-').name)
@@ -45,7 +87,7 @@ class TestDCB(unittest.TestCase):
     self.assertNotEqual(None, self.dcb.fname)
     self.assertEqual(fileio.DEFAULT_VERSION, self.dcb.v)
     self.assertEqual(None, self.dcb.fp)
-    self.assertEqual(None, self.dcb.log)
+    self.assertFalse(self.dcb.diag.counting)
     self.assertEqual(None, self.dcb.lec)
 
   def test_simple_lecture(self):
@@ -66,6 +108,415 @@ class TestDCB(unittest.TestCase):
 
     self.assertFalse(l2.is_empty())
 
+  def test_round_trip_v3(self):
+    self.dcb.v = (0,3,0)
+    lec = datatypes.Lecture()
+    lec.append(datatypes.Start(12.345, (500,400)))
+    lec.append(datatypes.Color(12.345, (1, 0, 0)))
+    lec.append(datatypes.Click(12.678, (.25, .5)))
+    lec.append(datatypes.Point(16.789, (.25, .75), .5))
+    lec.append(datatypes.Release(34.567, (.75, 1)))
+
+    self.dcb.save(lec)
+    l2 = self.dcb.load()
+    self.assertEqual([datatypes.Clear, datatypes.Color, datatypes.Click,
+                      datatypes.Point, datatypes.Release],
+                     [type(e) for e in l2])
+    self.assertEqual([12.345, 12.678, 12.678, 16.789, 34.567],
+                     [e.utime() for e in l2])
+    self.assertEqual([(.25, .5), (.25, .75), (.75, 1)],
+                     [e.pos for e in l2[2:]])
+    self.assertEqual(.5, l2[3].p)
+    self.assertEqual((1, 0, 0), l2[1].color)
+
+  def _write(self, v, points, moves=()):
+    '''Writes a DCB file of version v by hand: one slide at 1s with one
+    stroke of the given (t_ms, x, y, p) points, and the given moves.'''
+    f = open(self.dcb.fname, 'wb')
+    f.write(fileio.MAGIC_NUMBER + struct.pack("<III", *v))
+    if v[1] >= 2:
+      f.write(struct.pack("<f", 4/3.))
+    f.write(struct.pack("<IQII", 1, 1000, 1, len(points)))
+    if v == (0,2,0):
+      f.write(struct.pack("<ff", 4/3., .25))
+    f.write(struct.pack("<fff", 0, 0, 1))
+    for i, (t, x, y, p) in enumerate(points):
+      if v[1] >= 3 and i in (0, len(points) - 1):
+        f.write(struct.pack("<Qff", t, x, y))
+      else:
+        f.write(struct.pack("<Qfff", t, x, y, p))
+    f.write(struct.pack("<I", len(moves)))
+    for m in moves:
+      f.write(struct.pack("<Qff", *m))
+    if v != (0,1,0):
+      f.write(struct.pack("<I", 0))  # no audio
+    f.close()
+
+  def test_versions(self):
+    points = [(2000, .5, .5, .5), (2500, .5, .75, .5), (3000, .75, .75, .5),
+              (3500, .75, 1, .5)]
+    pressures = {(0,1,0): [], (0,1,1): [1., 1.], (0,1,2): [1.414214, 1.414214],
+                 (0,2,0): [.5, .5], (0,3,0): [.5, .5]}
+    for v in fileio.VALID_VERSIONS:
+      if v[1] >= 4: continue  # chunked: see TestDCB4
+      self._write(v, points, [(2700, .1, .1)])
+      lec = self.dcb.load()
+      self.assertEqual(v, self.dcb.v)
+      clicks = [e for e in lec if isinstance(e, datatypes.Click)]
+      self.assertEqual([2.], [e.utime() for e in clicks])
+      mid = [e for e in lec if type(e) is datatypes.Point]
+      self.assertEqual(pressures[v], [round(e.p, 6) for e in mid])
+      self.assertEqual(3.5, lec.last(datatypes.Release).utime())
+      self.assertEqual(2., lec.last(datatypes.Color).utime())
+      self.assertEqual(1, len(lec.strokes()))
+      times = [e.utime() for e in lec]
+      self.assertEqual(sorted(times), times)
+      self.assertEqual([2.7], list(lec.events_between(0, 10,
+                                                      datatypes.Move).times()))
+      if v[1] < 2:
+        self.assertAlmostEqual(.5, lec.state.thickness)
+      if v == (0,2,0):
+        self.assertEqual(.25, lec.last(datatypes.Thickness).thickness)
+
+  def test_truncated(self):
+    self._write((0,3,0), [(2000, .5, .5, .5)] * 10)
+    data = open(self.dcb.fname, 'rb').read()
+    open(self.dcb.fname, 'wb').write(data[:len(data) // 2])
+    self.assertRaises(fileio.FormatError, self.dcb.load)
+
+  def test_diagnostics_off(self):
+    self._write((0,3,0), [(2000, .5, .5, .5)] * 10)
+    self.dcb.load()
+    self.dcb.save(self.dcb.load())
+    self.assertFalse(os.path.exists(self.dcb.fname + '.load_log'))
+    self.assertFalse(os.path.exists(self.dcb.fname + '.save_log'))
+    self.assertEqual({}, self.dcb.diag.records)
+
+  def test_diagnostics_counts(self):
+    self._write((0,3,0), [(2000, .5, .5, .5)] * 10,
+                [(2700, .1, .1)] * 3)
+    diag = fileio.Diagnostics(fileio.Diagnostics.COUNTS)
+    fileio.DCB(self.dcb.fname, diag=diag).load()
+    self.assertEqual({'slide': 1, 'stroke': 1, 'point': 10, 'move': 3},
+                     diag.records)
+    self.assertEqual(os.path.getsize(self.dcb.fname),
+                     sum(diag.bytes.values()))
+    self.assertEqual(['audio', 'header', 'moves', 'slides'],
+                     sorted(diag.times))
+    self.assertFalse(os.path.exists(self.dcb.fname + '.load_log'))
+
+  def test_diagnostics_trace(self):
+    self._write((0,3,0), [(2000, .5, .5, .5)] * 10)
+    out = StringIO.StringIO()
+    fileio.DCB(self.dcb.fname,
+               diag=fileio.Diagnostics(fileio.Diagnostics.FULL, out)).load()
+    self.assertEqual(8, out.getvalue().count('point ('))
+    out = StringIO.StringIO()
+    fileio.DCB(self.dcb.fname, diag=fileio.Diagnostics(
+        fileio.Diagnostics.SAMPLED, out, 3)).load()
+    self.assertEqual(3, out.getvalue().count('point ('))
+
+    diag = fileio.Diagnostics(fileio.Diagnostics.FULL)
+    fileio.DCB(self.dcb.fname, diag=diag).load()
+    self.assertTrue(os.path.exists(self.dcb.fname + '.load_log'))
+    os.remove(self.dcb.fname + '.load_log')
+
+  def test_diagnostics_env(self):
+    os.environ['DESKCORDER_DIAG'] = 'sampled:7'
+    try:
+      diag = fileio.DCB(self.dcb.fname).diag
+      self.assertEqual(fileio.Diagnostics.SAMPLED, diag.level)
+      self.assertEqual(7, diag.sample)
+    finally:
+      del os.environ['DESKCORDER_DIAG']
+    self.assertEqual(fileio.Diagnostics.OFF, fileio.DCB(self.dcb.fname).diag.level)
+
+class TestDCB4(unittest.TestCase):
+  '''Chunked DCB files (v0.4+).'''
+  def setUp(self):
+    self.fname = tempfile.NamedTemporaryFile(prefix='TestDCB4-',
+                                             suffix='.dcb').name
+    self.lec = datatypes.Lecture()
+    self.lec.append(datatypes.Start(10., (800, 600)))
+    self.lec.append(datatypes.Color(10., (1., 0, 0)))
+    self.lec.append(datatypes.Thickness(10., .25))
+    self.lec.append(datatypes.Click(11., (.25, .5)))
+    self.lec.append(datatypes.Point(11.5, (.25, .75), .5))
+    self.lec.append(datatypes.Release(12., (.75, 1)))
+    self.lec.append(datatypes.Move(13., (.5, .5)))
+    audio = datatypes.AudioData(14.)
+    audio.add_type(datatypes.AudioData.RAW, 'abc' * 100)
+    self.lec.append(datatypes.AudioRecord(14., 0, audio))
+    self.lec.append(datatypes.Clear(20., (1., 1., 1.)))
+    self.lec.resize((640, 480), 20.5)
+    self.lec.append(datatypes.Click(21., (.5, .5)))
+    self.lec.append(datatypes.Release(22., (.5, .75)))
+    self.lec.append(datatypes.End(30., (640, 480)))
+
+  def tearDown(self):
+    if os.path.exists(self.fname):
+      os.remove(self.fname)
+
+  def test_round_trip(self):
+    fileio.save(self.fname, self.lec, (0,4,0))
+    lec = fileio.DCB(self.fname).load()
+    self.assertEqual([type(e) for e in self.lec], [type(e) for e in lec])
+    self.assertEqual([e.utime() for e in self.lec], [e.utime() for e in lec])
+    self.assertEqual([e.pos for e in self.lec if hasattr(e, 'pos')],
+                     [e.pos for e in lec if hasattr(e, 'pos')])
+    self.assertEqual(.5, lec[4].p)
+    self.assertEqual((1., 0, 0), lec[1].color)
+    self.assertEqual(.25, lec[2].thickness)
+    self.assertEqual((1., 1., 1.), lec[8].bg)
+    self.assertEqual((640, 480), lec[9].size)
+    self.assertEqual((640, 480), lec.state.win_sz)
+    self.assertEqual(1, len(lec.adats))
+    self.assertEqual('abc' * 100, lec.adats[0].dats[datatypes.AudioData.RAW])
+    self.assertTrue(lec[7].get_media() is lec.adats[0])
+    self.assertEqual(2, len(lec.slides()))
+
+  def test_index(self):
+    fileio.save(self.fname, self.lec, (0,4,0))
+    index = fileio.DCB(self.fname).index()
+    self.assertEqual(['HEAD', 'STAT', 'SLID', 'STAT', 'SLID', 'AUDI'],
+                     [entry[0] for entry in index])
+    self.assertEqual([(10., 14.), (20., 30.)],
+                     [entry[3:] for entry in index if entry[0] == 'SLID'])
+    data = open(self.fname, 'rb').read()
+    for tag, off, length, t0, t1 in index:
+      self.assertEqual((tag, length), struct.unpack_from("<4sQ", data, off))
+    fileio.save(self.fname, self.lec, (0,3,0))
+    self.assertRaises(fileio.FormatError, fileio.DCB(self.fname).index)
+
+  def test_summaries(self):
+    fileio.save(self.fname, self.lec, (0,4,0))
+    self.assertEqual(None, fileio.load_summaries(self.fname))
+    fileio.save(self.fname, self.lec, (0,4,0), summaries=True)
+    summaries = fileio.load_summaries(self.fname)
+    self.assertEqual([10., 20.], [s['t'] for s in summaries])
+    self.assertEqual([3, 2], [s['points'] for s in summaries])
+
+  def test_truncated(self):
+    fileio.save(self.fname, self.lec, (0,4,0))
+    data = open(self.fname, 'rb').read()
+    index = fileio.DCB(self.fname).index()
+    # Cut into the second slide: everything before it is still there, but
+    # for the audio, which came after it.
+    open(self.fname, 'wb').write(data[:index[4][1] + 20])
+    lec = fileio.DCB(self.fname).load()
+    self.assertEqual(7, len(lec))
+    self.assertEqual(datatypes.Move, type(lec[-1]))
+    self.assertEqual(0, len(lec.adats))
+
+  def test_truncated_v5(self):
+    # Without the trailer, the slides' times come from their packed columns.
+    fileio.save(self.fname, self.lec, (0,5,0))
+    whole = [(type(e), e.utime())
+             for e in fileio.iter_events(self.fname, 19.5, 25.)]
+    upto = len(fileio.LazyLecture(self.fname).events_to_time(21.5).events)
+    data = open(self.fname, 'rb').read()
+    index = fileio.DCB(self.fname).index()
+    end = max(off + fileio.DCB.CHUNK.size + length
+              for tag, off, length, t0, t1 in index)
+    open(self.fname, 'wb').write(data[:end])
+    lazy = fileio.load(self.fname, lazy=True)
+    self.assertTrue(isinstance(lazy, fileio.LazyLecture))
+    self.assertEqual([10., 20.], [slide.t for slide in lazy.slides()])
+    self.assertEqual(upto, len(lazy.events_to_time(21.5).events))
+    self.assertEqual(whole, [(type(e), e.utime()) for e in
+                             fileio.iter_events(self.fname, 19.5, 25.)])
+    self.assertNotEqual([], whole)
+    self.assertTrue(upto > 0)
+
+  def test_round_trip_v5(self):
+    fileio.save(self.fname, self.lec, (0,4,0))
+    size = os.path.getsize(self.fname)
+    fileio.save(self.fname, self.lec, (0,5,0))
+    self.assertTrue(os.path.getsize(self.fname) < size)
+    for lec in (fileio.DCB(self.fname).load(), fileio.LazyLecture(self.fname)):
+      self.assertEqual([type(e) for e in self.lec], [type(e) for e in lec])
+      self.assertEqual([e.utime() for e in self.lec],
+                       [e.utime() for e in lec])
+      self.assertEqual([e.pos for e in self.lec if hasattr(e, 'pos')],
+                       [e.pos for e in lec if hasattr(e, 'pos')])
+      self.assertEqual(.5, lec[4].p)
+      self.assertEqual('abc' * 100,
+                       lec[7].get_media().dats[datatypes.AudioData.RAW])
+
+    # The grid is saved with the file.
+    fileio.save(self.fname, self.lec, (0,5,0),
+                codec=datatypes.PointCodec(t_res=1, xy_res=2))
+    lec = fileio.load(self.fname)
+    self.assertEqual([11., 12., 12.], [e.utime() for e in lec[3:6]])
+    self.assertEqual((.5, .5), lec[3].pos)
+
+  def test_parallel_audio(self):
+    for i in xrange(4):
+      audio = datatypes.AudioData(40. + i)
+      audio.add_type(datatypes.AudioData.RAW, str(i) * 1000)
+      self.lec.append(datatypes.AudioRecord(40. + i, i + 1, audio))
+    workers = fileio.AUDIO_WORKERS, fileio.PARALLEL_AUDIO_BYTES
+    try:
+      fileio.AUDIO_WORKERS, fileio.PARALLEL_AUDIO_BYTES = 2, 0
+      fileio.save(self.fname, self.lec)
+      parallel = open(self.fname, 'rb').read()
+      lec = fileio.load(self.fname)
+      self.assertEqual([str(i) * 1000 for i in xrange(4)],
+          [adat.dats[datatypes.AudioData.RAW] for adat in lec.adats[1:]])
+      fileio.AUDIO_WORKERS = 1
+      fileio.save(self.fname, self.lec)
+      self.assertEqual(parallel, open(self.fname, 'rb').read())
+    finally:
+      fileio.AUDIO_WORKERS, fileio.PARALLEL_AUDIO_BYTES = workers
+
+  def test_lazy(self):
+    fileio.save(self.fname, self.lec, (0,4,0))
+    lec = fileio.load(self.fname, lazy=True)
+    self.assertTrue(isinstance(lec, fileio.LazyLecture))
+    self.assertEqual(len(self.lec), len(lec))
+    self.assertEqual([10., 20.], [slide.t for slide in lec.slides()])
+    self.assertEqual(20., lec.duration())
+    self.assertEqual(0, len(lec._cache))  # nothing decoded yet
+
+    # The second slide, on its own, starts out with the color and thickness
+    # set on the first.
+    stroke = lec.slides()[1].strokes[0]
+    self.assertEqual(1, len(lec._cache))
+    self.assertEqual((1., 0, 0), stroke.color)
+    self.assertEqual(.25, stroke.thickness)
+    self.assertEqual(self.lec.slides()[1].summary(),
+                     lec.slides()[1].summary())
+    self.assertEqual([type(e) for e in self.lec], [type(e) for e in lec])
+    self.assertEqual(datatypes.Release, type(lec[-2]))
+    self.assertEqual((640, 480), lec.state.win_sz)
+    self.assertEqual(2, len(lec.strokes()))
+    self.assertEqual([st.t0 for st in self.lec.strokes()],
+                     [st.t0 for st in lec.strokes()])
+    self.assertEqual([st.t0 for st in lec.strokes()],
+                     [st.t0 for st in lec.iter_strokes()])
+    self.assertEqual(
+        [e.utime() for e in self.lec.events_between(11., 21., datatypes.Point)],
+        [e.utime() for e in lec.events_between(11., 21., datatypes.Point)])
+    it = lec.events_to_time(21.5)
+    self.assertEqual((1., 0, 0), it.state.color)
+    self.assertEqual(datatypes.Clear, type(it.next()))
+    self.assertEqual(1, len(lec.adats))
+    self.assertEqual('abc' * 100, lec.adats[0].dats[datatypes.AudioData.RAW])
+    lec.close()
+
+  def test_lazy_cache(self):
+    fileio.save(self.fname, self.lec, (0,4,0))
+    lec = fileio.LazyLecture(self.fname, cache_size=1)
+    first = lec.slide(0)
+    self.assertTrue(lec.slide(0) is first)
+    lec.slide(1)
+    self.assertEqual(1, len(lec._cache))
+    self.assertFalse(lec.slide(0) is first)
+    # Without STAT chunks, the state is worked out from the slides before.
+    lec._states[1] = None
+    lec._cache = fileio._LRU(1)
+    self.assertEqual((1., 0, 0), lec.slide(1).strokes()[0].color)
+    lec.close()
+
+  def test_lazy_legacy(self):
+    fileio.save(self.fname, self.lec, (0,3,0))
+    lec = fileio.load(self.fname, lazy=True)
+    self.assertTrue(isinstance(lec, datatypes.Lecture))
+    self.assertRaises(fileio.FormatError, fileio.LazyLecture, self.fname)
+
+  def test_iter_events(self):
+    for v in ((0,3,0), (0,5,0)):
+      fileio.save(self.fname, self.lec, v)
+      lec = fileio.load(self.fname)
+      events = list(fileio.iter_events(self.fname))
+      self.assertEqual([type(e) for e in lec], [type(e) for e in events])
+      self.assertEqual([e.utime() for e in lec], [e.utime() for e in events])
+      self.assertEqual(
+          [e.get_media().dats for e in lec
+           if isinstance(e, datatypes.AudioRecord)],
+          [e.get_media().dats for e in events
+           if isinstance(e, datatypes.AudioRecord)])
+      self.assertEqual(
+          [(type(e), e.utime()) for e in lec.events_between(11., 21.)],
+          [(type(e), e.utime()) for e in
+           fileio.iter_events(self.fname, 11., 21.)])
+      self.assertEqual([], list(fileio.iter_events(self.fname, 30.)))
+
+  def test_append(self):
+    def add(lec, events):
+      for e in events:
+        if isinstance(e, datatypes.Resize):
+          lec.resize(e.size, e.t)
+        else:
+          lec.append(e)
+    lec = datatypes.Lecture()
+    add(lec, self.lec[:5])  # stops in the middle of a stroke
+    fileio.save(self.fname, lec, append=True)
+    before = open(self.fname, 'rb').read()
+    add(lec, self.lec[5:])
+    fileio.save(self.fname, lec, append=True)
+
+    after = open(self.fname, 'rb').read()
+    index = fileio.DCB(self.fname).index()
+    self.assertEqual(before[:index[3][1]], after[:index[3][1]])
+    self.assertEqual(['HEAD', 'STAT', 'SLID', 'STAT', 'SLID', 'STAT', 'SLID',
+                      'AUDI'], [entry[0] for entry in index])
+    loaded = fileio.load(self.fname)
+    self.assertEqual([(type(e), e.utime()) for e in self.lec],
+                     [(type(e), e.utime()) for e in loaded])
+    self.assertEqual((640, 480), loaded.state.win_sz)
+    self.assertEqual('abc' * 100,
+                     loaded.adats[0].dats[datatypes.AudioData.RAW])
+
+    # Read lazily, the first slide's two parts make one slide.
+    lazy = fileio.LazyLecture(self.fname)
+    self.assertEqual([10., 20.], [slide.t for slide in lazy.slides()])
+    self.assertEqual(1, len(lazy.slides()[0].strokes))
+    self.assertEqual(3, len(lazy.slides()[0].strokes[0].points()))
+    self.assertEqual([(type(e), e.utime()) for e in self.lec],
+                     [(type(e), e.utime()) for e in lazy])
+    lazy.close()
+
+    # Nothing new: only the index is written again.
+    fileio.save(self.fname, lec, append=True)
+    self.assertEqual(len(after), os.path.getsize(self.fname))
+
+    # A lecture the file doesn't hold the start of is saved whole.
+    other = datatypes.Lecture()
+    add(other, self.lec[8:])
+    fileio.save(self.fname, other, append=True)
+    self.assertEqual(len(other), len(fileio.load(self.fname)))
+
+
+  def test_append_loaded_v5(self):
+    # Times in a v0.5 file are rounded to the grid, and a lecture loaded
+    # from it is still appended to, not saved whole.
+    lec = datatypes.Lecture()
+    lec.append(datatypes.Clear(10.0001234, None))
+    lec.append(datatypes.Click(11.0004321, (.25, .5)))
+    lec.append(datatypes.Release(12.0006789, (.75, 1)))
+    fileio.save(self.fname, lec, (0,5,0))
+    lec = fileio.load(self.fname)
+    size = len(fileio.DCB(self.fname).index())
+    lec.append(datatypes.Click(13.0001111, (.5, .5)))
+    lec.append(datatypes.Release(14.0002222, (.5, .75)))
+    self.assertNotEqual(None, fileio.DCB(self.fname, (0,5,0))._saved_part(lec))
+    before = open(self.fname, 'rb').read()
+    fileio.save(self.fname, lec, (0,5,0), append=True)
+    index = fileio.DCB(self.fname).index()
+    self.assertEqual(size + 2, len(index))  # the new events' STAT and SLID
+    self.assertEqual(before[:index[size][1]],
+                     open(self.fname, 'rb').read()[:index[size][1]])
+    self.assertEqual([13., 14.], [e.utime() for e in fileio.load(self.fname)
+                                   if isinstance(e, datatypes.Point)][2:])
+  def test_legacy_save(self):
+    fileio.save(self.fname, self.lec, (0,3,0))
+    dcb = fileio.DCB(self.fname)
+    self.assertEqual(2, len(dcb.load().strokes()))
+    self.assertEqual((0,3,0), dcb.v)
+    self.assertRaises(fileio.VersionError, fileio.save, self.fname, self.lec,
+                      (0,2,0))
+
 class TestDCD(unittest.TestCase):
   def setUp(self):
     self.dcd = fileio.DCD(tempfile.NamedTemporaryFile(prefix='TestDCD-').name)
@@ -74,7 +525,7 @@ class TestDCD(unittest.TestCase):
     self.assertNotEqual(None, self.dcd.fname)
     self.assertEqual(fileio.DEFAULT_VERSION, self.dcd.v)
     self.assertEqual(None, self.dcd.fp)
-    self.assertEqual(None, self.dcd.log)
+    self.assertFalse(self.dcd.diag.counting)
     self.assertEqual(None, self.dcd.lec)
 
   def test_simple_lecture(self):
@@ -93,6 +544,415 @@ class TestDCD(unittest.TestCase):
     l2 = self.dcd.load()
 
     self.assertFalse(l2.is_empty())
+    self.assertEqual(None, self.dcd.load_summaries())
+
+  def test_iter_events(self):
+    lec = datatypes.Lecture()
+    lec.append(datatypes.Color(10., (1, 0, 0)))
+    lec.append(datatypes.Click(11., (.25, .5)))
+    lec.append(datatypes.Release(12., (.5, .5)))
+    lec.append(datatypes.Clear(20., None))
+    lec.append(datatypes.Click(21., (.5, .5)))
+    lec.append(datatypes.Release(22., (.5, .75)))
+
+    self.dcd.save(lec)
+    loaded = self.dcd.load()
+    self.assertEqual([(type(e), e.utime()) for e in loaded],
+                     [(type(e), e.utime()) for e in self.dcd.iter_events()])
+    events = list(self.dcd.iter_events(19.5))
+    self.assertEqual([type(e) for e in loaded.events_between(19.5, 30.)],
+                     [type(e) for e in events])
+    self.assertEqual(datatypes.Clear, type(events[0]))
+    self.assertEqual([], list(self.dcd.iter_events(30.)))
+
+  def test_summaries(self):
+    lec = datatypes.Lecture()
+    lec.append(datatypes.Start(12345, (500,400)))
+    lec.append(datatypes.Color(12345, (1, 0, 0)))
+    lec.append(datatypes.Click(12678, (40, 80)))
+    lec.append(datatypes.Point(16789, (40, 90), 1))
+    lec.append(datatypes.Release(34567, (90,100)))
+    lec.append(datatypes.Clear(40000, None))
+
+    self.dcd.summaries = True
+    self.dcd.save(lec)
+    summaries = self.dcd.load_summaries()
+    self.assertEqual(lec.slide_summaries(), summaries)
+    self.assertEqual(3, summaries[0]['points'])
+    self.assertEqual((40, 80, 90, 100), summaries[0]['bbox'])
+    self.assertEqual([(1, 0, 0)], summaries[0]['colors'])
+    self.assertEqual(None, summaries[1]['bbox'])
+    self.assertFalse(self.dcd.load().is_empty())
+
+class TestJournal(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp(prefix='TestJournal-')
+    self.journal = fileio.Journal(self.dirname, flush_ms=10, flush_events=4)
+    self.lec = datatypes.Lecture()
+    self.lec.append(datatypes.Start(10., (800, 600)))
+
+  def tearDown(self):
+    self.journal.close()
+    import shutil
+    shutil.rmtree(self.dirname)
+
+  def draw(self, lec, t):
+    lec.append(datatypes.Color(t, (1., 0, 0)))
+    lec.append(datatypes.Click(t + 1, (.25, .5)))
+    lec.append(datatypes.Point(t + 1.5, (.25, .75), .5))
+    lec.append(datatypes.Release(t + 2, (.75, 1)))
+
+  def assertSameEvents(self, lec, other):
+    self.assertEqual([(type(e), e.utime()) for e in lec],
+                     [(type(e), e.utime()) for e in other])
+
+  def test_recover(self):
+    self.assertEqual(None, fileio.recover(self.dirname))
+    self.journal.start(self.lec)
+    self.assertTrue(self.lec.journal is self.journal)
+    self.draw(self.lec, 11.)
+    self.lec.append(datatypes.Clear(20., None))
+    self.lec.resize((640, 480), 20.5)
+    self.journal.add_audio(21., 'abc')
+    self.journal.add_audio(21., 'def')
+    self.draw(self.lec, 22.)
+    self.journal.close()
+    self.assertEqual(None, self.lec.journal)
+
+    lec = fileio.recover(self.dirname)
+    self.assertSameEvents(self.lec, lec)
+    self.assertEqual((640, 480), lec.state.win_sz)
+    self.assertEqual(.5, lec[3].p)
+    self.assertEqual(1, len(lec.adats))
+    self.assertEqual('abcdef', lec.adats[0].dats[datatypes.AudioData.RAW])
+
+  def test_restart(self):
+    self.journal.start(self.lec)
+    lec = datatypes.Lecture()
+    lec.append(datatypes.Start(30., (640, 480)))
+    self.journal.start(lec)
+    self.assertEqual(None, self.lec.journal)
+    self.assertTrue(lec.journal is self.journal)
+    self.draw(self.lec, 11.)  # not logged any more
+    self.journal.close()
+    self.assertSameEvents(lec, fileio.recover(self.dirname))
+
+  def test_group_commit(self):
+    self.journal.flush_ms = 60000
+    self.journal.start(self.lec)
+    size = os.path.getsize(self.journal.fname)
+    self.lec.append(datatypes.Move(11., (.5, .5)))
+    self.lec.append(datatypes.Move(12., (.5, .5)))
+    self.assertEqual(2, len(self.journal._pending))
+    self.draw(self.lec, 13.)  # reaches flush_events
+    for i in xrange(100):  # give the writer a second
+      if os.path.getsize(self.journal.fname) > size: break
+      time.sleep(.01)
+    self.assertTrue(os.path.getsize(self.journal.fname) > size)
+    self.assertEqual(7, len(fileio.recover(self.dirname)))
+
+  def test_torn(self):
+    self.journal.start(self.lec)
+    self.draw(self.lec, 11.)
+    self.journal.close()
+    size = os.path.getsize(self.journal.fname)
+    self.journal.start(self.lec, None)
+    self.draw(self.lec, 13.)
+    self.journal.close()
+    f = open(self.journal.fname, 'r+b')
+    f.truncate(os.path.getsize(self.journal.fname) - 3)
+    f.close()
+    lec = fileio.recover(self.dirname)
+    self.assertTrue(5 <= len(lec) < len(self.lec))
+    self.assertSameEvents(lec, self.lec[:len(lec)])
+
+  def test_compact(self):
+    fname = os.path.join(self.dirname, 'saved.dcb')
+    self.journal.start(self.lec)
+    self.draw(self.lec, 11.)
+    audio = datatypes.AudioData(12.)
+    audio.add_type(datatypes.AudioData.RAW, 'abc' * 100)
+    self.lec.append(datatypes.AudioRecord(12., 0, audio))
+    fileio.save(fname, self.lec)
+    self.journal.compact(fname)
+    self.draw(self.lec, 20.)
+    self.journal.close()
+
+    lec = fileio.recover(self.dirname)
+    self.assertSameEvents(self.lec, lec)
+    self.assertEqual(['abc' * 100],
+        [adat.dats[datatypes.AudioData.RAW] for adat in lec.adats])
+    self.journal.close(remove=True)
+    self.assertEqual(None, fileio.recover(self.dirname))
+
+  def test_missing_base(self):
+    fname = os.path.join(self.dirname, 'saved.dcb')
+    fileio.save(fname, self.lec)
+    self.journal.start(self.lec, fname)
+    self.draw(self.lec, 11.)
+    self.journal.close()
+    size = os.path.getsize(self.journal.fname)
+
+    open(fname, 'wb').write('garbage')
+    self.assertRaises(fileio.MissingBaseError, fileio.recover, self.dirname)
+    os.remove(fname)
+    self.assertRaises(fileio.MissingBaseError, fileio.recover, self.dirname)
+    self.assertEqual(size, os.path.getsize(self.journal.fname))
+
+class TestSaver(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp(prefix='TestSaver-')
+    self.fname = os.path.join(self.dirname, 'save.dcb')
+    self.lec = datatypes.Lecture()
+    self.lec.append(datatypes.Start(10., (800, 600)))
+    self.lec.append(datatypes.Click(11., (.25, .5)))
+    self.lec.append(datatypes.Release(12., (.75, 1)))
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.dirname)
+
+  def test_save(self):
+    saver = fileio.save_in_background(self.fname, self.lec)
+    self.lec.append(datatypes.Clear(20., None))  # not in the snapshot
+    saver.join()
+    self.assertTrue(saver.done())
+    self.assertEqual(None, saver.error)
+    self.assertEqual(3, saver.num_events)
+    self.assertEqual(3, len(fileio.load(self.fname)))
+    self.assertEqual(['save.dcb'], os.listdir(self.dirname))
+
+    inode = os.stat(self.fname).st_ino
+    saver = fileio.save_in_background(self.fname, self.lec, append=True)
+    saver.join()
+    self.assertEqual(4, len(fileio.load(self.fname)))
+    self.assertEqual(inode, os.stat(self.fname).st_ino)  # appended in place
+
+  def test_round_trips(self):
+    self.assertTrue(fileio.Saver(self.fname, self.lec,
+                                 req_v=(0,4,0)).round_trips())
+    self.assertFalse(fileio.Saver(self.fname, self.lec,
+                                  req_v=(0,5,0)).round_trips())
+    for ext in ('.dcx', '.dct', '.dcd', '.dar', '.txt'):
+      self.assertFalse(fileio.Saver(self.fname[:-4] + ext, self.lec,
+                                    req_v=(0,4,0)).round_trips())
+
+  def test_mode(self):
+    umask = os.umask(022)
+    try:
+      fileio.save_in_background(self.fname, self.lec).join()
+      self.assertEqual(0644, os.stat(self.fname).st_mode & 0777)
+      os.chmod(self.fname, 0640)
+      fileio.save_in_background(self.fname, self.lec).join()
+      self.assertEqual(0640, os.stat(self.fname).st_mode & 0777)
+    finally:
+      os.umask(umask)
+
+  def test_error(self):
+    saver = fileio.save_in_background(self.fname, self.lec,
+                                      req_v=(0,2,0))
+    saver.join()
+    self.assertTrue(isinstance(saver.error, fileio.VersionError))
+    self.assertEqual([], os.listdir(self.dirname))
+
+class TestDAR(unittest.TestCase):
+  def setUp(self):
+    self.fname = tempfile.NamedTemporaryFile(prefix='TestDAR-',
+                                             suffix='.dar').name
+    self.lec = datatypes.Lecture()
+    self.lec.append(datatypes.Clear(10., None))
+    self.lec.append(datatypes.Color(11., (1., 0, 0)))
+    self.lec.append(datatypes.Click(11., (.25, .5)))
+    self.lec.append(datatypes.Point(11.5, (.25, .75), .5))
+    self.lec.append(datatypes.Release(12., (.75, 1)))
+    for i in xrange(3):
+      audio = datatypes.AudioData(13. + i)
+      audio.add_type(datatypes.AudioData.RAW, str(i) * 1000)
+      self.lec.append(datatypes.AudioRecord(13. + i, i, audio))
+    self.lec.append(datatypes.Clear(20., None))
+    self.lec.append(datatypes.Color(21., (0, 0, 1.)))
+    self.lec.append(datatypes.Click(21., (.5, .5)))
+    self.lec.append(datatypes.Release(22., (.5, .75)))
+
+  def tearDown(self):
+    if os.path.exists(self.fname):
+      os.remove(self.fname)
+
+  def test_round_trip(self):
+    fileio.save(self.fname, self.lec)
+    lec = fileio.load(self.fname)
+    self.assertEqual([(type(e), e.utime()) for e in self.lec],
+                     [(type(e), e.utime()) for e in lec])
+    self.assertEqual(.5, lec[3].p)
+    self.assertEqual([str(i) * 1000 for i in xrange(3)],
+        [adat.dats[datatypes.AudioData.RAW] for adat in lec.adats])
+    self.assertEqual([(type(e), e.utime()) for e in lec],
+                     [(type(e), e.utime()) for e in
+                      fileio.iter_events(self.fname)])
+
+  def test_members(self):
+    fileio.save(self.fname, self.lec)
+    arc = zipfile.ZipFile(self.fname)
+    try:
+      self.assertEqual(None, arc.testzip())
+      types = dict((info.filename, info.compress_type)
+                   for info in arc.infolist())
+    finally:
+      arc.close()
+    self.assertEqual(zipfile.ZIP_STORED, types['metadata'])
+    self.assertEqual(zipfile.ZIP_DEFLATED, types['slide001/strokes'])
+    self.assertEqual(zipfile.ZIP_DEFLATED, types['audio002'])
+
+    dar = fileio.DAR(self.fname)
+    self.assertEqual(2, dar.num_slides())
+    self.assertEqual([datatypes.Clear, datatypes.Color, datatypes.Click,
+                      datatypes.Release], [type(e) for e in dar.load_slide(1)])
+    self.assertEqual([13., 14., 15.], [a.utime() for a in dar.load_audio()])
+
+  def test_parallel(self):
+    workers = fileio.AUDIO_WORKERS, fileio.PARALLEL_AUDIO_BYTES
+    try:
+      fileio.AUDIO_WORKERS, fileio.PARALLEL_AUDIO_BYTES = 2, 0
+      fileio.save(self.fname, self.lec)
+      lec = fileio.load(self.fname)
+    finally:
+      fileio.AUDIO_WORKERS, fileio.PARALLEL_AUDIO_BYTES = workers
+    self.assertEqual([(type(e), e.utime()) for e in self.lec],
+                     [(type(e), e.utime()) for e in lec])
+    self.assertEqual('2' * 1000, lec.adats[2].dats[datatypes.AudioData.RAW])
+
+  def test_not_a_dar(self):
+    f = open(self.fname, 'w')
+    f.write('not a zip file')
+    f.close()
+    self.assertEqual((), fileio.load(self.fname))
+
+class TestDCX(unittest.TestCase):
+  def setUp(self):
+    self.fname = tempfile.NamedTemporaryFile(prefix='TestDCX-',
+                                             suffix='.dcx').name
+    f = open(self.fname, 'w')
+    f.write('''<?xml version="1.0" encoding="UTF-8"?>
+<document version="0.1.1">
+  <slide cleartime="1.0">
+    <stroke color="#ff0000">
+      <point x="0.1" y="0.2" time="2.0" thickness="0.01"/>
+      <point x="0.2" y="0.2" time="2.5" thickness="0.02"/>
+      <point x="0.3" y="0.2" time="3.0" thickness="0.01"/>
+    </stroke>
+  </slide>
+  <slide cleartime="5.0">
+  </slide>
+  <position x="0.5" y="0.5" time="2.2"/>
+  <audiofile time="2.7" type="wav" encoding="base64">YWJj</audiofile>
+</document>
+''')
+    f.close()
+
+  def tearDown(self):
+    if os.path.exists(self.fname):
+      os.remove(self.fname)
+
+  def test_iter_events(self):
+    events = list(fileio.iter_events(self.fname))
+    self.assertEqual([datatypes.Clear, datatypes.Color, datatypes.Thickness,
+                      datatypes.Click, datatypes.Move, datatypes.Point,
+                      datatypes.AudioRecord, datatypes.Release,
+                      datatypes.Clear], [type(e) for e in events])
+    self.assertEqual((1., 0, 0), events[1].color)
+    self.assertEqual(.02, events[2].thickness)
+    self.assertEqual(1., events[5].p)
+    self.assertEqual((.5, .5), events[4].pos)
+    self.assertEqual('abc',
+        events[6].get_media().dats[datatypes.AudioData.RAW])
+    self.assertEqual([2.7, 3., 5.],
+        [e.utime() for e in fileio.iter_events(self.fname, 2.5, 6.)])
+
+  def test_load(self):
+    lec = fileio.load(self.fname)
+    self.assertEqual([(type(e), e.utime()) for e in
+                      fileio.iter_events(self.fname)],
+                     [(type(e), e.utime()) for e in lec.events])
+    self.assertEqual(['abc'], [a.dats[datatypes.AudioData.RAW]
+                               for a in lec.adats])
+
+  def test_load_audio_in_pieces(self):
+    data = ''.join(chr(i % 256) for i in xrange(3000))
+    f = open(self.fname, 'w')
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<document version="0.1.1">\n'
+            '  <audiofile time="1.0" type="wav" encoding="base64">')
+    encoded = base64.b64encode(data)
+    for i in xrange(0, len(encoded), 77):  # lines not a multiple of 4 long
+      f.write(encoded[i:i+77] + '\n')
+    f.write('</audiofile>\n</document>\n')
+    f.close()
+    B64_CHARS = fileio._DCXReader.B64_CHARS
+    fileio._DCXReader.B64_CHARS = 100
+    try:
+      lec = fileio.load(self.fname)
+    finally:
+      fileio._DCXReader.B64_CHARS = B64_CHARS
+    self.assertEqual(data, lec.adats[0].dats[datatypes.AudioData.RAW])
+
+  def test_thin_strokes(self):
+    f = open(self.fname, 'w')
+    f.write('''<?xml version="1.0" encoding="UTF-8"?>
+<document version="0.1.1">
+  <slide cleartime="1.0">
+    <stroke color="#000000">
+      <point x="0.1" y="0.2" time="2.0" thickness="0"/>
+      <point x="0.2" y="0.2" time="2.5" thickness="0"/>
+      <point x="0.3" y="0.2" time="3.0" thickness="0"/>
+    </stroke>
+    <stroke color="#000000">
+      <point x="0.5" y="0.5" time="4.0" thickness="0.01"/>
+    </stroke>
+  </slide>
+</document>
+''')
+    f.close()
+    kinds = [datatypes.Clear,
+             datatypes.Color, datatypes.Thickness, datatypes.Click,
+             datatypes.Point, datatypes.Release,
+             datatypes.Color, datatypes.Thickness, datatypes.Click,
+             datatypes.Release]
+    lec = fileio.load(self.fname)
+    self.assertEqual(kinds, [type(e) for e in lec])
+    self.assertEqual(kinds, [type(e) for e in fileio.iter_events(self.fname)])
+    self.assertEqual(2, len(lec.strokes()))
+    self.assertTrue(all(stroke.closed for stroke in lec.strokes()))
+
+  def test_save(self):
+    lec = datatypes.Lecture()
+    lec.append(datatypes.Clear(10., None))
+    # DCX keeps colors and thicknesses with the strokes, so they come back
+    # at the time of the stroke's first point.
+    lec.append(datatypes.Color(11., (1., 0, 0)))
+    lec.append(datatypes.Thickness(11., .25))
+    lec.append(datatypes.Click(11., (.25, .5)))
+    lec.append(datatypes.Point(11.5, (.25, .75), .5))
+    lec.append(datatypes.Release(12., (.75, 1)))
+    lec.append(datatypes.Move(13., (.5, .5)))
+    audio = datatypes.AudioData(14.)
+    audio.add_type(datatypes.AudioData.RAW, ['ab', 'cde', 'f' * 1000])
+    lec.append(datatypes.AudioRecord(14., 0, audio))
+    lec.append(datatypes.Clear(20., None))
+    B64_BYTES = fileio._DCXWriter.B64_BYTES
+    fileio._DCXWriter.B64_BYTES = 30
+    try:
+      fileio.save(self.fname, lec)
+    finally:
+      fileio._DCXWriter.B64_BYTES = B64_BYTES
+    loaded = fileio.load(self.fname)
+    self.assertEqual([(type(e), e.utime()) for e in lec],
+                     [(type(e), e.utime()) for e in loaded])
+    self.assertEqual((1., 0, 0), loaded[1].color)
+    self.assertEqual(.25, loaded[2].thickness)
+    self.assertEqual(.5, loaded[4].p)
+    self.assertEqual((.75, 1), loaded[5].pos)
+    self.assertEqual('abcde' + 'f' * 1000,
+                     loaded.adats[0].dats[datatypes.AudioData.RAW])
 
 
 if __name__ == "__main__":
@@ -7,10 +7,9 @@ from datatypes import *
 
 if len(sys.argv) <= 0: sys.exit()
 
-lec = fileio.load('../saves/ll2.dcb')
 ofile = open('tmp.csv', 'w')
 
-it = iter(lec)
+it = fileio.iter_events('../saves/ll2.dcb')
 try:
   last_point = None
   while True: